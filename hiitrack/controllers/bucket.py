@@ -9,8 +9,9 @@ user.
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..lib.authentication import authenticate
 from ..exceptions import BucketException
-from ..models import bucket_check, BucketModel, user_authorize
-from ..lib.b64encode import b64encode_values, b64encode_nested_values
+from ..models import bucket_check, BucketModel, user_authorize, \
+    parse_settings
+from ..lib.serializer import Stream, id_values, id_nested_values
 from ..lib.parameters import require
 
 
@@ -44,15 +45,23 @@ class Bucket(object):
     @inlineCallbacks
     def put(self, request, user_name, bucket_name):
         """
-        Create a new bucket.
+        Create a new bucket. Optional 'path_limit' and 'path_window'
+        parameters limit the paths recorded for each event to those from
+        the visitor's last path_limit distinct events or from events in
+        the last path_window seconds.
         """
         bucket = BucketModel(user_name, bucket_name)
         exists = yield bucket.exists()
         if exists:
             request.setResponseCode(403)
             raise BucketException("Bucket already exists.")
+        try:
+            settings = parse_settings(request.args)
+        except BucketException:
+            request.setResponseCode(403)
+            raise
         description = request.args["description"][0]
-        yield bucket.create(description)
+        yield bucket.create(description, settings)
         request.setResponseCode(201)
 
     @authenticate
@@ -61,18 +70,24 @@ class Bucket(object):
     @inlineCallbacks
     def get(self, request, user_name, bucket_name):
         """
-        Information about the bucket.
+        Information about the bucket. Properties, events, and stats are
+        read as the response is streamed.
         """
         bucket = BucketModel(user_name, bucket_name)
         name, description = yield bucket.get_name_and_description()
-        data = yield bucket.get_properties()
-        properties = b64encode_nested_values(data)
-        data = yield bucket.get_events()
-        events = b64encode_values(data)
-        returnValue({
-            "description": description,
-            "properties": properties,
-            "events": events})
+        settings = yield bucket.get_settings()
+
+        def sections():
+            """
+            Response sections.
+            """
+            yield "description", description
+            yield "properties", \
+                bucket.get_properties().addCallback(id_nested_values)
+            yield "events", bucket.get_events().addCallback(id_values)
+            yield "settings", settings
+            yield "stats", bucket.get_stats()
+        returnValue(Stream(sections()))
 
     @authenticate
     @user_authorize
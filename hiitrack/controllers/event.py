@@ -5,13 +5,256 @@
 Events are name/timestamp pairs linked to a visitor and stored in buckets.
 """
 
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
+import time
+import ujson
+from twisted.python import log
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    DeferredList, DeferredSemaphore, gatherResults
 from ..models import bucket_check, user_authorize
-from ..models import VisitorModel, EventModel
+from ..models import VisitorModel, EventModel, PropertyValueModel, \
+    BucketModel
+from ..models.event import format_day, format_periods, plan_periods
+from ..exceptions import MissingParameterException
 from ..lib.authentication import authenticate
-from ..lib.b64encode import b64encode_keys, b64encode_nested_keys, \
-    uri_b64encode
-from ..lib.parameters import require
+from ..lib.cassandra import CounterBatch
+from ..lib.serializer import Id, Stream, id_keys, id_nested_keys
+from ..lib.parameters import require, time_range
+from .property import record_property
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+# Maximum number of visitor states read concurrently by ingest().
+INGEST_CONCURRENCY = 50
+# Number of days, ending today, of daily unique visitor counts in Event.get.
+UNIQUE_VISITOR_DAYS = 30
+# Optional Spool. When set, posted events are spooled to disk, answered with
+# 202 Accepted, and recorded in the background by ingest_spooled().
+SPOOL = None
+
+
+def record_event(event, visitor, state, batch, settings=None,
+        timestamp=None):
+    """
+    Add the counter increments recording event for a visitor to batch and
+    update the visitor's state. If the bucket's settings have a path_limit
+    or path_window, paths are only added from the visitor's recent events,
+    hits with fewer paths are counted in the bucket's stats row, and a
+    Deferred for the visitor event time write is returned. Otherwise
+    returns None. The visitor is also added to the event's sketches. If
+    the bucket has the time_series setting, counters are also incremented
+    in the rows of the hit's day and hour, and both periods are counted in
+    the bucket's period row.
+    """
+    settings = settings or {}
+    limit = settings.get("path_limit")
+    window = settings.get("path_window")
+    if timestamp is None:
+        timestamp = time.time()
+    deferred = None
+    event_time = None
+    periods = ()
+    if settings.get("time_series"):
+        periods = format_periods(timestamp)
+        for resolution, period in periods:
+            batch.add(
+                (event.user_name, event.bucket_name, "period"),
+                column_id="%s/%s" % (resolution, period))
+    event_ids = state.event_totals.keys()
+    if limit or window:
+        event_time = timestamp
+        event_ids = state.recent_event_ids(timestamp, limit, window)
+        skipped = len(state.event_totals) - len(event_ids)
+        if skipped:
+            stats_key = (event.user_name, event.bucket_name, "stats")
+            batch.add(stats_key, column_id="truncated_hits")
+            batch.add(stats_key, column_id="skipped_paths", value=skipped)
+        deferred = visitor.set_event_time(event.id, timestamp)
+    unique = event.id not in state.event_totals
+    event.increment_total(unique, batch=batch, periods=periods)
+    for property_id in state.property_ids:
+        event.increment_total(
+            unique,
+            property_id,
+            batch=batch,
+            periods=periods)
+    visitor.increment_total(event.id, batch=batch)
+    for event_id in event_ids:
+        _unique = unique or event_id not in state.path[event.id]
+        visitor.increment_path(event_id, event.id, batch=batch)
+        event.increment_path(event_id, _unique, batch=batch, periods=periods)
+        for property_id in state.property_ids:
+            event.increment_path(
+                event_id,
+                _unique,
+                property_id,
+                batch=batch,
+                periods=periods)
+    event.add_visitor(visitor.id, state.property_ids, batch, timestamp)
+    state.add_event(event.id, event_ids, event_time)
+    visitor.update_state(state)
+    return deferred
+
+
+def _utf8(value):
+    """
+    Encode JSON strings like path parameters.
+    """
+    if isinstance(value, unicode):
+        return value.encode("utf8")
+    if not isinstance(value, str):
+        raise ValueError("Expected a string, got %r." % (value,))
+    return value
+
+
+def parse_record(item):
+    """
+    Validate a decoded event record and encode its strings.
+    """
+    if not isinstance(item, dict):
+        raise ValueError("Event records must be objects.")
+    if not item.get("visitor_id") or not item.get("event"):
+        raise ValueError("Parameters 'visitor_id' and 'event' are required.")
+    properties = item.get("properties") or {}
+    if isinstance(properties, dict):
+        properties = sorted(properties.items())
+    elif not isinstance(properties, list) or [x for x in properties \
+            if not isinstance(x, (list, tuple)) or len(x) != 2]:
+        # Spooled records store properties as [name, value] pairs.
+        raise ValueError("Parameter 'properties' must be an object.")
+    timestamp = item.get("timestamp")
+    if timestamp is not None:
+        if not isinstance(timestamp, (int, long, float)):
+            raise ValueError("Parameter 'timestamp' must be a number.")
+        timestamp = float(timestamp)
+    return {
+        "visitor_id": _utf8(item["visitor_id"]),
+        "event": _utf8(item["event"]),
+        "properties": [(_utf8(k), _utf8(v)) for k, v in properties],
+        "timestamp": timestamp}
+
+
+def parse_records(body):
+    """
+    Parse a JSON array or newline delimited JSON objects into a list of
+    event records.
+    """
+    body = body.strip()
+    if body.startswith("["):
+        data = ujson.loads(body)
+    else:
+        data = [ujson.loads(x) for x in body.splitlines() if x.strip()]
+    return [parse_record(x) for x in data]
+
+
+@inlineCallbacks
+def ingest(user_name, bucket_name, records):
+    """
+    Record a list of event records. Records are grouped by visitor and each
+    group is applied in order. Counter increments of all records are merged
+    into one batch. Fails if any write fails.
+    """
+    groups = OrderedDict()
+    for record in records:
+        groups.setdefault(record["visitor_id"], []).append(record)
+    visitors = [VisitorModel(user_name, bucket_name, x) for x in groups]
+    settings = yield BucketModel(user_name, bucket_name).get_settings()
+    settings = settings or {}
+    filtered = bool(settings.get("visitor_filter"))
+    semaphore = DeferredSemaphore(INGEST_CONCURRENCY)
+    states = yield gatherResults(
+        [semaphore.run(x.get_state, filtered) for x in visitors],
+        consumeErrors=True)
+    batch = CounterBatch()
+    deferreds = []
+    events = {}
+    property_values = {}
+    for visitor, state, group in zip(visitors, states, groups.values()):
+        for record in group:
+            for property_name, value in record["properties"]:
+                key = (property_name, value)
+                if key not in property_values:
+                    property_values[key] = PropertyValueModel(
+                        user_name,
+                        bucket_name,
+                        property_name,
+                        value)
+                deferred = record_property(
+                    property_values[key],
+                    visitor,
+                    state,
+                    batch)
+                if deferred is not None:
+                    deferreds.append(deferred)
+            if record["event"] not in events:
+                events[record["event"]] = EventModel(
+                    user_name,
+                    bucket_name,
+                    record["event"])
+            deferred = record_event(
+                events[record["event"]],
+                visitor,
+                state,
+                batch,
+                settings,
+                record["timestamp"])
+            if deferred is not None:
+                deferreds.append(deferred)
+    deferreds.extend([x.create() for x in events.values()])
+    deferreds.extend([x.create() for x in property_values.values()])
+    deferreds.append(batch.send())
+    try:
+        yield gatherResults(deferreds, consumeErrors=True)
+    except Exception:
+        # The cached states already include the failed writes.
+        for visitor in visitors:
+            visitor.invalidate_state()
+        raise
+
+
+@inlineCallbacks
+def ingest_spooled(items):
+    """
+    Record spooled event records, grouped by bucket. Returns the items of
+    buckets that failed, for the spool to retry, so other buckets' records
+    are never recorded twice. Counter writes of a failed bucket that
+    succeeded before the failure are applied again when it is retried.
+    """
+    buckets = OrderedDict()
+    for item in items:
+        try:
+            record = parse_record(item)
+        except ValueError:
+            log.msg("Skipping invalid spooled record: %r" % (item,))
+            continue
+        key = (_utf8(item["user_name"]), _utf8(item["bucket_name"]))
+        buckets.setdefault(key, []).append((item, record))
+    results = yield DeferredList(
+        [ingest(user_name, bucket_name, [x[1] for x in pairs]) \
+            for (user_name, bucket_name), pairs in buckets.items()],
+        consumeErrors=True)
+    retries = []
+    for (key, pairs), (success, result) in zip(buckets.items(), results):
+        if not success:
+            log.err(result, "Retrying spooled records of bucket %s/%s" % key)
+            retries.extend([x[0] for x in pairs])
+    returnValue(retries)
+
+
+def spool_records(user_name, bucket_name, records):
+    """
+    Append event records to SPOOL. Returns a Deferred that fires once they
+    are durable.
+    """
+    timestamp = time.time()
+    for record in records:
+        record["user_name"] = user_name
+        record["bucket_name"] = bucket_name
+        if record.get("timestamp") is None:
+            record["timestamp"] = timestamp
+    return SPOOL.append(records)
 
 
 class Event(object):
@@ -20,6 +263,12 @@ class Event(object):
     """
 
     def __init__(self, dispatcher):
+        dispatcher.connect(
+            name='event_batch',
+            route='/{user_name}/{bucket_name}/event',
+            controller=self,
+            action='post_batch',
+            conditions={"method": "POST"})
         dispatcher.connect(
             name='event',
             route='/{user_name}/{bucket_name}/event/{event_name}',
@@ -45,20 +294,49 @@ class Event(object):
     @inlineCallbacks
     def get(self, request, user_name, bucket_name, event_name):
         """
-        Information about the event.
+        Information about the event. With 'start' and 'end' timestamps,
+        counts are summed over the hours in that range, and daily unique
+        visitors are given for its days.
         """
         event = EventModel(user_name, bucket_name, event_name)
-        total = yield event.get_total()
-        unique_total = yield event.get_unique_total()
-        path = yield event.get_path()
-        unique_path = yield event.get_unique_path()
-        returnValue({
-            "id": uri_b64encode(event.id),
-            "unique_total": b64encode_keys(unique_total),
-            "total": b64encode_keys(total),
-            "path": b64encode_nested_keys(path),
-            "unique_path": b64encode_nested_keys(unique_path),
-            "name": event_name})
+        start, end = time_range(request)
+        if start is None:
+            periods = None
+            now = time.time()
+            days = [format_day(now - 86400 * x) \
+                for x in range(UNIQUE_VISITOR_DAYS)]
+        else:
+            periods = plan_periods(start, end)
+            days = [format_day(x) \
+                for x in range(int(start) // 86400 * 86400, int(end), 86400)]
+        (totals, unique_totals), (paths, unique_paths), \
+            (visitors, daily_visitors) = yield gatherResults(
+                [EventModel.get_totals(
+                    user_name,
+                    bucket_name,
+                    [event.id],
+                    periods),
+                EventModel.get_paths(
+                    user_name,
+                    bucket_name,
+                    [event.id],
+                    periods),
+                EventModel.get_unique_visitors(
+                    user_name,
+                    bucket_name,
+                    [event.id],
+                    days)],
+                consumeErrors=True)
+        returnValue(Stream([
+            ("id", Id(event.id)),
+            ("unique_total", id_keys(unique_totals[event.id])),
+            ("total", id_keys(totals[event.id])),
+            ("path", id_nested_keys(paths[event.id])),
+            ("unique_path", id_nested_keys(unique_paths[event.id])),
+            ("unique_visitors", id_keys(visitors[event.id])),
+            ("daily_unique_visitors", dict([(k, id_keys(v)) \
+                for k, v in daily_visitors[event.id].iteritems()])),
+            ("name", event_name)]))
 
     @require("visitor_id")
     @bucket_check
@@ -67,26 +345,46 @@ class Event(object):
         """
         Create event.
         """
+        if SPOOL is not None:
+            yield spool_records(user_name, bucket_name, [{
+                "visitor_id": request.args["visitor_id"][0],
+                "event": event_name}])
+            request.setResponseCode(202)
+            return
         event = EventModel(user_name, bucket_name, event_name)
         visitor = VisitorModel(
             user_name,
             bucket_name,
             request.args["visitor_id"][0])
-        event_ids = yield visitor.get_event_ids()
-        path = yield visitor.get_path()
-        property_ids = yield visitor.get_property_ids()
-        unique = event.id not in event_ids
-        deferreds = [
-            event.create(),
-            event.increment_total(unique)]
-        for property_id in property_ids:
-            deferreds.append(event.increment_total(unique, property_id))
-        deferreds.append(visitor.increment_total(event.id))
-        for event_id in event_ids:
-            _unique = unique or event_id not in path[event.id]
-            deferreds.append(visitor.increment_path(event_id, event.id))
-            deferreds.append(event.increment_path(event_id, _unique))
-            for property_id in property_ids:
-                deferreds.append(event.increment_path(event_id, _unique, property_id))
-        yield DeferredList(deferreds)
+        settings = yield BucketModel(user_name, bucket_name).get_settings()
+        state = yield visitor.get_state(bool(settings.get("visitor_filter")))
+        batch = CounterBatch()
+        deferred = record_event(event, visitor, state, batch, settings)
+        deferreds = [event.create(), batch.send()]
+        if deferred is not None:
+            deferreds.append(deferred)
+        try:
+            yield gatherResults(deferreds, consumeErrors=True)
+        except Exception:
+            visitor.invalidate_state()
+            raise
 
+    @bucket_check
+    @inlineCallbacks
+    def post_batch(self, request, user_name, bucket_name):
+        """
+        Create events from a JSON array or newline delimited JSON objects
+        with 'visitor_id', 'event', and optional 'properties' and
+        'timestamp' keys.
+        """
+        try:
+            records = parse_records(request.content.read())
+        except ValueError, error:
+            request.setResponseCode(403)
+            raise MissingParameterException(str(error))
+        if SPOOL is not None:
+            yield spool_records(user_name, bucket_name, records)
+            request.setResponseCode(202)
+        else:
+            yield ingest(user_name, bucket_name, records)
+        returnValue({"events": len(records)})
@@ -6,23 +6,64 @@ Funnels are a collection of events within a bucket.
 """
 
 from itertools import chain
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    gatherResults
 from telephus.cassandra.c08.ttypes import NotFoundException
 from ..models import bucket_check, user_authorize
 from ..models import FunnelModel, EventModel
 from ..lib.authentication import authenticate
 from ..exceptions import MissingParameterException
-from ..lib.b64encode import uri_b64decode, uri_b64encode, \
-    b64encode_nested_keys, b64encode_double_nested_keys
-from ..lib.parameters import require
+from ..lib.b64encode import uri_b64decode
+from ..lib.serializer import Id, IdPairs, Stream, id_nested_keys, \
+    id_double_nested_keys
+from ..lib.parameters import require, time_range
+from ..models.event import plan_periods
 
 
-def encode_nested_lists(dictionary):
+def property_funnel(event_ids, property_id, totals, paths):
     """
-    Base64 encodes nested lists.
+    Return the (event_id, count) steps of the funnel over event_ids for
+    visitors with property_id, from totals and paths.
     """
-    return dict([(uri_b64encode(k), [(uri_b64encode(x[0]), x[1]) for x in v]) \
-        for k, v in dictionary.items()])
+    event_id = event_ids[0]
+    try:
+        steps = [(event_id, totals[event_id][property_id])]
+    except KeyError:
+        steps = [(event_id, 0)]
+    for i in range(1, len(event_ids)):
+        event_id = event_ids[i - 1]
+        new_event_id = event_ids[i]
+        try:
+            steps.append((
+                new_event_id,
+                paths[new_event_id][property_id][event_id]))
+        except KeyError:
+            steps.append((new_event_id, 0))
+    return steps
+
+
+def property_funnels(event_ids, property_ids, totals, paths):
+    """
+    Stream the funnel of each property, computing one at a time.
+    """
+    return Stream((
+        Id(x),
+        IdPairs(property_funnel(event_ids, x, totals, paths))) \
+        for x in property_ids)
+
+
+def plan_path_columns(event_ids, property_ids):
+    """
+    Return the path columns a funnel over event_ids reads: for each step,
+    new_event_id + (new_event_id or property_id) + previous event_id.
+    """
+    column_ids = []
+    for i in range(1, len(event_ids)):
+        event_id = event_ids[i - 1]
+        new_event_id = event_ids[i]
+        for property_id in chain([new_event_id], property_ids):
+            column_ids.append("".join([new_event_id, property_id, event_id]))
+    return column_ids
 
 
 class Funnel(object):
@@ -75,7 +116,8 @@ class Funnel(object):
     @inlineCallbacks
     def get_saved_funnel(self, request, user_name, bucket_name, funnel_name):
         """
-        Get funnel details.
+        Get funnel details. With 'start' and 'end' timestamps, totals and
+        paths are summed over the hours in that range.
         """
         funnel = FunnelModel(user_name, bucket_name, funnel_name)
         try:
@@ -83,19 +125,27 @@ class Funnel(object):
         except NotFoundException:
             request.setResponseCode(404)
             raise
-        totals = {}
-        unique_totals = {}
-        paths = {}
-        unique_paths = {}
-        for event_id in event_ids:
-            event = EventModel(user_name, bucket_name, event_id=event_id)
-            total = yield event.get_total()
-            totals[event.id] = total
-            unique_totals[event.id] = yield event.get_unique_total()
-            paths[event.id] = yield event.get_path()
-            unique_paths[event.id] = yield event.get_unique_path()
+        start, end = time_range(request)
+        if start is None:
+            periods = None
+        else:
+            periods = plan_periods(start, end)
+        (totals, unique_totals), (visitors, _) = yield gatherResults(
+            [EventModel.get_totals(
+                user_name,
+                bucket_name,
+                event_ids,
+                periods),
+            EventModel.get_unique_visitors(user_name, bucket_name, event_ids)],
+            consumeErrors=True)
         property_ids = chain(*[x.keys() for x in totals.values()])
         property_ids = set(property_ids) - set(event_ids)
+        # Only read the path columns between consecutive funnel steps.
+        paths, unique_paths = yield EventModel.get_path_columns(
+            user_name,
+            bucket_name,
+            plan_path_columns(event_ids, property_ids),
+            periods)
         # Full funnel, no properties.
         event_id = event_ids[0]
         base_funnel = [(event_id, totals[event_id][event_id])]
@@ -112,49 +162,26 @@ class Funnel(object):
                     unique_paths[new_event_id][new_event_id][event_id]))
             except KeyError:
                 base_unique_funnel.append((new_event_id, 0))
-        funnels = {}
-        unique_funnels = {}
-        for property_id in property_ids:
-            event_id = event_ids[0]
-            try:
-                _funnel = [(event_id, totals[event_id][property_id])]
-            except KeyError:
-                _funnel = [(event_id, 0)]
-            try:
-                unique_funnel = [(
-                    event_id,
-                    unique_totals[event_id][property_id])]
-            except KeyError:
-                unique_funnel = [(event_id, 0)]
-            for i in range(1, len(event_ids)):
-                event_id = event_ids[i - 1]
-                new_event_id = event_ids[i]
-                try:
-                    _funnel.append((
-                        new_event_id,
-                        paths[new_event_id][property_id][event_id]))
-                except KeyError:
-                    _funnel.append((new_event_id, 0))
-                try:
-                    unique_funnel.append((
-                        new_event_id,
-                        unique_paths[new_event_id][property_id][event_id]))
-                except KeyError:
-                    unique_funnel.append((new_event_id, 0))
-            funnels[property_id] = _funnel
-            unique_funnels[property_id] = unique_funnel
-        returnValue({
-            "description": description,
-            "event_ids": [uri_b64encode(x) for x in event_ids],
-            "totals": b64encode_nested_keys(totals),
-            "unique_totals": b64encode_nested_keys(unique_totals),
-            "paths": b64encode_double_nested_keys(paths),
-            "unique_paths": b64encode_double_nested_keys(unique_paths),
-            "funnel": [(uri_b64encode(x[0]), x[1]) for x in base_funnel],
-            "unique_funnel": [(uri_b64encode(x[0]), x[1]) \
-                for x in base_unique_funnel],
-            "funnels": encode_nested_lists(funnels),
-            "unique_funnels": encode_nested_lists(unique_funnels)})
+        returnValue(Stream([
+            ("description", description),
+            ("event_ids", [Id(x) for x in event_ids]),
+            ("totals", id_nested_keys(totals)),
+            ("unique_totals", id_nested_keys(unique_totals)),
+            ("unique_visitors", id_nested_keys(visitors)),
+            ("paths", id_double_nested_keys(paths)),
+            ("unique_paths", id_double_nested_keys(unique_paths)),
+            ("funnel", IdPairs(base_funnel)),
+            ("unique_funnel", IdPairs(base_unique_funnel)),
+            ("funnels", property_funnels(
+                event_ids,
+                property_ids,
+                totals,
+                paths)),
+            ("unique_funnels", property_funnels(
+                event_ids,
+                property_ids,
+                unique_totals,
+                unique_paths))]))
 
     @authenticate
     @user_authorize
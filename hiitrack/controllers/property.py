@@ -5,12 +5,81 @@
 Properties are key/value pairs linked to a visitor and stored in buckets.
 """
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    DeferredSemaphore, gatherResults
+from twisted.python import log
 from ..models import bucket_check, user_authorize
-from ..models import PropertyValueModel, VisitorModel, EventModel
+from ..models import PropertyValueModel, VisitorModel, EventModel, \
+    BucketModel
 from ..lib.authentication import authenticate
-from ..lib.b64encode import b64encode_keys
-from ..lib.parameters import require
+from ..lib.cassandra import CounterBatch
+from ..lib.serializer import Stream, id_keys
+from ..lib.parameters import require, time_range
+from ..models.event import plan_periods
+from ..exceptions import MissingParameterException
+
+# Optional number of counter columns above which Property.post answers with
+# 202 Accepted once the visitor property is stored, and writes the backfill
+# in the background.
+BACKGROUND_BACKFILL = None
+# Backfills being written in the background.
+BACKFILLS = set()
+# Background backfills are sent one at a time, so however many are pending
+# they make at most WRITE_CONCURRENCY concurrent batch_mutate calls.
+BACKFILL_SEMAPHORE = DeferredSemaphore(1)
+# Request arguments that are not property names in Property.post_multiple.
+RESERVED_ARGS = frozenset(["visitor_id", "callback", "_"])
+
+
+def record_property(property_value, visitor, state, batch):
+    """
+    Add property_value to a visitor. The visitor's past events are
+    backfilled by adding their counts to batch, and state is updated.
+    Returns a Deferred for the visitor property write, or None if the
+    visitor already has the property.
+    """
+    if property_value.id in state.property_ids:
+        return None
+    user_name = property_value.user_name
+    bucket_name = property_value.bucket_name
+    for event_id, value in state.event_totals.iteritems():
+        event = EventModel(user_name, bucket_name, event_id=event_id)
+        event.increment_total(
+            True,
+            property_id=property_value.id,
+            value=value,
+            batch=batch)
+    for new_event_id in state.path:
+        event = EventModel(user_name, bucket_name, event_id=new_event_id)
+        for event_id, value in state.path[new_event_id].iteritems():
+            event.increment_path(event_id,
+                True,  # Unique
+                property_id=property_value.id,
+                value=value,
+                batch=batch)
+    state.add_property(property_value.id)
+    visitor.update_state(state)
+    return property_value.add_to_visitor(visitor)
+
+
+def send_in_background(batch, visitor):
+    """
+    Send a batch without waiting for it, after the background batches
+    already pending. Errors are logged and the visitor's cached state, which
+    already includes the backfill, is dropped.
+    """
+    deferred = BACKFILL_SEMAPHORE.run(batch.send)
+    BACKFILLS.add(deferred)
+    deferred.addErrback(_background_failure, visitor)
+    deferred.addBoth(lambda _: BACKFILLS.discard(deferred))
+
+
+def _background_failure(failure, visitor):
+    """
+    Log a failed background backfill.
+    """
+    log.err(failure)
+    visitor.invalidate_state()
 
 
 class Property(object):
@@ -19,6 +88,18 @@ class Property(object):
     """
 
     def __init__(self, dispatcher):
+        dispatcher.connect(
+            name='property_multiple',
+            route='/{user_name}/{bucket_name}/property',
+            controller=self,
+            action='post_multiple',
+            conditions={"method": "POST"})
+        dispatcher.connect(
+            name='property_multiple',
+            route='/{user_name}/{bucket_name}/property/jsonp',
+            controller=self,
+            action='post_multiple',
+            conditions={"method": "GET"})
         dispatcher.connect(
             name='property',
             route=('/{user_name}/{bucket_name}/property/'
@@ -52,7 +133,8 @@ class Property(object):
             property_name,
             property_value):
         """
-        Information about the property.
+        Information about the property. With 'start' and 'end' timestamps,
+        totals are summed over the hours in that range.
         """
         property_value = PropertyValueModel(
             user_name,
@@ -60,11 +142,15 @@ class Property(object):
             property_name,
             property_value)
         name, value = property_value.get_name_and_value()
-        total = yield property_value.get_total()
-        returnValue({
-            "name": name,
-            "value": value,
-            "total": b64encode_keys(total)})
+        start, end = time_range(request)
+        if start is None:
+            total = yield property_value.get_total()
+        else:
+            total = yield property_value.get_total(plan_periods(start, end))
+        returnValue(Stream([
+            ("name", name),
+            ("value", value),
+            ("total", id_keys(total))]))
 
     @bucket_check
     @require("visitor_id")
@@ -89,22 +175,71 @@ class Property(object):
             bucket_name,
             visitor_id)
         yield property_value.create()
-        property_ids = yield visitor.get_property_ids()
-        if property_value.id in property_ids:
+        settings = yield BucketModel(user_name, bucket_name).get_settings()
+        state = yield visitor.get_state(bool(settings.get("visitor_filter")))
+        batch = CounterBatch()
+        deferred = record_property(property_value, visitor, state, batch)
+        if deferred is None:
             return
-        yield property_value.add_to_visitor(visitor)
-        event_total = yield visitor.get_total()
-        event_path = yield visitor.get_path()
-        for event_id in event_total:
-            event = EventModel(user_name, bucket_name, event_id=event_id)
-            yield event.increment_total(
-                True,
-                property_id=property_value.id,
-                value=event_total[event_id])
-        for new_event_id in event_path:
-            event = EventModel(user_name, bucket_name, event_id=new_event_id)
-            for event_id in event_path[new_event_id]:
-                yield event.increment_path(event_id,
-                    True,  # Unique
-                    property_id=property_value.id,
-                    value=event_path[event.id][event_id])
+        background = BACKGROUND_BACKFILL and len(batch) > BACKGROUND_BACKFILL
+        deferreds = [deferred]
+        if not background:
+            deferreds.append(batch.send())
+        try:
+            yield gatherResults(deferreds, consumeErrors=True)
+        except Exception:
+            # The cached state already includes the failed writes.
+            visitor.invalidate_state()
+            raise
+        if background:
+            send_in_background(batch, visitor)
+            request.setResponseCode(202)
+
+    @bucket_check
+    @require("visitor_id")
+    @inlineCallbacks
+    def post_multiple(self, request, user_name, bucket_name):
+        """
+        Record several properties for a visitor. Every argument other than
+        'visitor_id' is a property name and its values. The visitor is read
+        once and the backfills of all new properties are written in one
+        batch.
+        """
+        property_values = []
+        for property_name in sorted(request.args):
+            if property_name in RESERVED_ARGS:
+                continue
+            for value in request.args[property_name]:
+                property_values.append(PropertyValueModel(
+                    user_name,
+                    bucket_name,
+                    property_name,
+                    value))
+        if not property_values:
+            request.setResponseCode(403)
+            raise MissingParameterException(
+                "At least one property is required.")
+        visitor = VisitorModel(
+            user_name,
+            bucket_name,
+            request.args["visitor_id"][0])
+        settings = yield BucketModel(user_name, bucket_name).get_settings()
+        state = yield visitor.get_state(bool(settings.get("visitor_filter")))
+        batch = CounterBatch()
+        deferreds = [x.create() for x in property_values]
+        for property_value in property_values:
+            deferred = record_property(property_value, visitor, state, batch)
+            if deferred is not None:
+                deferreds.append(deferred)
+        background = BACKGROUND_BACKFILL and len(batch) > BACKGROUND_BACKFILL
+        if not background:
+            deferreds.append(batch.send())
+        try:
+            yield gatherResults(deferreds, consumeErrors=True)
+        except Exception:
+            # The cached state already includes the failed writes.
+            visitor.invalidate_state()
+            raise
+        if background:
+            send_in_background(batch, visitor)
+            request.setResponseCode(202)
@@ -6,11 +6,11 @@ Users have usernames, passwords, and buckets.
 """
 
 from twisted.internet.defer import inlineCallbacks, returnValue
-from ..lib.authentication import authenticate
+from ..lib.authentication import authenticate, issue_token
 from ..lib.parameters import require
-from ..exceptions import UserException
+from ..exceptions import UserException, HTTPAuthenticationRequired
 from ..models import UserModel, user_authorize
-from ..lib.b64encode import uri_b64encode
+from ..lib.serializer import Id
 
 
 class User(object):
@@ -36,6 +36,12 @@ class User(object):
             controller=self,
             action='delete',
             conditions={"method": "DELETE"})
+        dispatcher.connect(
+            name='user_token',
+            route='/{user_name}/token',
+            controller=self,
+            action='token',
+            conditions={"method": "POST"})
 
     @require("password")
     @inlineCallbacks
@@ -62,7 +68,7 @@ class User(object):
         user = UserModel(user_name)
         buckets = yield user.get_buckets()
         for name in buckets:
-            buckets[name]["id"] = uri_b64encode(buckets[name]["id"])
+            buckets[name]["id"] = Id(buckets[name]["id"])
         returnValue({"buckets": buckets})
 
     @authenticate
@@ -74,3 +80,16 @@ class User(object):
         """
         user = UserModel(user_name)
         yield user.delete()
+
+    @authenticate
+    @user_authorize
+    def token(self, request, user_name):
+        """
+        Issue a signed, expiring token. Requires basic authentication so
+        tokens cannot be renewed indefinitely.
+        """
+        if request.auth_type != "Basic":
+            request.setResponseCode(401)
+            raise HTTPAuthenticationRequired("Basic authentication required.")
+        token, expires = issue_token(user_name)
+        return {"token": token, "expires": expires}
@@ -7,14 +7,23 @@ from twisted.application.service import Service
 from telephus.pool import CassandraClusterPool
 from twisted.python import log
 from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, DeferredList
 from twisted.web.server import Site
+import socket
+from .lib import dispatcher as dispatcher_module
 from .lib.dispatcher import Dispatcher
 from .controllers.user import User
 from .controllers.bucket import Bucket
+from .controllers import event
 from .controllers.event import Event
+from .controllers import property as property_controller
 from .controllers.property import Property
 from .controllers.funnel import Funnel
 from .lib import cassandra
+from .lib import authentication
+from .lib.spool import Spool
+from .models import visitor
+from .models import registry
 
 
 class HiiTrack(Service):
@@ -24,13 +33,84 @@ class HiiTrack(Service):
 
     listener = None
 
-    def __init__(self, port=8080, cassandra_settings=None):
+    def __init__(
+            self,
+            port=8080,
+            cassandra_settings=None,
+            auth_settings=None,
+            cache_settings=None,
+            spool_settings=None,
+            compression_settings=None):
         if not cassandra_settings:
             cassandra_settings = {}
+        if not auth_settings:
+            auth_settings = {}
+        if not cache_settings:
+            cache_settings = {}
+        if not compression_settings:
+            compression_settings = {}
+        if spool_settings and spool_settings.get("path"):
+            event.SPOOL = Spool(
+                spool_settings["path"],
+                event.ingest_spooled,
+                sync_interval=spool_settings.get("sync_interval", 0.05),
+                drain_interval=spool_settings.get("drain_interval", 0.5),
+                chunk_size=spool_settings.get("chunk_size", 1000))
+        else:
+            event.SPOOL = None
+        visitor.configure_cache(
+            cache_settings.get("visitor_size"),
+            ttl=cache_settings.get("visitor_ttl"))
+        if cache_settings.get("visitor_filters"):
+            visitor.configure_filters(
+                path=cache_settings.get("visitor_filter_path"),
+                capacity=cache_settings.get("visitor_filter_capacity", 10000),
+                error_rate=cache_settings.get(
+                    "visitor_filter_error_rate",
+                    0.001))
+        else:
+            visitor.VISITOR_FILTERS = None
+        if cache_settings.get("registry_size"):
+            registry.configure_registry(
+                cache_settings["registry_size"],
+                ttl=cache_settings.get("registry_ttl", 600))
+        if auth_settings.get("token_secret"):
+            authentication.TOKEN_SECRET = auth_settings["token_secret"]
+        if auth_settings.get("token_ttl"):
+            authentication.TOKEN_TTL = auth_settings["token_ttl"]
         cassandra.CLIENT = CassandraClusterPool(
             cassandra_settings.get("servers", ["127.0.0.1"]),
             keyspace=cassandra_settings.get("keyspace", "HiiTrack"),
             pool_size=cassandra_settings.get("pool_size", None))
+        if cassandra_settings.get("buffer_interval"):
+            cassandra.BUFFER = cassandra.CounterBuffer(
+                interval=cassandra_settings["buffer_interval"],
+                size=cassandra_settings.get("buffer_size", 10000))
+        else:
+            cassandra.BUFFER = None
+        if cassandra_settings.get("sketch_interval"):
+            cassandra.SKETCHES = cassandra.SketchBuffer(
+                interval=cassandra_settings["sketch_interval"],
+                node_id=cassandra_settings.get(
+                    "sketch_node_id",
+                    "%s:%s" % (socket.gethostname(), port)))
+        else:
+            cassandra.SKETCHES = None
+        cassandra.SHARDS = cassandra_settings.get("shards", 1)
+        if cassandra_settings.get("write_concurrency"):
+            cassandra.WRITE_CONCURRENCY = \
+                cassandra_settings["write_concurrency"]
+        property_controller.BACKGROUND_BACKFILL = \
+            cassandra_settings.get("background_backfill")
+        dispatcher_module.COMPRESSION_MIN_SIZE = compression_settings.get(
+            "min_size",
+            1024)
+        dispatcher_module.COMPRESSION_LEVEL = compression_settings.get(
+            "level",
+            6)
+        dispatcher_module.COMPRESSION_THREAD_SIZE = compression_settings.get(
+            "thread_size",
+            256 * 1024)
         dispatcher = Dispatcher()
         dispatcher.connect(
             name='index',
@@ -51,14 +131,33 @@ class HiiTrack(Service):
         """
         Service.startService(self)
         cassandra.CLIENT.startService()
+        if cassandra.BUFFER:
+            cassandra.BUFFER.start()
+        if cassandra.SKETCHES:
+            cassandra.SKETCHES.start()
+        if event.SPOOL:
+            event.SPOOL.start()
         self.listener = reactor.listenTCP(self.port, Site(self.dispatcher))
 
+    @inlineCallbacks
     def stopService(self):
         """
-        Shutdown HiiTrack.
+        Shutdown HiiTrack. Spooled events are synced, background backfills
+        finished, visitor filters checkpointed, and buffered sketches and
+        counter increments written before the Cassandra pool is stopped.
         """
         Service.stopService(self)
-        cassandra.CLIENT.stopService()
         if self.listener:
-            self.listener.stopListening()
+            yield self.listener.stopListening()
+        if event.SPOOL:
+            yield event.SPOOL.stop()
+        if property_controller.BACKFILLS:
+            yield DeferredList(list(property_controller.BACKFILLS))
+        if visitor.VISITOR_FILTERS:
+            visitor.VISITOR_FILTERS.stop()
+        if cassandra.SKETCHES:
+            yield cassandra.SKETCHES.stop()
+        if cassandra.BUFFER:
+            yield cassandra.BUFFER.stop()
+        cassandra.CLIENT.stopService()
         log.msg("Shut down.")
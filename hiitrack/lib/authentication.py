@@ -2,14 +2,62 @@
 # -*- coding: utf-8 -*-
 
 """
-Request authentication decorator.
+Request authentication decorator and signed tokens.
 """
 
 import base64
+import hmac
+import os
+import time
+from hashlib import sha1
 from telephus.cassandra.c08.ttypes import NotFoundException
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..exceptions import HTTPAuthenticationRequired
 from ..models import UserModel
+from .b64encode import uri_b64encode, uri_b64decode
+
+# Key used to sign tokens. HiiTrack sets it from its settings; the random
+# default only accepts tokens issued by this process.
+TOKEN_SECRET = os.urandom(32)
+# Seconds until an issued token expires.
+TOKEN_TTL = 3600
+
+
+def _sign(payload):
+    """
+    HMAC-SHA1 signature of payload.
+    """
+    return hmac.new(TOKEN_SECRET, payload, sha1).digest()
+
+
+def issue_token(user_name, ttl=None):
+    """
+    Return a signed token for user_name and its expiry timestamp.
+    """
+    expires = int(time.time() + (ttl or TOKEN_TTL))
+    payload = "%d:%s" % (expires, user_name)
+    token = "%s.%s" % (uri_b64encode(payload), uri_b64encode(_sign(payload)))
+    return token, expires
+
+
+def verify_token(token):
+    """
+    Return the user name of a valid, unexpired token. Raises AssertionError
+    otherwise.
+    """
+    try:
+        encoded_payload, encoded_signature = token.split(".")
+        payload = uri_b64decode(encoded_payload)
+        signature = uri_b64decode(encoded_signature)
+        expires, user_name = payload.split(":", 1)
+        expires = int(expires)
+    except (TypeError, ValueError):
+        raise AssertionError("Malformed token.")
+    if not hmac.compare_digest(signature, _sign(payload)):
+        raise AssertionError("Invalid token signature.")
+    if expires <= time.time():
+        raise AssertionError("Token expired.")
+    return user_name
 
 
 def authenticate(method):
@@ -19,24 +67,32 @@ def authenticate(method):
     @inlineCallbacks
     def wrapper(*args, **kwargs):
         """
-        Checks basic authentication.
+        Checks basic or signed token authentication.
         """
         request = args[1]
         try:
             auth_header = request.getHeader("Authorization")
-            assert auth_header
+            if not auth_header:
+                raise AssertionError("Missing Authorization header.")
             auth_type, auth_data = auth_header.split()
-            assert auth_type == "Basic"
-            user_name, password = base64.b64decode(auth_data).split(":", 1)
-            user = UserModel(user_name)
-            password_is_valid = yield user.validate_password(password)
-            assert password_is_valid
-        except (AssertionError, NotFoundException):
+            if auth_type == "Token":
+                user_name = verify_token(auth_data)
+            else:
+                if auth_type != "Basic":
+                    raise AssertionError("Unsupported authorization type.")
+                user_name, password = base64.b64decode(auth_data).split(
+                    ":", 1)
+                user = UserModel(user_name)
+                password_is_valid = yield user.validate_password(password)
+                if not password_is_valid:
+                    raise AssertionError("Invalid password.")
+        except (AssertionError, NotFoundException, TypeError, ValueError):
             request.setResponseCode(401)
             request.setHeader('WWW-Authenticate', 'Basic')
             raise HTTPAuthenticationRequired("Authentication required.")
         else:
             request.username = user_name
+            request.auth_type = auth_type
             data = yield method(*args, **kwargs)
             returnValue(data)
     return wrapper
@@ -21,40 +21,3 @@ def uri_b64decode(value):
     """
     return urlsafe_b64decode(value + '=' * (4 - len(value) % 4))
 
-
-def b64encode_keys(dictionary):
-    """
-    Make a dictionary's keys url safe.
-    """
-    return dict([(uri_b64encode(x[0]), x[1]) for x in dictionary.items()])
-
-
-def b64encode_nested_keys(dictionary):
-    """
-    Nested version of b64encode_keys.
-    """
-    return dict([(uri_b64encode(x[0]), b64encode_keys(x[1]))
-        for x in dictionary.items()])
-
-
-def b64encode_double_nested_keys(dictionary):
-    """
-    Double-nested version of b64encode_keys.
-    """
-    return dict([(uri_b64encode(x[0]), b64encode_nested_keys(x[1]))
-        for x in dictionary.items()])
-
-
-def b64encode_values(dictionary):
-    """
-    Make a dictionary's values url safe.
-    """
-    return dict([(x[0], uri_b64encode(x[1])) for x in dictionary.items()])
-
-
-def b64encode_nested_values(dictionary):
-    """
-    Nested version of b64encode_values.
-    """
-    return dict([(x[0], b64encode_values(x[1]))
-        for x in dictionary.items()])
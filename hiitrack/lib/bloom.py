@@ -0,0 +1,127 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bloom filters of 16 byte ids.
+"""
+
+import math
+import struct
+import zlib
+
+
+class BloomFilter(object):
+    """
+    Bloom filter sized for capacity ids at error_rate false positives.
+    Ids are 16 byte hashes, so their two halves are used for double hashing
+    instead of hashing them again.
+    """
+
+    def __init__(self, capacity, error_rate, bits=None):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.hashes = int(math.ceil(math.log(1.0 / error_rate, 2)))
+        size = int(math.ceil(
+            capacity * abs(math.log(error_rate)) / math.log(2) ** 2))
+        self.size = size + (-size % 8)
+        if bits is None:
+            bits = bytearray(self.size / 8)
+        self.bits = bits
+        self.count = 0
+
+    def _indexes(self, key):
+        """
+        Yield the bit indexes of key.
+        """
+        first, second = struct.unpack(">QQ", key[0:16])
+        for i in xrange(self.hashes):
+            yield (first + i * second) % self.size
+
+    def add(self, key):
+        """
+        Add key to the filter.
+        """
+        bits = self.bits
+        for index in self._indexes(key):
+            bits[index >> 3] |= 1 << (index & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        bits = self.bits
+        for index in self._indexes(key):
+            if not bits[index >> 3] & (1 << (index & 7)):
+                return False
+        return True
+
+
+class ScalableBloomFilter(object):
+    """
+    Bloom filter that grows by adding filters of twice the capacity and
+    tighter error rates as it fills up, so the overall false positive rate
+    stays below error_rate however many ids are added.
+    """
+
+    def __init__(self, capacity=10000, error_rate=0.001):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = []
+
+    def __len__(self):
+        return sum([x.count for x in self.filters])
+
+    def __contains__(self, key):
+        for bloom_filter in self.filters:
+            if key in bloom_filter:
+                return True
+        return False
+
+    def add(self, key):
+        """
+        Add key to the filter, unless it may already be present.
+        """
+        if key in self:
+            return
+        if not self.filters or \
+                self.filters[-1].count >= self.filters[-1].capacity:
+            self.filters.append(BloomFilter(
+                self.capacity * 2 ** len(self.filters),
+                self.error_rate * 0.5 ** (len(self.filters) + 1)))
+        self.filters[-1].add(key)
+
+    def dumps(self):
+        """
+        Serialize the filter.
+        """
+        header = [struct.pack(">Id", self.capacity, self.error_rate)]
+        for bloom_filter in self.filters:
+            header.append(struct.pack(
+                ">IdI",
+                bloom_filter.capacity,
+                bloom_filter.error_rate,
+                bloom_filter.count))
+        data = "".join([str(x.bits) for x in self.filters])
+        return zlib.compress(
+            struct.pack(">I", len(self.filters)) + "".join(header) + data)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Deserialize a filter serialized with dumps().
+        """
+        data = zlib.decompress(data)
+        length, = struct.unpack(">I", data[0:4])
+        capacity, error_rate = struct.unpack(">Id", data[4:16])
+        scalable = cls(capacity, error_rate)
+        offset = 16
+        params = []
+        for _ in range(length):
+            params.append(struct.unpack(">IdI", data[offset:offset + 16]))
+            offset += 16
+        for capacity, error_rate, count in params:
+            bloom_filter = BloomFilter(capacity, error_rate)
+            end = offset + bloom_filter.size / 8
+            bloom_filter.bits = bytearray(data[offset:end])
+            bloom_filter.count = count
+            offset = end
+            scalable.filters.append(bloom_filter)
+        return scalable
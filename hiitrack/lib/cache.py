@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Process-local caches.
+"""
+
+import time
+try:
+    from collections import OrderedDict
+except ImportError:
+    from ordereddict import OrderedDict
+
+
+class LRUCache(object):
+    """
+    Least recently used cache holding at most `size` entries. Entries expire
+    `ttl` seconds after they are set, if a ttl is given. If `weigh` is given
+    it is called with each value and `size` bounds the total weight instead
+    of the number of entries. `clock` returns the current time.
+    """
+
+    def __init__(self, size=1000, ttl=None, weigh=None, clock=time.time):
+        self.size = size
+        self.ttl = ttl
+        self.weigh = weigh
+        self.clock = clock
+        self.data = OrderedDict()
+        self.weights = {}
+        self.weight = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return self.get(key) is not None
+
+    def get(self, key, default=None):
+        """
+        Return the value for key, or default if it is missing or expired.
+        """
+        try:
+            expires, value = self.data.pop(key)
+        except KeyError:
+            self.misses += 1
+            return default
+        if expires is not None and expires < self.clock():
+            self._discard(key)
+            self.misses += 1
+            return default
+        self.data[key] = (expires, value)
+        self.hits += 1
+        return value
+
+    def set(self, key, value, ttl=None):
+        """
+        Set the value for key. ttl overrides the cache's default expiry.
+        """
+        ttl = ttl or self.ttl
+        if ttl:
+            expires = self.clock() + ttl
+        else:
+            expires = None
+        self.delete(key)
+        self.data[key] = (expires, value)
+        if self.weigh:
+            self.weights[key] = self.weigh(value)
+        else:
+            self.weights[key] = 1
+        self.weight += self.weights[key]
+        while self.weight > self.size and self.data:
+            self._discard(self.data.iterkeys().next())
+            self.evictions += 1
+
+    def delete(self, key):
+        """
+        Remove key from the cache.
+        """
+        self._discard(key)
+
+    def delete_matching(self, predicate):
+        """
+        Remove every key for which predicate(key) is true.
+        """
+        for key in [x for x in self.data if predicate(x)]:
+            self.delete(key)
+
+    def _discard(self, key):
+        """
+        Remove key and its weight.
+        """
+        self.data.pop(key, None)
+        self.weight -= self.weights.pop(key, 0)
+
+    def clear(self):
+        """
+        Remove all entries.
+        """
+        self.data.clear()
+        self.weights.clear()
+        self.weight = 0
+
+    def stats(self):
+        """
+        Return entry count, weight, hit, miss, and eviction counts.
+        """
+        return {
+            "entries": len(self.data),
+            "weight": self.weight,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions}
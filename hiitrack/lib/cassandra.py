@@ -6,24 +6,77 @@ Cassandra methods for dealing with hashed keys.
 """
 
 from ..lib.hash import pack_hash
-from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    DeferredList, DeferredSemaphore, succeed
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+from telephus.cassandra.c08.ttypes import Mutation, ColumnOrSuperColumn, \
+    CounterColumn
 
+import socket
 import struct
 import time
+import zlib
+from collections import defaultdict
+from .hyperloglog import HyperLogLog
 try:
     from collections import OrderedDict
 except ImportError:
     from ordereddict import OrderedDict
 
 CLIENT = None
+# Optional CounterBuffer. When set, increments of aggregate counter rows are
+# coalesced in memory and written periodically instead of immediately.
+BUFFER = None
+# Counter row types that may be delayed by BUFFER. Visitor rows are read back
+# while recording events and are always written immediately.
+BUFFERED_ROWS = frozenset([
+    "event",
+    "unique_event",
+    "path",
+    "unique_path",
+    "property",
+    "stats",
+    "sketch_day",
+    "period"])
 HIGH_ID = chr(255) * 16
+# Maximum number of counter columns sent in a single batch_mutate call.
+BATCH_SIZE = 500
+# Number of columns fetched per get_slice call when paging through a row.
+PAGE_SIZE = 1000
+# Maximum number of concurrent batch_mutate calls made by a CounterBatch.
+WRITE_CONCURRENCY = 8
+# Number of shards of SHARDED_ROWS counter rows. Increments are spread over
+# the shards by a hash of the column and reads sum all shards. Shard 0 is
+# the unsharded row, so existing counts stay readable when sharding is
+# enabled. Lowering SHARDS hides the counts of the removed shards.
+SHARDS = 1
+SHARDED_ROWS = frozenset([
+    "event",
+    "unique_event",
+    "path",
+    "unique_path",
+    "property"])
+# Optional SketchBuffer. When set, HyperLogLog sketches of visitors are
+# merged in memory and written periodically.
+SKETCHES = None
 
 
-def pack_timestamp():
+def pack_timestamp(timestamp=None):
     """
-    Return a packed byte string representing a timestamp.
+    Return a packed byte string representing a timestamp, by default the
+    current time.
     """
-    return struct.pack(">1d", time.time())
+    if timestamp is None:
+        timestamp = time.time()
+    return struct.pack(">1d", timestamp)
+
+
+def unpack_timestamp(value):
+    """
+    Return the timestamp represented by a packed byte string.
+    """
+    return struct.unpack(">1d", value)[0]
 
 
 def cols_to_dict(columns, prefix=None):
@@ -54,6 +107,336 @@ def counter_cols_to_dict(columns, prefix=None):
             for x in columns])
 
 
+def column_name(column):
+    """
+    Name of a ColumnOrSuperColumn holding a column or counter column.
+    """
+    if column.counter_column:
+        return column.counter_column.name
+    return column.column.name
+
+
+def is_sharded(key):
+    """
+    Whether a counter row is spread over SHARDS rows.
+    """
+    return SHARDS > 1 and len(key) > 2 and key[2] in SHARDED_ROWS
+
+
+def shard_key(key, column_id):
+    """
+    Return the key of the shard of a counter row holding column_id.
+    """
+    if not is_sharded(key):
+        return key
+    shard = zlib.crc32(column_id) % SHARDS
+    if shard:
+        return key + ("shard", str(shard))
+    return key
+
+
+def shard_keys(key):
+    """
+    Return the keys of all shards of a counter row.
+    """
+    if not is_sharded(key):
+        return [key]
+    return [key] + [key + ("shard", str(x)) for x in range(1, SHARDS)]
+
+
+def sum_shards(rows):
+    """
+    Sum the columns of several shards into an OrderedDict sorted by column.
+    """
+    result = defaultdict(int)
+    for row in rows:
+        for column_id, value in row.iteritems():
+            result[column_id] += value
+    return OrderedDict(sorted(result.items()))
+
+
+class SlicePager(object):
+    """
+    Pages through a slice of a row, page_size columns at a time, using the
+    last column of each page as the start of the next. If last is given,
+    paging resumes after that column. Use next_page() until the pager is
+    exhausted:
+
+        pager = SlicePager(key, "counter", prefix=prefix)
+        while not pager.exhausted:
+            page = yield pager.next_page()
+    """
+
+    def __init__(
+            self,
+            key,
+            column_family,
+            prefix=None,
+            page_size=None,
+            consistency=None,
+            last=None):
+        self.key = pack_hash(key)
+        self.column_family = column_family
+        self.prefix = prefix
+        self.page_size = page_size or PAGE_SIZE
+        self.consistency = consistency
+        if prefix:
+            self.start = prefix
+            self.finish = prefix + HIGH_ID
+        else:
+            self.start = ''
+            self.finish = ''
+        self.last = last
+        self.exhausted = False
+
+    @inlineCallbacks
+    def next_page(self):
+        """
+        Return the next page as an OrderedDict of column names, with the
+        prefix removed, to values. Empty once the slice is exhausted.
+        """
+        if self.exhausted:
+            returnValue(OrderedDict())
+        if self.last is None:
+            start = self.start
+            count = self.page_size
+        else:
+            # Slices include their start column, so fetch one extra.
+            start = self.last
+            count = self.page_size + 1
+        result = yield CLIENT.get_slice(
+            key=self.key,
+            column_family=self.column_family,
+            consistency=self.consistency,
+            start=start,
+            finish=self.finish,
+            count=count)
+        if len(result) < count:
+            self.exhausted = True
+        if result and column_name(result[0]) == self.last:
+            result = result[1:]
+        if result:
+            self.last = column_name(result[-1])
+        if self.column_family == "counter":
+            returnValue(counter_cols_to_dict(result, prefix=self.prefix))
+        returnValue(cols_to_dict(result, prefix=self.prefix))
+
+
+class ShardedPager(object):
+    """
+    Pages through a slice of every shard of a counter row, summing the
+    columns of each page. Shards are read in step and a column is returned
+    only once every shard has been read past it, so each column appears in
+    a single page. Has the interface of SlicePager.
+    """
+
+    def __init__(self, key, prefix=None, page_size=None, consistency=None):
+        self.pagers = [SlicePager(
+            x,
+            "counter",
+            prefix=prefix,
+            page_size=page_size,
+            consistency=consistency) for x in shard_keys(key)]
+        self.prefix = prefix
+        self.pending = defaultdict(int)
+        self.exhausted = False
+
+    @inlineCallbacks
+    def next_page(self):
+        """
+        Return the next page of the summed shards.
+        """
+        pagers = [x for x in self.pagers if not x.exhausted]
+        if pagers:
+            # Shards already read further than the others wait.
+            last = min([x.last for x in pagers])
+            pages = yield DeferredList(
+                [x.next_page() for x in pagers if x.last == last],
+                fireOnOneErrback=True,
+                consumeErrors=True)
+            for _, page in pages:
+                for column_id, value in page.iteritems():
+                    self.pending[column_id] += value
+        pagers = [x for x in self.pagers if not x.exhausted]
+        if pagers:
+            last = min([x.last for x in pagers])[len(self.prefix or ""):]
+            column_ids = [x for x in self.pending if x <= last]
+        else:
+            column_ids = self.pending.keys()
+            self.exhausted = True
+        returnValue(OrderedDict([(x, self.pending.pop(x)) \
+            for x in sorted(column_ids)]))
+
+
+@inlineCallbacks
+def get_slice(key, column_family, prefix=None, consistency=None):
+    """
+    Get all columns of a row, or those beginning with prefix, one page at a
+    time. Sharded counter rows are read from every shard concurrently.
+    """
+    if column_family == "counter" and is_sharded(key):
+        data = yield multiget_slice([key], column_family, prefix, consistency)
+        returnValue(data[key])
+    pager = SlicePager(
+        key,
+        column_family,
+        prefix=prefix,
+        consistency=consistency)
+    data = OrderedDict()
+    while not pager.exhausted:
+        page = yield pager.next_page()
+        data.update(page)
+    returnValue(data)
+
+
+@inlineCallbacks
+def _multiget_slice(keys, column_family, prefix=None, consistency=None):
+    """
+    Get all columns, or those beginning with prefix, of several rows with a
+    single multiget_slice call. Rows wider than a page are finished with a
+    SlicePager. Returns a dictionary of key -> OrderedDict.
+    """
+    packed_keys = dict([(pack_hash(key), key) for key in keys])
+    if prefix:
+        start = prefix
+        finish = prefix + HIGH_ID
+    else:
+        start = ''
+        finish = ''
+    result = yield CLIENT.multiget_slice(
+        keys=packed_keys.keys(),
+        column_family=column_family,
+        consistency=consistency,
+        start=start,
+        finish=finish,
+        count=PAGE_SIZE)
+    data = {}
+    pagers = []
+    for packed_key, columns in result.iteritems():
+        key = packed_keys[packed_key]
+        if column_family == "counter":
+            data[key] = counter_cols_to_dict(columns, prefix=prefix)
+        else:
+            data[key] = cols_to_dict(columns, prefix=prefix)
+        if len(columns) == PAGE_SIZE:
+            pagers.append((key, SlicePager(
+                key,
+                column_family,
+                prefix=prefix,
+                consistency=consistency,
+                last=column_name(columns[-1]))))
+    for key in keys:
+        data.setdefault(key, OrderedDict())
+    while pagers:
+        pages = yield DeferredList(
+            [pager.next_page() for key, pager in pagers],
+            fireOnOneErrback=True,
+            consumeErrors=True)
+        for (key, pager), (_, page) in zip(pagers, pages):
+            data[key].update(page)
+        pagers = [x for x in pagers if not x[1].exhausted]
+    returnValue(data)
+
+
+@inlineCallbacks
+def multiget_slice(keys, column_family, prefix=None, consistency=None):
+    """
+    Get all columns, or those beginning with prefix, of several rows with a
+    single multiget_slice call. Rows wider than a page are finished with a
+    SlicePager. Sharded counter rows are read from every shard and summed.
+    Returns a dictionary of key -> OrderedDict.
+    """
+    if column_family != "counter" or not any([is_sharded(x) for x in keys]):
+        data = yield _multiget_slice(keys, column_family, prefix, consistency)
+        returnValue(data)
+    shards = dict([(key, shard_keys(key)) for key in keys])
+    data = yield _multiget_slice(
+        [x for key in keys for x in shards[key]],
+        column_family,
+        prefix,
+        consistency)
+    returnValue(dict([(key, sum_shards([data[x] for x in shards[key]])) \
+        for key in keys]))
+
+
+@inlineCallbacks
+def multiget_slices(slices, column_family, consistency=None):
+    """
+    Get several (key, prefix) slices concurrently. Slices sharing a prefix
+    are read with one multiget_slice call. Returns a dictionary of
+    (key, prefix) -> OrderedDict.
+    """
+    keys_by_prefix = OrderedDict()
+    for key, prefix in slices:
+        keys_by_prefix.setdefault(prefix, []).append(key)
+    results = yield DeferredList(
+        [multiget_slice(keys, column_family, prefix, consistency)
+            for prefix, keys in keys_by_prefix.items()],
+        fireOnOneErrback=True,
+        consumeErrors=True)
+    data = {}
+    for prefix, (_, result) in zip(keys_by_prefix, results):
+        for key in result:
+            data[(key, prefix)] = result[key]
+    returnValue(data)
+
+
+@inlineCallbacks
+def _multiget_columns(keys, column_family, column_ids, consistency=None):
+    """
+    Get a list of columns from several rows. Column names are requested
+    PAGE_SIZE at a time, concurrently. Missing columns are omitted. Returns
+    a dictionary of key -> OrderedDict.
+    """
+    packed_keys = dict([(pack_hash(key), key) for key in keys])
+    column_ids = list(column_ids)
+    deferreds = []
+    for i in range(0, len(column_ids), PAGE_SIZE):
+        deferreds.append(CLIENT.multiget_slice(
+            keys=packed_keys.keys(),
+            column_family=column_family,
+            consistency=consistency,
+            names=column_ids[i:i + PAGE_SIZE]))
+    results = yield DeferredList(
+        deferreds,
+        fireOnOneErrback=True,
+        consumeErrors=True)
+    data = dict([(key, OrderedDict()) for key in keys])
+    for _, result in results:
+        for packed_key, columns in result.iteritems():
+            if column_family == "counter":
+                data[packed_keys[packed_key]].update(
+                    counter_cols_to_dict(columns))
+            else:
+                data[packed_keys[packed_key]].update(cols_to_dict(columns))
+    returnValue(data)
+
+
+@inlineCallbacks
+def multiget_columns(keys, column_family, column_ids, consistency=None):
+    """
+    Get a list of columns from several rows. Column names are requested
+    PAGE_SIZE at a time, concurrently. Missing columns are omitted.
+    Sharded counter rows are read from every shard and summed. Returns a
+    dictionary of key -> OrderedDict.
+    """
+    if column_family != "counter" or not any([is_sharded(x) for x in keys]):
+        data = yield _multiget_columns(
+            keys,
+            column_family,
+            column_ids,
+            consistency)
+        returnValue(data)
+    shards = dict([(key, shard_keys(key)) for key in keys])
+    data = yield _multiget_columns(
+        [x for key in keys for x in shards[key]],
+        column_family,
+        column_ids,
+        consistency)
+    returnValue(dict([(key, sum_shards([data[x] for x in shards[key]])) \
+        for key in keys]))
+
+
 @inlineCallbacks
 def set_user(key, column, value, consistency=None):
     yield CLIENT.insert(
@@ -107,19 +490,12 @@ def get_relation(
             column=pack_hash(column))
         returnValue(result.column.value)
     else:
-        if prefix:
-            start = prefix
-            finish = prefix + HIGH_ID
-        else:
-            start = ''
-            finish = ''
-        result = yield CLIENT.get_slice(
-            key=pack_hash(key),
-            column_family="relation",
-            start=start,
-            finish=finish,
+        data = yield get_slice(
+            key,
+            "relation",
+            prefix=prefix,
             consistency=consistency)
-        returnValue(cols_to_dict(result, prefix=prefix))
+        returnValue(data)
 
 
 @inlineCallbacks
@@ -180,20 +556,38 @@ def get_counter(key, consistency=None, prefix=None):
     """
     Get all columns from a row of counters.
     """
-    if prefix:
-        start = prefix
-        finish = prefix + HIGH_ID
-    else:
-        start = ''
-        finish = ''
-    result = yield CLIENT.get_slice(
-        key=pack_hash(key),
-        column_family="counter",
-        consistency=consistency,
-        start=start,
-        finish=finish,
-        count=10000)
-    returnValue(counter_cols_to_dict(result, prefix=prefix))
+    data = yield get_slice(
+        key,
+        "counter",
+        prefix=prefix,
+        consistency=consistency)
+    returnValue(data)
+
+
+def get_counter_pager(key, consistency=None, prefix=None, page_size=None):
+    """
+    Return a SlicePager over a row of counters, or a ShardedPager if the
+    row is sharded.
+    """
+    if is_sharded(key):
+        return ShardedPager(
+            key,
+            prefix=prefix,
+            page_size=page_size,
+            consistency=consistency)
+    return SlicePager(
+        key,
+        "counter",
+        prefix=prefix,
+        page_size=page_size,
+        consistency=consistency)
+
+
+def is_buffered(key):
+    """
+    Whether increments of a counter row may be delayed by BUFFER.
+    """
+    return len(key) > 2 and key[2] in BUFFERED_ROWS
 
 
 @inlineCallbacks
@@ -202,47 +596,332 @@ def increment_counter(
         column=None,
         consistency=None,
         column_id=None,
-        value=1):
+        value=1,
+        batch=None):
     """
     Increment a counter specified by a hashed column tuple or a column_id.
+    If a CounterBatch is supplied the increment is added to it instead of
+    being sent.
     """
+    if batch is not None:
+        batch.add(key, column=column, column_id=column_id, value=value)
+        return
+    if BUFFER is not None and is_buffered(key):
+        BUFFER.add(key, column=column, column_id=column_id, value=value)
+        return
     if column_id:
-        yield CLIENT.add(
-            key=pack_hash(key),
-            column_family="counter",
-            consistency=consistency,
-            column=column_id,
-            value=value)
+        pass
     elif column:
-        yield CLIENT.add(
-            key=pack_hash(key),
-            column_family="counter",
-            consistency=consistency,
-            column=pack_hash(column),
-            value=value)
+        column_id = pack_hash(column)
     else:
         raise TypeError("column composite key or column_id is required.")
+    yield CLIENT.add(
+        key=pack_hash(shard_key(key, column_id)),
+        column_family="counter",
+        consistency=consistency,
+        column=column_id,
+        value=value)
+
+
+class CounterBatch(object):
+    """
+    Collects counter increments, grouped by row key, and sends them with
+    as few batch_mutate calls as possible. Increments of the same column
+    are summed.
+    """
+
+    def __init__(self, consistency=None, size=None):
+        self.consistency = consistency
+        self.size = size or BATCH_SIZE
+        self.rows = defaultdict(lambda: defaultdict(int))
+        self.buffered = set()
+        self.count = 0
+
+    def __len__(self):
+        return self.count
+
+    def add(self, key, column=None, column_id=None, value=1):
+        """
+        Add an increment specified by a hashed column tuple or a column_id.
+        """
+        if column_id:
+            pass
+        elif column:
+            column_id = pack_hash(column)
+        else:
+            raise TypeError("column composite key or column_id is required.")
+        packed_key = pack_hash(shard_key(key, column_id))
+        if is_buffered(key):
+            self.buffered.add(packed_key)
+        self.add_packed(packed_key, column_id, value)
+
+    def add_packed(self, packed_key, column_id, value):
+        """
+        Add an increment to an already hashed row key.
+        """
+        row = self.rows[packed_key]
+        if column_id not in row:
+            self.count += 1
+        row[column_id] += value
+
+    def merge(self, batch):
+        """
+        Add all increments collected by another batch.
+        """
+        self.buffered.update(batch.buffered)
+        for packed_key in batch.rows:
+            for column_id, value in batch.rows[packed_key].iteritems():
+                self.add_packed(packed_key, column_id, value)
+
+    def send(self):
+        """
+        Send the collected increments and empty the batch. If a write-behind
+        buffer is configured, increments of buffered rows are handed to it
+        and only the rest are written.
+        """
+        if BUFFER is not None and self.buffered:
+            buffered = CounterBatch(consistency=self.consistency)
+            for packed_key in self.buffered:
+                buffered.buffered.add(packed_key)
+                for column_id, value in self.rows.pop(packed_key).iteritems():
+                    buffered.add_packed(packed_key, column_id, value)
+            self.buffered = set()
+            self.count = sum([len(x) for x in self.rows.values()])
+            BUFFER.merge(buffered)
+        return self.write()
+
+    def write(self):
+        """
+        Write the collected increments, at most self.size columns per
+        batch_mutate call and at most WRITE_CONCURRENCY calls at a time,
+        and empty the batch.
+        """
+        rows = self.rows
+        self.rows = defaultdict(lambda: defaultdict(int))
+        self.buffered = set()
+        self.count = 0
+        mutation_maps = []
+        mutation_map = defaultdict(lambda: {"counter": []})
+        count = 0
+        for key in rows:
+            for column_id, value in rows[key].iteritems():
+                if not value:
+                    continue
+                if count == self.size:
+                    mutation_maps.append(dict(mutation_map))
+                    mutation_map = defaultdict(lambda: {"counter": []})
+                    count = 0
+                mutation_map[key]["counter"].append(Mutation(
+                    column_or_supercolumn=ColumnOrSuperColumn(
+                        counter_column=CounterColumn(
+                            name=column_id,
+                            value=value))))
+                count += 1
+        if count:
+            mutation_maps.append(dict(mutation_map))
+        semaphore = DeferredSemaphore(WRITE_CONCURRENCY)
+        deferreds = [semaphore.run(
+            CLIENT.batch_mutate,
+            mutationmap=x,
+            consistency=self.consistency) for x in mutation_maps]
+        return DeferredList(
+            deferreds,
+            fireOnOneErrback=True,
+            consumeErrors=True)
+
+
+class CounterBuffer(object):
+    """
+    Write-behind buffer for the counter CF. Increments are summed in memory
+    per row and column and written every `interval` seconds, or as soon as
+    `size` distinct columns are pending.
+    """
+
+    def __init__(self, interval=1.0, size=10000, consistency=None):
+        self.interval = interval
+        self.size = size
+        self.batch = CounterBatch(consistency=consistency)
+        self.loop = LoopingCall(self.flush)
+
+    def start(self):
+        """
+        Start periodic flushing.
+        """
+        self.loop.start(self.interval, now=False)
+
+    def stop(self):
+        """
+        Stop periodic flushing and write anything still pending.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        return self.flush()
+
+    def add(self, key, column=None, column_id=None, value=1):
+        """
+        Buffer an increment specified by a hashed column tuple or a
+        column_id.
+        """
+        self.batch.add(key, column=column, column_id=column_id, value=value)
+        if len(self.batch) >= self.size:
+            self.flush()
+
+    def merge(self, batch):
+        """
+        Buffer all increments collected by a CounterBatch.
+        """
+        self.batch.merge(batch)
+        if len(self.batch) >= self.size:
+            self.flush()
+
+    def flush(self):
+        """
+        Write pending increments. Increments that fail to write are logged
+        and dropped, since counter writes cannot be safely retried.
+        """
+        if not len(self.batch):
+            return succeed(None)
+        batch = self.batch
+        self.batch = CounterBatch(consistency=batch.consistency)
+        deferred = batch.write()
+        deferred.addErrback(log.err)
+        return deferred
+
+
+class SketchBuffer(object):
+    """
+    Write-behind buffer of HyperLogLog sketches stored in the relation CF.
+    Ids are added to in-memory sketches per row and column, which are
+    merged into storage every `interval` seconds. Each process writes its
+    own column, the sketch column id followed by a hash of the process'
+    node_id, so no process overwrites another's sketch. Readers merge the
+    columns with merge_sketches(). The node_id must be unique to the process
+    and stable across restarts, or every start adds a new set of columns.
+    """
+
+    def __init__(self, interval=10.0, consistency=None, node_id=None):
+        self.interval = interval
+        self.consistency = consistency
+        self.node_id = pack_hash((node_id or socket.gethostname(),))
+        self.sketches = {}
+        self.flushing = None
+        self.loop = LoopingCall(self.flush)
+
+    def start(self):
+        """
+        Start periodic flushing.
+        """
+        self.loop.start(self.interval, now=False)
+
+    @inlineCallbacks
+    def stop(self):
+        """
+        Stop periodic flushing and write anything still pending.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        if self.flushing:
+            yield self.flushing
+        yield self.flush()
+
+    def add(self, key, column_id, value_id):
+        """
+        Add value_id to the sketch in column column_id of row key.
+        """
+        sketch = self.sketches.get((key, column_id))
+        if sketch is None:
+            sketch = self.sketches[(key, column_id)] = HyperLogLog()
+        sketch.add(value_id)
+
+    def flush(self):
+        """
+        Merge pending sketches into this process' stored sketches. Sketches
+        that fail to write are logged and dropped.
+        """
+        if self.flushing or not self.sketches:
+            return succeed(None)
+        sketches = self.sketches
+        self.sketches = {}
+        deferred = self._write(sketches)
+        deferred.addErrback(log.err)
+        if not deferred.called:
+            self.flushing = deferred
+            deferred.addBoth(self._flushed)
+        return deferred
+
+    def _flushed(self, result):
+        self.flushing = None
+        return result
+
+    @inlineCallbacks
+    def _write(self, sketches):
+        """
+        Read, merge and write back this process' columns of sketches.
+        """
+        rows = defaultdict(dict)
+        for (key, column_id), sketch in sketches.iteritems():
+            rows[key][column_id + self.node_id] = sketch
+        semaphore = DeferredSemaphore(WRITE_CONCURRENCY)
+        stored = yield DeferredList(
+            [semaphore.run(
+                multiget_columns,
+                [key],
+                "relation",
+                rows[key].keys(),
+                consistency=self.consistency) for key in rows],
+            fireOnOneErrback=True,
+            consumeErrors=True)
+        deferreds = []
+        for key, (_, data) in zip(rows, stored):
+            for column_id, sketch in rows[key].iteritems():
+                if column_id in data[key]:
+                    sketch.merge(HyperLogLog.loads(data[key][column_id]))
+                deferreds.append(semaphore.run(
+                    insert_relation_by_id,
+                    key,
+                    column_id,
+                    sketch.dumps(),
+                    consistency=self.consistency))
+        yield DeferredList(
+            deferreds,
+            fireOnOneErrback=True,
+            consumeErrors=True)
+
+
+def merge_sketches(columns):
+    """
+    Merge the per-process columns of stored sketches. Takes a dictionary of
+    column_id + node_id -> serialized sketch and returns a dictionary of
+    column_id -> HyperLogLog.
+    """
+    sketches = {}
+    for column_id, value in columns.iteritems():
+        sketch = HyperLogLog.loads(value)
+        column_id = column_id[0:-16]
+        if column_id in sketches:
+            sketches[column_id].merge(sketch)
+        else:
+            sketches[column_id] = sketch
+    return sketches
 
 
 @inlineCallbacks
 def delete_counter(key, column=None, column_id=None, consistency=None):
     """
-    Delete a row or column from the counter CF.
+    Delete a row or column from the counter CF, in every shard of sharded
+    rows.
     """
-    if column_id:
-        yield CLIENT.remove_counter(
-            key=pack_hash(key),
-            column_family="counter",
-            column=column_id,
-            consistency=consistency)
-    elif column:
-        yield CLIENT.remove_counter(
-            key=pack_hash(key),
-            column_family="counter",
-            column=pack_hash(column),
-            consistency=consistency)
-    else:
-        yield CLIENT.remove_counter(
-            key=pack_hash(key),
-            column_family="counter",
-            consistency=consistency)
+    if column:
+        column_id = pack_hash(column)
+    for shard in shard_keys(key):
+        if column_id:
+            yield CLIENT.remove_counter(
+                key=pack_hash(shard),
+                column_family="counter",
+                column=column_id,
+                consistency=consistency)
+        else:
+            yield CLIENT.remove_counter(
+                key=pack_hash(shard),
+                column_family="counter",
+                consistency=consistency)
@@ -1,44 +1,446 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
-import routes
 from twisted.web.resource import Resource
-from twisted.internet.defer import maybeDeferred
+from twisted.internet.defer import maybeDeferred, inlineCallbacks, \
+    returnValue, Deferred
+from twisted.internet.interfaces import IPushProducer
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+from twisted.python.failure import Failure
 from twisted.web.server import NOT_DONE_YET
-import gzip
-from cStringIO import StringIO
+from zope.interface import implementer
 import json
+import zlib
 from twisted.web import http
 from traceback import format_exc
+from .cache import LRUCache
+from .serializer import SERIALIZERS, JSONEncoder, Stream, dumps_json
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Responses smaller than COMPRESSION_MIN_SIZE bytes are sent uncompressed.
+COMPRESSION_MIN_SIZE = 1024
+# Compression level, 1 (fastest) to 9 (smallest).
+COMPRESSION_LEVEL = 6
+# Responses larger than COMPRESSION_THREAD_SIZE bytes are compressed in the
+# reactor's thread pool.
+COMPRESSION_THREAD_SIZE = 256 * 1024
+# Responses are compressed and written COMPRESSION_CHUNK_SIZE bytes at a
+# time.
+COMPRESSION_CHUNK_SIZE = 64 * 1024
+# Streamed responses are written in chunks of at least STREAM_CHUNK_SIZE
+# bytes, or COMPRESSION_MIN_SIZE bytes before waiting for a section.
+STREAM_CHUNK_SIZE = 16 * 1024
+# Result of a response that has been streamed to the request.
+STREAMED = object()
+
+
+def _zlib_codec(wbits):
+    """
+    Return a codec writing zlib streams with wbits.
+    """
+    def codec(level):
+        """
+        Return compress, sync and flush functions of a new compressor.
+        """
+        compressor = zlib.compressobj(level, zlib.DEFLATED, wbits)
+        return compressor.compress, \
+            lambda: compressor.flush(zlib.Z_SYNC_FLUSH), compressor.flush
+    return codec
+
+
+def _brotli_codec(level):
+    """
+    Return compress, sync and flush functions of a new brotli compressor.
+    """
+    compressor = brotli.Compressor(quality=level)
+    return getattr(compressor, "process", compressor.compress), \
+        compressor.flush, compressor.finish
+
+
+# Content codings in order of preference. Brotli is used if installed.
+CODECS = [
+    ("gzip", _zlib_codec(16 + zlib.MAX_WBITS)),
+    ("deflate", _zlib_codec(zlib.MAX_WBITS))]
+if brotli is not None:
+    CODECS.insert(0, ("br", _brotli_codec))
+
+
+def parse_accept(header):
+    """
+    Return a dictionary of the values in an Accept style header and their
+    quality.
+    """
+    accepted = {}
+    for item in (header or "").split(","):
+        parts = item.split(";")
+        quality = 1.0
+        for parameter in parts[1:]:
+            name, _, value = parameter.partition("=")
+            if name.strip() == "q":
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        accepted[parts[0].strip().lower()] = quality
+    return accepted
+
+
+def negotiate_encoding(header):
+    """
+    Return the name of the preferred codec accepted by an Accept-Encoding
+    header, or None.
+    """
+    accepted = parse_accept(header)
+    for name, _ in CODECS:
+        if accepted.get(name, accepted.get("*", 0)) > 0:
+            return name
+    return None
+
+
+def negotiate_serializer(header):
+    """
+    Return the content type and serializer best matching an Accept header.
+    JSON is used unless another type has a higher quality.
+    """
+    accepted = parse_accept(header)
+    best = SERIALIZERS[0]
+    best_quality = 0
+    for content_type, dumps in SERIALIZERS:
+        quality = accepted.get(
+            content_type,
+            accepted.get(
+                "%s/*" % content_type.split("/")[0],
+                accepted.get("*/*", 0)))
+        if quality > best_quality:
+            best = (content_type, dumps)
+            best_quality = quality
+    return best
+
+
+def compress(data, encoding, level=None):
+    """
+    Compress data with the named codec, COMPRESSION_CHUNK_SIZE bytes at a
+    time. Returns the list of compressed chunks.
+    """
+    if level is None:
+        level = COMPRESSION_LEVEL
+    compress_chunk, _, flush = dict(CODECS)[encoding](level)
+    chunks = []
+    for offset in xrange(0, len(data), COMPRESSION_CHUNK_SIZE):
+        chunk = compress_chunk(data[offset:offset + COMPRESSION_CHUNK_SIZE])
+        if chunk:
+            chunks.append(chunk)
+    chunks.append(flush())
+    return chunks
+
+
+class RouteNode(object):
+    """
+    Node of a route trie. Children are keyed by static path segment, and
+    variable is the child matching any non-empty segment. Leaf is the
+    (handler, variable names) pair of the route ending at this node.
+    """
+
+    __slots__ = ["children", "variable", "leaf"]
+
+    def __init__(self):
+        self.children = {}
+        self.variable = None
+        self.leaf = None
+
+    def insert(self, segments, handler):
+        """
+        Add the route with path segments. Segments of the form {name} are
+        variables.
+        """
+        node = self
+        names = []
+        for segment in segments:
+            if segment.startswith("{") and segment.endswith("}"):
+                names.append(segment[1:-1])
+                if node.variable is None:
+                    node.variable = RouteNode()
+                node = node.variable
+            elif "{" in segment or "}" in segment:
+                raise ValueError("Unsupported route segment %r." % segment)
+            else:
+                node = node.children.setdefault(segment, RouteNode())
+        if node.leaf is None:
+            node.leaf = (handler, names)
+
+    def match(self, segments, index=0, values=None):
+        """
+        Return (handler, variables) for the route matching path segments,
+        or None. Static segments take precedence over variables.
+        """
+        if values is None:
+            values = []
+        if index == len(segments):
+            if self.leaf is None:
+                return None
+            handler, names = self.leaf
+            return handler, dict(zip(names, values))
+        segment = segments[index]
+        child = self.children.get(segment)
+        if child is not None:
+            result = child.match(segments, index + 1, values)
+            if result is not None:
+                return result
+        if self.variable is not None and segment:
+            values.append(segment)
+            result = self.variable.match(segments, index + 1, values)
+            if result is not None:
+                return result
+            values.pop()
+        return None
+
+
+@inlineCallbacks
+def collect_stream(stream):
+    """
+    Return a Stream as a dictionary.
+    """
+    data = {}
+    for key, value in stream.sections:
+        if isinstance(value, Deferred):
+            value = yield value
+        if isinstance(value, Stream):
+            value = yield collect_stream(value)
+        data[key] = value
+    returnValue(data)
+
+
+@implementer(IPushProducer)
+class StreamProducer(object):
+    """
+    Writes a Stream to a request as a JSON object, a section at a time,
+    while the request's transport is not paused. Chunks are compressed
+    with the named codec, if given, and flushed from the compressor before
+    waiting for a section. start() returns a Deferred that fires with
+    STREAMED once the stream is written or the client has gone. It fails if
+    a section fails before anything was written. If a section fails later,
+    the connection is closed.
+    """
+
+    def __init__(self, request, stream, prefix="", suffix="", encoding=None):
+        self.request = request
+        self.suffix = suffix
+        self.encoding = encoding
+        self.encoder = JSONEncoder()
+        self.frames = [[iter(stream.sections), ""]]
+        self.buffer = [prefix, "{"]
+        self.size = 0
+        self.compress = None
+        self.sync = None
+        self.flush = None
+        self.started = False
+        self.running = False
+        self.waiting = False
+        self.paused = False
+        self.done = Deferred()
+
+    def start(self):
+        """
+        Start writing the stream.
+        """
+        if getattr(self.request, "_disconnected", False):
+            self.done.callback(STREAMED)
+            return self.done
+        self.request.registerProducer(self, True)
+        self._run()
+        return self.done
+
+    def pauseProducing(self):
+        self.paused = True
+
+    def resumeProducing(self):
+        self.paused = False
+        if not self.running and not self.waiting and not self.done.called:
+            self._run()
+
+    def stopProducing(self):
+        self.frames = []
+        if not self.done.called:
+            self.done.callback(STREAMED)
+
+    def _run(self):
+        """
+        Write sections until the stream ends, the transport is paused, or
+        a section's Deferred has to be waited for.
+        """
+        self.running = True
+        try:
+            while self.frames and not self.paused and not self.waiting:
+                frame = self.frames[-1]
+                try:
+                    key, value = frame[0].next()
+                except StopIteration:
+                    self.frames.pop()
+                    self._write("}")
+                    continue
+                self._write(frame[1] + self.encoder.encode_key(key) + ":")
+                frame[1] = ","
+                if isinstance(value, Deferred):
+                    self.waiting = True
+                    if not value.called and (self.started or
+                            self.size >= COMPRESSION_MIN_SIZE):
+                        self._send(sync=True)
+                    value.addCallbacks(self._section, self._fail)
+                else:
+                    self._value(value)
+        except Exception:
+            self._fail(Failure())
+        finally:
+            self.running = False
+        if not self.frames and not self.done.called:
+            self._finish()
+
+    def _section(self, value):
+        """
+        Write the value of a section that was waited for.
+        """
+        if self.done.called:
+            return
+        self.waiting = False
+        try:
+            self._value(value)
+        except Exception:
+            self._fail(Failure())
+            return
+        if not self.running:
+            self._run()
+
+    def _value(self, value):
+        """
+        Write a section's value. Streams are written as nested objects.
+        """
+        if isinstance(value, Stream):
+            self.frames.append([iter(value.sections), ""])
+            self._write("{")
+        else:
+            self._write(self.encoder.encode(value))
+
+    def _write(self, data):
+        """
+        Buffer data, sending it once the buffer is large enough.
+        """
+        self.buffer.append(data)
+        self.size += len(data)
+        if self.size >= STREAM_CHUNK_SIZE:
+            self._send()
+
+    def _send(self, final=False, sync=False):
+        """
+        Send the buffer as a chunk, and everything the compressor holds if
+        sync. Streams sent in one final chunk smaller than
+        COMPRESSION_MIN_SIZE bytes are not compressed.
+        """
+        data = "".join(self.buffer)
+        self.buffer = []
+        self.size = 0
+        if not self.started:
+            self.started = True
+            self.request.setHeader("Vary", "Accept, Accept-Encoding")
+            if final and len(data) < COMPRESSION_MIN_SIZE:
+                self.encoding = None
+            if self.encoding is not None:
+                self.request.setHeader("Content-Encoding", self.encoding)
+                self.compress, self.sync, self.flush = \
+                    dict(CODECS)[self.encoding](COMPRESSION_LEVEL)
+        if self.compress is not None:
+            data = self.compress(data)
+            if sync:
+                data += self.sync()
+        if data:
+            self.request.write(data)
+
+    def _finish(self):
+        """
+        Send the rest of the stream and finish the request.
+        """
+        self.buffer.append(self.suffix)
+        self._send(True)
+        if self.flush is not None:
+            self.request.write(self.flush())
+        self.request.unregisterProducer()
+        self.request.finish()
+        self.done.callback(STREAMED)
+
+    def _fail(self, failure):
+        """
+        Stop the stream after a section failed.
+        """
+        self.frames = []
+        if self.done.called:
+            log.err(failure)
+            return
+        self.request.unregisterProducer()
+        if not self.started:
+            self.done.errback(failure)
+            return
+        log.err(failure)
+        self.request.loseConnection()
+        self.done.callback(STREAMED)
 
 
 class Dispatcher(Resource):
     '''
     Based on txroutes
 
+    Routes are compiled into a segment trie per request method when they
+    are connected, and matched in one pass over request.postpath. Matches
+    of recently requested paths are kept in an LRU cache of cache_size
+    entries.
+
     Helpful background information:
-    - Python routes: http://routes.groovie.org/
     - Using twisted.web.resources:
     http://twistedmatrix.com/documents/current/web/howto/web-in-60/dynamic-
     dispatch.html
     '''
 
-    def __init__(self):
-        Resource.__init__(self)
-
-        self.__path = ['']
+    isLeaf = True
 
-        self.__controllers = {}
-        self.__mapper = routes.Mapper()
+    def __init__(self, cache_size=10000):
+        Resource.__init__(self)
 
-    def connect(self, name, route, controller, **kwargs):
-        self.__controllers[name] = controller
-        self.__mapper.connect(name, route, controller=name, **kwargs)
+        self.__tries = {}
+        self.__cache = LRUCache(size=cache_size)
 
-    def getChild(self, name, request):
-        self.__path.append(name)
+    def connect(self, name, route, controller, action, conditions=None):
+        """
+        Route requests for route to the action method of controller. Routes
+        without a method condition match any method. Requests routed to a
+        missing action are not found.
+        """
+        method = (conditions or {}).get("method")
+        trie = self.__tries.setdefault(method, RouteNode())
+        trie.insert(
+            route.split("/")[1:],
+            getattr(controller, action, None))
+        self.__cache.clear()
 
-        return self
+    def match(self, method, segments):
+        """
+        Return (handler, variables) for the route matching method and path
+        segments, or None.
+        """
+        key = (method, tuple(segments))
+        result = self.__cache.get(key)
+        if result is None:
+            for trie_method in (method, None):
+                trie = self.__tries.get(trie_method)
+                if trie is not None:
+                    result = trie.match(segments)
+                    if result is not None:
+                        break
+            if result is None or result[0] is None:
+                result = False
+            self.__cache.set(key, result)
+        return result or None
 
     def render_HEAD(self, request):
         return self.__render('HEAD', request)
@@ -59,69 +461,111 @@ class Dispatcher(Resource):
         return self.__render('DELETE', request)
 
     def __render(self, method, request):
-        try:
-            wsgi_environ = {}
-            wsgi_environ['REQUEST_METHOD'] = method
-            wsgi_environ['PATH_INFO'] = '/'.join(self.__path)
-            result = self.__mapper.match(environ=wsgi_environ)
-            handler = None
-            if result is not None:
-                controller = result.get('controller', None)
-                controller = self.__controllers.get(controller)
-                if controller is not None:
-                    del result['controller']
-                    action = result.get('action', None)
-                    if action is not None:
-                        del result['action']
-                        handler = getattr(controller, action, None)
-        finally:
-            self.__path = ['']
-        if handler:
-            result = dict([(x[0], x[1].encode("utf8")) \
-                for x in result.items()])
-            d = maybeDeferred(handler, request, **result)
-            d.addCallback(self._success_response)
-            d.addErrback(self._error_response, request)
+        result = self.match(method, request.postpath)
+        if result:
+            handler, variables = result
             if "callback" in request.args:
-                d.addCallback(self._add_jsonp_callback)
-            d.addCallback(self._gzip_response, request)
+                content_type, dumps = "application/javascript", dumps_json
+            else:
+                content_type, dumps = negotiate_serializer(
+                    request.getHeader("accept"))
+            request.setHeader("Content-Type", content_type)
+            d = maybeDeferred(handler, request, **variables)
+            d.addCallback(self._success_response, request, dumps)
+            d.addErrback(self._error_response, request, dumps)
+            if "callback" in request.args:
+                d.addCallback(self._add_jsonp_callback, request)
+            d.addCallback(self._compress_response, request)
             return NOT_DONE_YET
         else:
             request.setResponseCode(404)
             return json.dumps({"error": "Not found"})
 
-    def _success_response(self, data):
-        return json.dumps(data)
+    def _success_response(self, data, request, dumps):
+        if isinstance(data, Stream):
+            return self._stream_response(data, request, dumps)
+        return dumps(data)
 
-    def _error_response(self, error, request):
+    def _stream_response(self, stream, request, dumps):
+        """
+        Stream a JSON response with a StreamProducer. Other serializers
+        collect the stream first.
+        """
+        if dumps is not dumps_json:
+            return collect_stream(stream).addCallback(dumps)
+        prefix, suffix = "", ""
+        if "callback" in request.args:
+            prefix, suffix = "%s(" % request.args["callback"][0], ");"
+        producer = StreamProducer(
+            request,
+            stream,
+            prefix,
+            suffix,
+            negotiate_encoding(request.getHeader("accept-encoding")))
+        return producer.start()
+
+    def _error_response(self, error, request, dumps):
         try:
             error.raiseException()
         except:
             exc = format_exc()
         if request.code == 401:
-            return json.dumps({"error": "Authorization required."})
+            return dumps({"error": "Authorization required."})
         if request.code < 400:
             request.setResponseCode(500)
             print error.getTraceback()
-        return json.dumps({"error": str(error.value), "exc": exc})
+        return dumps({"error": str(error.value), "exc": exc})
 
     def _add_jsonp_callback(self, data, request):
+        if data is STREAMED:
+            return data
         return "%s(%s);" % (request.args["callback"][0], data)
 
-    def _gzip_response(self, data, request):
-        encoding = request.getHeader("accept-encoding")
-        if encoding and "gzip" in encoding:
-            zbuf = StringIO()
-            zfile = gzip.GzipFile(None, 'wb', 9, zbuf)
-            if isinstance(data, unicode):
-                zfile.write(unicode(data).encode("utf-8"))
-            elif isinstance(data, str):
-                zfile.write(unicode(data, 'utf-8').encode("utf-8"))
-            else:
-                zfile.write(unicode(data).encode("utf-8"))
-            zfile.close()
-            request.setHeader("Content-encoding", "gzip")
-            request.write(zbuf.getvalue())
-        else:
+    def _compress_response(self, data, request):
+        """
+        Write the response, compressed with the preferred codec accepted by
+        the client if it is at least COMPRESSION_MIN_SIZE bytes. Responses
+        over COMPRESSION_THREAD_SIZE bytes are compressed in a thread.
+        """
+        if data is STREAMED:
+            return
+        if isinstance(data, unicode):
+            data = data.encode("utf-8")
+        encoding = None
+        if len(data) >= COMPRESSION_MIN_SIZE:
+            encoding = negotiate_encoding(
+                request.getHeader("accept-encoding"))
+        request.setHeader("Vary", "Accept, Accept-Encoding")
+        if encoding is None:
             request.write(data)
+            request.finish()
+            return
+        request.setHeader("Content-Encoding", encoding)
+        if len(data) > COMPRESSION_THREAD_SIZE:
+            d = deferToThread(compress, data, encoding)
+            d.addCallbacks(
+                self._write_chunks,
+                self._compression_failed,
+                callbackArgs=(request,),
+                errbackArgs=(request,))
+            return d
+        self._write_chunks(compress(data, encoding), request)
+
+    def _compression_failed(self, failure, request):
+        """
+        Log a failed compression and drop the connection, since the
+        response headers are already set.
+        """
+        log.err(failure)
+        if not getattr(request, "_disconnected", False):
+            request.loseConnection()
+
+    def _write_chunks(self, chunks, request):
+        """
+        Write chunks and finish the request, unless the client has gone.
+        """
+        if getattr(request, "_disconnected", False):
+            return
+        for chunk in chunks:
+            request.write(chunk)
         request.finish()
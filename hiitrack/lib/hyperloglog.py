@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+HyperLogLog sketches of 16 byte ids.
+"""
+
+import math
+import struct
+import zlib
+
+# Number of index bits. 2 ** PRECISION one byte registers give a standard
+# error of about 1.04 / sqrt(2 ** PRECISION), 1.6% at 12.
+PRECISION = 12
+
+
+class HyperLogLog(object):
+    """
+    Approximate count of distinct ids. Ids are 16 byte hashes, so their
+    first 64 bits are used directly as the hash.
+    """
+
+    def __init__(self, registers=None, precision=None):
+        self.precision = precision or PRECISION
+        self.size = 1 << self.precision
+        if registers is None:
+            registers = bytearray(self.size)
+        self.registers = registers
+
+    def add(self, key):
+        """
+        Add an id to the sketch.
+        """
+        value, = struct.unpack(">Q", key[0:8])
+        bits = 64 - self.precision
+        index = value >> bits
+        rank = bits - (value & ((1 << bits) - 1)).bit_length() + 1
+        if rank > self.registers[index]:
+            self.registers[index] = rank
+
+    def merge(self, sketch):
+        """
+        Add the ids counted by another sketch.
+        """
+        registers = self.registers
+        for index, rank in enumerate(sketch.registers):
+            if rank > registers[index]:
+                registers[index] = rank
+
+    def count(self):
+        """
+        Return the approximate number of distinct ids added.
+        """
+        size = self.size
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / \
+            sum([2.0 ** -x for x in self.registers])
+        zeros = self.registers.count(chr(0))
+        if estimate <= 2.5 * size and zeros:
+            estimate = size * math.log(float(size) / zeros)
+        return int(round(estimate))
+
+    def dumps(self):
+        """
+        Serialize the sketch.
+        """
+        return chr(self.precision) + zlib.compress(str(self.registers))
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Deserialize a sketch serialized with dumps().
+        """
+        return cls(bytearray(zlib.decompress(data[1:])), ord(data[0]))
@@ -5,9 +5,14 @@
 Checks for required parameters.
 """
 
+import time
 from ..exceptions import MissingParameterException
 from functools import wraps
 
+# Maximum number of seconds between 'start' and 'end'. Each day of a range
+# is read as several counter and sketch rows.
+MAX_RANGE = 366 * 86400
+
 
 def require(*required_parameters):
     """
@@ -32,3 +37,29 @@ def require(*required_parameters):
             return method(*args, **kwargs)
         return wraps(method)(wrapper)
     return decorator
+
+
+def time_range(request):
+    """
+    Return the 'start' and 'end' timestamp parameters of a request, or
+    (None, None) if there is no start. End defaults to now, and may be at
+    most MAX_RANGE seconds after start.
+    """
+    try:
+        if "start" not in request.args:
+            if "end" in request.args:
+                raise AssertionError("Parameter 'end' without 'start'.")
+            return None, None
+        start = float(request.args["start"][0])
+        if "end" in request.args:
+            end = float(request.args["end"][0])
+        else:
+            end = time.time()
+        if not 0 <= start < end <= start + MAX_RANGE:
+            raise AssertionError("Invalid time range.")
+    except (ValueError, IndexError, AssertionError):
+        request.setResponseCode(403)
+        raise MissingParameterException("Parameters 'start' and 'end' "
+            "must be timestamps with start before end, at most %d days "
+            "apart." % (MAX_RANGE // 86400))
+    return start, end
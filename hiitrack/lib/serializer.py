@@ -0,0 +1,276 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Response serializers. Controllers mark raw ids in responses with Id and
+serializers encode them, as URL safe base64 strings in JSON and as binary
+in MessagePack.
+"""
+
+import ujson
+from .b64encode import uri_b64encode
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Id(str):
+    """
+    A raw id in a response.
+    """
+
+    __slots__ = ()
+
+
+class IdKeys(object):
+    """
+    A dictionary whose keys, and the keys of its values to depth levels of
+    nesting, are raw ids.
+    """
+
+    __slots__ = ["dictionary", "depth"]
+
+    def __init__(self, dictionary, depth=1):
+        self.dictionary = dictionary
+        self.depth = depth
+
+
+class IdValues(object):
+    """
+    A dictionary whose values, or the values of its values to depth levels
+    of nesting, are raw ids.
+    """
+
+    __slots__ = ["dictionary", "depth"]
+
+    def __init__(self, dictionary, depth=1):
+        self.dictionary = dictionary
+        self.depth = depth
+
+
+class IdPairs(object):
+    """
+    A list of (raw id, value) pairs.
+    """
+
+    __slots__ = ["pairs"]
+
+    def __init__(self, pairs):
+        self.pairs = pairs
+
+
+def id_keys(dictionary):
+    """
+    Mark a dictionary's keys as ids.
+    """
+    return IdKeys(dictionary)
+
+
+def id_nested_keys(dictionary):
+    """
+    Nested version of id_keys.
+    """
+    return IdKeys(dictionary, 2)
+
+
+def id_double_nested_keys(dictionary):
+    """
+    Double-nested version of id_keys.
+    """
+    return IdKeys(dictionary, 3)
+
+
+def id_values(dictionary):
+    """
+    Mark a dictionary's values as ids.
+    """
+    return IdValues(dictionary)
+
+
+def id_nested_values(dictionary):
+    """
+    Nested version of id_values.
+    """
+    return IdValues(dictionary, 2)
+
+
+class Stream(object):
+    """
+    A response object written section by section. sections is an iterable
+    of (key, value) pairs. Values may be Deferreds or Streams.
+    """
+
+    __slots__ = ["sections"]
+
+    def __init__(self, sections):
+        self.sections = sections
+
+
+class JSONEncoder(object):
+    """
+    Emits JSON in one pass over a response, without copying it. Ids are
+    encoded as URL safe base64 strings through a table memoizing each
+    distinct id of the response.
+    """
+
+    def __init__(self):
+        self.ids = {}
+
+    def encode(self, value):
+        """
+        Return value as JSON.
+        """
+        value_type = type(value)
+        if value_type is int or value_type is long:
+            return str(value)
+        if isinstance(value, Id):
+            return self.ids.get(value) or self._encode_id(value)
+        if isinstance(value, dict):
+            return "{%s}" % ",".join([self.encode_key(x[0]) + ":" + \
+                self.encode(x[1]) for x in value.iteritems()])
+        if isinstance(value, (list, tuple)):
+            return "[%s]" % ",".join([self.encode(x) for x in value])
+        if isinstance(value, IdKeys):
+            return self._encode_id_keys(value.dictionary, value.depth)
+        if isinstance(value, IdValues):
+            return self._encode_id_values(value.dictionary, value.depth)
+        if isinstance(value, IdPairs):
+            return self._encode_id_pairs(value.pairs)
+        return ujson.dumps(value)
+
+    def _encode_id(self, value):
+        """
+        Encode an id and add it to the table.
+        """
+        encoded = self.ids[value] = '"%s"' % uri_b64encode(value)
+        return encoded
+
+    def encode_key(self, value):
+        """
+        Encode a dictionary key. Other keys than strings are converted as
+        by json.dumps.
+        """
+        if isinstance(value, Id):
+            return self.ids.get(value) or self._encode_id(value)
+        if isinstance(value, basestring):
+            return ujson.dumps(value)
+        if value is None:
+            return '"null"'
+        if isinstance(value, float):
+            return '"%r"' % value
+        return '"%s"' % value
+
+    def _encode_id_keys(self, dictionary, depth):
+        """
+        Encode a dictionary with ids as keys to depth levels.
+        """
+        ids = self.ids
+        encode_id = self._encode_id
+        if depth > 1:
+            encode = self._encode_id_keys
+            depth -= 1
+            items = [(ids.get(x[0]) or encode_id(x[0])) + ":" + \
+                encode(x[1], depth) for x in dictionary.iteritems()]
+        else:
+            encode = self.encode
+            items = [(ids.get(x[0]) or encode_id(x[0])) + ":" + \
+                encode(x[1]) for x in dictionary.iteritems()]
+        return "{%s}" % ",".join(items)
+
+    def _encode_id_values(self, dictionary, depth):
+        """
+        Encode a dictionary with ids as values at depth.
+        """
+        encode_key = self.encode_key
+        if depth > 1:
+            items = [encode_key(x[0]) + ":" + \
+                self._encode_id_values(x[1], depth - 1) \
+                for x in dictionary.iteritems()]
+        else:
+            ids = self.ids
+            items = [encode_key(x[0]) + ":" + \
+                (ids.get(x[1]) or self._encode_id(x[1])) \
+                for x in dictionary.iteritems()]
+        return "{%s}" % ",".join(items)
+
+    def _encode_id_pairs(self, pairs):
+        """
+        Encode a list of (id, value) pairs.
+        """
+        ids = self.ids
+        return "[%s]" % ",".join(["[%s,%s]" % (
+            ids.get(x[0]) or self._encode_id(x[0]),
+            self.encode(x[1])) for x in pairs])
+
+
+def encode_msgpack_ids(value):
+    """
+    Replace ids in value with byte strings and other strings with unicode,
+    so MessagePack sends ids as binary and text as strings.
+    """
+    if isinstance(value, Id):
+        return str(value)
+    if isinstance(value, str):
+        try:
+            return value.decode("utf-8")
+        except UnicodeDecodeError:
+            return value
+    if isinstance(value, dict):
+        return dict([(encode_msgpack_ids(x[0]), encode_msgpack_ids(x[1]))
+            for x in value.iteritems()])
+    if isinstance(value, (list, tuple)):
+        return [encode_msgpack_ids(x) for x in value]
+    if isinstance(value, IdKeys):
+        return _encode_msgpack_id_keys(value.dictionary, value.depth)
+    if isinstance(value, IdValues):
+        return _encode_msgpack_id_values(value.dictionary, value.depth)
+    if isinstance(value, IdPairs):
+        return [(str(x[0]), encode_msgpack_ids(x[1])) for x in value.pairs]
+    return value
+
+
+def _encode_msgpack_id_keys(dictionary, depth):
+    """
+    encode_msgpack_ids of a dictionary with ids as keys to depth levels.
+    """
+    if depth > 1:
+        return dict([(str(x[0]), _encode_msgpack_id_keys(x[1], depth - 1))
+            for x in dictionary.iteritems()])
+    return dict([(str(x[0]), encode_msgpack_ids(x[1]))
+        for x in dictionary.iteritems()])
+
+
+def _encode_msgpack_id_values(dictionary, depth):
+    """
+    encode_msgpack_ids of a dictionary with ids as values at depth.
+    """
+    if depth > 1:
+        return dict([(encode_msgpack_ids(x[0]),
+            _encode_msgpack_id_values(x[1], depth - 1))
+            for x in dictionary.iteritems()])
+    return dict([(encode_msgpack_ids(x[0]), str(x[1]))
+        for x in dictionary.iteritems()])
+
+
+def dumps_json(data):
+    """
+    Serialize data as JSON.
+    """
+    return JSONEncoder().encode(data)
+
+
+def dumps_msgpack(data):
+    """
+    Serialize data as MessagePack.
+    """
+    return msgpack.packb(encode_msgpack_ids(data), use_bin_type=True)
+
+
+# Content types and serializers in order of preference. MessagePack is
+# available if the msgpack module is installed.
+SERIALIZERS = [("application/json", dumps_json)]
+if msgpack is not None:
+    SERIALIZERS.extend([
+        ("application/msgpack", dumps_msgpack),
+        ("application/x-msgpack", dumps_msgpack)])
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Durable local spool for asynchronous ingestion.
+"""
+
+import os
+import ujson
+from twisted.internet.defer import Deferred, inlineCallbacks, succeed
+from twisted.internet.task import LoopingCall
+from twisted.internet.threads import deferToThread
+from twisted.python import log
+
+
+class Spool(object):
+    """
+    Append-only file of JSON records. Appends are fsynced in batches every
+    sync_interval seconds. Every drain_interval seconds, up to chunk_size
+    records are passed to handler, which returns a Deferred firing with the
+    records to retry, if any. Those are appended to the spool again and
+    retried on the next drain. The offset of the last handled record is
+    checkpointed next to the spool, so records not yet handled are replayed
+    after a restart. Records are handled at least once: a crash between
+    handling and checkpointing replays them. File reads, checkpoints, and
+    fsyncs run in threads.
+    """
+
+    def __init__(
+            self,
+            path,
+            handler,
+            sync_interval=0.05,
+            drain_interval=0.5,
+            chunk_size=1000):
+        self.path = path
+        self.offset_path = "%s.offset" % path
+        self.handler = handler
+        self.sync_interval = sync_interval
+        self.drain_interval = drain_interval
+        self.chunk_size = chunk_size
+        self.file = open(path, "ab")
+        self.offset = self._read_offset()
+        self.pending = []
+        self.syncing = None
+        self.draining = None
+        self.sync_loop = LoopingCall(self.sync)
+        self.drain_loop = LoopingCall(self.drain)
+
+    def _read_offset(self):
+        """
+        Read the checkpointed offset. An offset past the end of the spool
+        means it was truncated after being fully handled.
+        """
+        try:
+            with open(self.offset_path, "rb") as offset_file:
+                offset = int(offset_file.read().strip() or 0)
+        except IOError:
+            offset = 0
+        if offset > os.path.getsize(self.path):
+            offset = 0
+        return offset
+
+    def _write_offset(self, offset):
+        """
+        Atomically checkpoint offset. Blocks, so it is run in a thread.
+        """
+        temp_path = "%s.tmp" % self.offset_path
+        with open(temp_path, "wb") as offset_file:
+            offset_file.write(str(offset))
+            offset_file.flush()
+            os.fsync(offset_file.fileno())
+        os.rename(temp_path, self.offset_path)
+
+    def start(self):
+        """
+        Start syncing and draining, replaying records left by a previous
+        run.
+        """
+        self.sync_loop.start(self.sync_interval, now=False)
+        self.drain_loop.start(self.drain_interval, now=True)
+
+    @inlineCallbacks
+    def stop(self):
+        """
+        Stop draining and sync outstanding appends. Records not yet handled
+        stay in the spool for the next run.
+        """
+        for loop in (self.sync_loop, self.drain_loop):
+            if loop.running:
+                loop.stop()
+        if self.draining:
+            yield self.draining
+        yield self.sync()
+        self.file.close()
+
+    def append(self, records):
+        """
+        Append records. Returns a Deferred that fires once they are
+        fsynced.
+        """
+        self.file.write("".join([ujson.dumps(x) + "\n" for x in records]))
+        deferred = Deferred()
+        self.pending.append(deferred)
+        return deferred
+
+    @inlineCallbacks
+    def sync(self):
+        """
+        Flush and fsync appended records, then notify their appenders.
+        """
+        if self.syncing:
+            yield self.syncing
+        if not self.pending:
+            return
+        pending = self.pending
+        self.pending = []
+        self.file.flush()
+        self.syncing = deferToThread(os.fsync, self.file.fileno())
+        try:
+            yield self.syncing
+        except Exception:
+            self.syncing = None
+            for deferred in pending:
+                deferred.errback()
+            return
+        self.syncing = None
+        for deferred in pending:
+            deferred.callback(None)
+
+    def drain(self):
+        """
+        Pass spooled records to the handler, a chunk at a time, until the
+        spool is empty.
+        """
+        if self.draining:
+            return succeed(None)
+        deferred = self._drain()
+        deferred.addErrback(log.err)
+        if not deferred.called:
+            self.draining = deferred
+            deferred.addBoth(self._drained)
+        return deferred
+
+    def _drained(self, result):
+        self.draining = None
+        return result
+
+    def _read_chunk(self, offset):
+        """
+        Read up to chunk_size complete lines from offset. Returns the lines
+        and their size in bytes. Blocks, so it is run in a thread.
+        """
+        lines = []
+        size = 0
+        with open(self.path, "rb") as spool_file:
+            spool_file.seek(offset)
+            for line in spool_file:
+                if not line.endswith("\n") or len(lines) == self.chunk_size:
+                    break
+                lines.append(line)
+                size += len(line)
+        return lines, size
+
+    @inlineCallbacks
+    def _drain(self):
+        """
+        Hand off chunks of records and advance the checkpoint after each.
+        Records to retry are appended and synced before the checkpoint
+        moves past them, and the drain stops until the next interval.
+        Truncates the spool once everything is handled.
+        """
+        while True:
+            self.file.flush()
+            lines, size = yield deferToThread(self._read_chunk, self.offset)
+            if not lines:
+                return
+            records = []
+            for line in lines:
+                try:
+                    records.append(ujson.loads(line))
+                except ValueError:
+                    log.msg("Skipping malformed spool record: %r" % line)
+            retries = None
+            if records:
+                retries = yield self.handler(records)
+            if retries:
+                appended = self.append(retries)
+                yield self.sync()
+                yield appended
+            self.offset += size
+            spool_size = os.fstat(self.file.fileno()).st_size
+            if self.offset == spool_size and not self.pending:
+                self.file.truncate(0)
+                self.offset = 0
+            yield deferToThread(self._write_offset, self.offset)
+            if retries:
+                return
@@ -11,9 +11,43 @@ import ujson
 from twisted.internet.defer import inlineCallbacks, returnValue
 from telephus.cassandra.c08.ttypes import NotFoundException
 from ..lib.cassandra import get_relation, insert_relation, delete_relation, \
-    delete_counter
+    delete_counter, get_counter
+from ..lib.cache import LRUCache
+from .visitor import invalidate_bucket
+from . import registry
 from ..exceptions import BucketException
 
+# Process-local cache of (user_name, bucket_name) -> (exists, settings).
+# Buckets that do not exist are cached for NEGATIVE_TTL seconds only.
+EXISTS_CACHE = LRUCache(size=10000, ttl=60)
+NEGATIVE_TTL = 5
+# Bucket settings and their types.
+SETTINGS = {
+    # Only update paths from the last path_limit distinct events.
+    "path_limit": int,
+    # Only update paths from events seen in the last path_window seconds.
+    "path_window": float,
+    # Set to 1 to skip reading visitors missing from a visitor filter.
+    "visitor_filter": int,
+    # Set to 1 to also count events in hourly and daily rows.
+    "time_series": int}
+
+
+def parse_settings(args):
+    """
+    Read bucket settings from request arguments.
+    """
+    settings = {}
+    for name, cast in SETTINGS.items():
+        if name in args and args[name][0]:
+            try:
+                settings[name] = cast(args[name][0])
+            except ValueError:
+                raise BucketException("Invalid value for '%s'." % name)
+            if not settings[name] > 0:
+                raise BucketException("Invalid value for '%s'." % name)
+    return settings
+
 
 def bucket_check(method):
     """
@@ -52,23 +86,44 @@ class BucketModel(object):
         """
         Verify bucket exists.
         """
+        settings = yield self.get_settings()
+        returnValue(settings is not None)
+
+    @inlineCallbacks
+    def get_settings(self):
+        """
+        Return the bucket's settings, or None if it does not exist.
+        """
+        cache_key = (self.user_name, self.bucket_name)
+        cached = EXISTS_CACHE.get(cache_key)
+        if cached is not None:
+            returnValue(cached[1])
         key = (self.user_name, "bucket")
         column = (self.bucket_name,)
         try:
-            yield get_relation(key, column)
+            data = yield get_relation(key, column)
         except NotFoundException:
-            returnValue(False)
-        returnValue(True)
+            EXISTS_CACHE.set(cache_key, (False, None), ttl=NEGATIVE_TTL)
+            returnValue(None)
+        data = ujson.loads(data)
+        if len(data) > 2:
+            settings = data[2]
+        else:
+            settings = {}
+        EXISTS_CACHE.set(cache_key, (True, settings))
+        returnValue(settings)
 
     @inlineCallbacks
-    def create(self, description):
+    def create(self, description, settings=None):
         """
         Create bucket for username.
         """
         key = (self.user_name, "bucket")
         column = (self.bucket_name,)
-        value = ujson.dumps((self.bucket_name, description))
+        settings = settings or {}
+        value = ujson.dumps((self.bucket_name, description, settings))
         yield insert_relation(key, column, value)
+        EXISTS_CACHE.set((self.user_name, self.bucket_name), (True, settings))
 
     @inlineCallbacks
     def get_property_ids(self):
@@ -110,9 +165,19 @@ class BucketModel(object):
         key = (self.user_name, "bucket")
         column = (self.bucket_name,)
         data = yield get_relation(key, column)
-        bucket_name, description = ujson.loads(data)
+        bucket_name, description = ujson.loads(data)[0:2]
         returnValue((bucket_name, description))
 
+    @inlineCallbacks
+    def get_stats(self):
+        """
+        Return bucket counters such as the number of hits whose path
+        updates were cut off by the path settings.
+        """
+        key = (self.user_name, self.bucket_name, "stats")
+        data = yield get_counter(key)
+        returnValue(dict(data))
+
     @inlineCallbacks
     def delete(self):
         """
@@ -121,11 +186,21 @@ class BucketModel(object):
         key = (self.user_name, "bucket")
         column = (self.bucket_name,)
         yield delete_relation(key, column)
+        EXISTS_CACHE.delete((self.user_name, self.bucket_name))
+        invalidate_bucket(self.user_name, self.bucket_name)
+        registry.invalidate_bucket(self.user_name, self.bucket_name)
         keys = [
             (self.user_name, self.bucket_name, "property"),
             (self.user_name, self.bucket_name, "event"),
             (self.user_name, self.bucket_name, "funnel"),
-            (self.user_name, self.bucket_name, "visitor_property")]
+            (self.user_name, self.bucket_name, "visitor_property"),
+            (self.user_name, self.bucket_name, "visitor_event_time"),
+            (self.user_name, self.bucket_name, "visitor_sketch")]
+        days = yield get_counter(
+            (self.user_name, self.bucket_name, "sketch_day"))
+        for day in days:
+            keys.append(
+                (self.user_name, self.bucket_name, "visitor_sketch", day))
         for key in keys:
             yield delete_relation(key)
         keys = [
@@ -135,6 +210,16 @@ class BucketModel(object):
             (self.user_name, self.bucket_name, "path"),
             (self.user_name, self.bucket_name, "unique_path"),
             (self.user_name, self.bucket_name, "visitor_event"),
-            (self.user_name, self.bucket_name, "visitor_path")]
+            (self.user_name, self.bucket_name, "visitor_path"),
+            (self.user_name, self.bucket_name, "stats"),
+            (self.user_name, self.bucket_name, "sketch_day")]
+        periods = yield get_counter(
+            (self.user_name, self.bucket_name, "period"))
+        for column_id in periods:
+            period = tuple(column_id.split("/", 1))
+            for row in ("event", "unique_event", "path", "unique_path",
+                    "property"):
+                keys.append((self.user_name, self.bucket_name, row) + period)
+        keys.append((self.user_name, self.bucket_name, "period"))
         for key in keys:
             yield delete_counter(key)
@@ -5,12 +5,92 @@
 Events are name/timestamp pairs linked to a visitor and stored in buckets.
 """
 
+import math
+import time
 from ..lib.hash import pack_hash
 from twisted.internet.defer import inlineCallbacks, returnValue
-from ..lib.cassandra import insert_relation, increment_counter, get_counter
+from ..lib import cassandra
+from ..lib.cassandra import insert_relation, increment_counter, get_counter, \
+    get_counter_pager, multiget_slices, multiget_columns, merge_sketches
+from .registry import is_known, add_known
 from collections import defaultdict
 
 
+def nest_path(data, result=None):
+    """
+    Convert path columns of new_event_id + property_id + event_id, with the
+    new_event_id prefix removed, into a nested dictionary of
+    property_id -> event_id -> count. Counts are added to those already in
+    result.
+    """
+    if result is None:
+        result = defaultdict(dict)
+    for column_id in data:
+        event_id = column_id[0:16]
+        property_id = column_id[16:]
+        result[event_id][property_id] = \
+            result[event_id].get(property_id, 0) + data[column_id]
+    return result
+
+
+def format_day(timestamp):
+    """
+    Return the UTC day of a timestamp as YYYY-MM-DD.
+    """
+    return time.strftime("%Y-%m-%d", time.gmtime(timestamp))
+
+
+def format_periods(timestamp):
+    """
+    Return the (resolution, period) row suffixes of the UTC day and hour
+    of a timestamp.
+    """
+    when = time.gmtime(timestamp)
+    return (
+        ("day", time.strftime("%Y-%m-%d", when)),
+        ("hour", time.strftime("%Y-%m-%dT%H", when)))
+
+
+def plan_periods(start, end):
+    """
+    Return the fewest (resolution, period) row suffixes covering the hours
+    from start up to end: whole UTC days, and hours at either edge.
+    """
+    hour = int(start) // 3600 * 3600
+    end = int(math.ceil(end / 3600.0)) * 3600
+    periods = []
+    while hour < end:
+        if hour % 86400 == 0 and hour + 86400 <= end:
+            periods.append(("day", format_day(hour)))
+            hour += 86400
+        else:
+            periods.append(("hour", time.strftime(
+                "%Y-%m-%dT%H",
+                time.gmtime(hour))))
+            hour += 3600
+    return periods
+
+
+def sum_columns(rows):
+    """
+    Sum a list of dictionaries of column_id -> count.
+    """
+    result = defaultdict(int)
+    for row in rows:
+        for column_id, value in row.iteritems():
+            result[column_id] += value
+    return dict(result)
+
+
+def count_sketches(data):
+    """
+    Merge stored sketch columns, with the event_id prefix removed, into a
+    dictionary of property_id -> approximate visitor count.
+    """
+    sketches = merge_sketches(data)
+    return dict([(k, v.count()) for k, v in sketches.iteritems()])
+
+
 class EventModel(object):
     """
     Events are name/timestamp pairs linked to a visitor and stored in buckets.
@@ -30,29 +110,56 @@ class EventModel(object):
     @inlineCallbacks
     def create(self):
         """
-        Bucket event.
+        Bucket event. Skipped if this process has already stored it.
         """
+        if is_known(self.user_name, self.bucket_name, self.id):
+            return
         key = (self.user_name, self.bucket_name, "event")
         column = (self.user_name, self.bucket_name, "event", self.event_name)
         value = self.event_name
         yield insert_relation(key, column, value)
+        add_known(self.user_name, self.bucket_name, self.id)
 
     @inlineCallbacks
-    def increment_total(self, unique, property_id=None, value=1):
+    def increment_total(
+            self,
+            unique,
+            property_id=None,
+            value=1,
+            batch=None,
+            periods=()):
         """
-        Increment the total count of event_id.
+        Increment the total count of event_id, in the all-time rows and in
+        the rows of periods.
         """
         key = (self.user_name, self.bucket_name, "event")
         column_id = "".join([self.id, property_id or self.id])
-        yield increment_counter(key, column_id=column_id, value=value)
+        yield self._increment(key, column_id, value, batch, periods)
         if not unique:
             return
         key = (self.user_name, self.bucket_name, "unique_event")
-        yield increment_counter(key, column_id=column_id)
+        yield self._increment(key, column_id, 1, batch, periods)
         if property_id:
             key = (self.user_name, self.bucket_name, "property")
             column_id = "".join([property_id, self.id])
-            yield increment_counter(key, column_id=column_id)
+            yield self._increment(key, column_id, 1, batch, periods)
+
+    @inlineCallbacks
+    def _increment(self, key, column_id, value, batch, periods):
+        """
+        Increment a column of an all-time row and of its period rows.
+        """
+        yield increment_counter(
+            key,
+            column_id=column_id,
+            value=value,
+            batch=batch)
+        for period in periods:
+            yield increment_counter(
+                key + period,
+                column_id=column_id,
+                value=value,
+                batch=batch)
 
     @inlineCallbacks
     def get_total(self):
@@ -73,20 +180,28 @@ class EventModel(object):
         returnValue(data)
 
     @inlineCallbacks
-    def increment_path(self, event_id, unique, property_id=None, value=1):
+    def increment_path(
+            self,
+            event_id,
+            unique,
+            property_id=None,
+            value=1,
+            batch=None,
+            periods=()):
         """
-        Increment the path of events from event_id -> new_event_id.
+        Increment the path of events from event_id -> new_event_id, in the
+        all-time rows and in the rows of periods.
         """
         key = (self.user_name, self.bucket_name, "path")
         column_id = "".join([
             self.id,
             property_id or self.id,
             event_id])
-        yield increment_counter(key, column_id=column_id, value=value)
+        yield self._increment(key, column_id, value, batch, periods)
         if not unique:
             return
         key = (self.user_name, self.bucket_name, "unique_path")
-        yield increment_counter(key, column_id=column_id)
+        yield self._increment(key, column_id, 1, batch, periods)
 
     @inlineCallbacks
     def get_path(self):
@@ -94,14 +209,8 @@ class EventModel(object):
         Get the path of events.
         """
         key = (self.user_name, self.bucket_name, "path")
-        prefix = self.id
-        data = yield get_counter(key, prefix=prefix)
-        result = defaultdict(dict)
-        for column_id in data:
-            event_id = column_id[0:16]
-            property_id = column_id[16:]
-            result[event_id][property_id] = data[column_id]
-        returnValue(result)
+        data = yield self._get_path(key)
+        returnValue(data)
 
     @inlineCallbacks
     def get_unique_path(self):
@@ -109,11 +218,150 @@ class EventModel(object):
         Get the unique path of visitor events.
         """
         key = (self.user_name, self.bucket_name, "unique_path")
-        prefix = self.id
-        data = yield get_counter(key, prefix=prefix)
+        data = yield self._get_path(key)
+        returnValue(data)
+
+    @inlineCallbacks
+    def _get_path(self, key):
+        """
+        Read a path row one page at a time into a nested dictionary of
+        property_id -> event_id -> count.
+        """
+        pager = get_counter_pager(key, prefix=self.id)
         result = defaultdict(dict)
-        for column_id in data:
-            event_id = column_id[0:16]
-            property_id = column_id[16:]
-            result[event_id][property_id] = data[column_id]
+        while not pager.exhausted:
+            data = yield pager.next_page()
+            nest_path(data, result)
         returnValue(result)
+
+    def add_visitor(self, visitor_id, property_ids, batch, timestamp=None):
+        """
+        Add a visitor to the event's HyperLogLog sketches of all time and of
+        the day, overall and per property. The day is counted in the
+        sketch_day counter row of batch so that its sketches can be found.
+        Does nothing unless cassandra.SKETCHES is set.
+        """
+        if cassandra.SKETCHES is None:
+            return
+        day = format_day(timestamp or time.time())
+        keys = (
+            (self.user_name, self.bucket_name, "visitor_sketch"),
+            (self.user_name, self.bucket_name, "visitor_sketch", day))
+        for key in keys:
+            cassandra.SKETCHES.add(key, self.id + self.id, visitor_id)
+            for property_id in property_ids:
+                cassandra.SKETCHES.add(key, self.id + property_id, visitor_id)
+        batch.add(
+            (self.user_name, self.bucket_name, "sketch_day"),
+            column_id=day)
+
+    @classmethod
+    @inlineCallbacks
+    def get_unique_visitors(cls, user_name, bucket_name, event_ids,
+            days=None):
+        """
+        Get approximate unique visitor counts of several events from their
+        HyperLogLog sketches. Returns a dictionary of event_id ->
+        property_id -> count and a dictionary of event_id -> day ->
+        property_id -> count for days with visitors. Nothing is read
+        unless cassandra.SKETCHES is set.
+        """
+        if cassandra.SKETCHES is None:
+            returnValue((
+                dict([(x, {}) for x in event_ids]),
+                dict([(x, {}) for x in event_ids])))
+        days = days or []
+        key = (user_name, bucket_name, "visitor_sketch")
+        keys = [key] + [key + (day,) for day in days]
+        data = yield multiget_slices(
+            [(x, event_id) for x in keys for event_id in event_ids],
+            "relation")
+        unique_visitors = {}
+        daily_unique_visitors = {}
+        for event_id in event_ids:
+            unique_visitors[event_id] = count_sketches(data[(key, event_id)])
+            daily_unique_visitors[event_id] = {}
+            for day in days:
+                counts = count_sketches(data[(key + (day,), event_id)])
+                if counts:
+                    daily_unique_visitors[event_id][day] = counts
+        returnValue((unique_visitors, daily_unique_visitors))
+
+    @classmethod
+    @inlineCallbacks
+    def get_totals(cls, user_name, bucket_name, event_ids, periods=None):
+        """
+        Get the total and unique total counts of several events
+        concurrently, summed over the rows of periods if given. Returns
+        dictionaries of event_id -> total data.
+        """
+        keys = (
+            (user_name, bucket_name, "event"),
+            (user_name, bucket_name, "unique_event"))
+        suffixes = periods or [()]
+        data = yield multiget_slices(
+            [(key + x, event_id) \
+                for key in keys for x in suffixes for event_id in event_ids],
+            "counter")
+        totals = {}
+        unique_totals = {}
+        for event_id in event_ids:
+            totals[event_id] = sum_columns(
+                [data[(keys[0] + x, event_id)] for x in suffixes])
+            unique_totals[event_id] = sum_columns(
+                [data[(keys[1] + x, event_id)] for x in suffixes])
+        returnValue((totals, unique_totals))
+
+    @classmethod
+    @inlineCallbacks
+    def get_paths(cls, user_name, bucket_name, event_ids, periods=None):
+        """
+        Get the paths and unique paths of several events concurrently,
+        summed over the rows of periods if given. Returns dictionaries of
+        event_id -> path data.
+        """
+        keys = (
+            (user_name, bucket_name, "path"),
+            (user_name, bucket_name, "unique_path"))
+        suffixes = periods or [()]
+        data = yield multiget_slices(
+            [(key + x, event_id) \
+                for key in keys for x in suffixes for event_id in event_ids],
+            "counter")
+        paths = {}
+        unique_paths = {}
+        for event_id in event_ids:
+            paths[event_id] = nest_path(sum_columns(
+                [data[(keys[0] + x, event_id)] for x in suffixes]))
+            unique_paths[event_id] = nest_path(sum_columns(
+                [data[(keys[1] + x, event_id)] for x in suffixes]))
+        returnValue((paths, unique_paths))
+
+    @classmethod
+    @inlineCallbacks
+    def get_path_columns(cls, user_name, bucket_name, column_ids,
+            periods=None):
+        """
+        Get specific new_event_id + property_id + event_id path and unique
+        path columns, summed over the rows of periods if given. Returns
+        nested dictionaries of new_event_id -> property_id -> event_id ->
+        count.
+        """
+        keys = (
+            (user_name, bucket_name, "path"),
+            (user_name, bucket_name, "unique_path"))
+        suffixes = periods or [()]
+        data = yield multiget_columns(
+            [key + x for key in keys for x in suffixes],
+            "counter",
+            column_ids)
+        paths = defaultdict(lambda: defaultdict(dict))
+        unique_paths = defaultdict(lambda: defaultdict(dict))
+        for result, key in ((paths, keys[0]), (unique_paths, keys[1])):
+            columns = sum_columns([data[key + x] for x in suffixes])
+            for column_id, value in columns.iteritems():
+                new_event_id = column_id[0:16]
+                property_id = column_id[16:32]
+                event_id = column_id[32:]
+                result[new_event_id][property_id][event_id] = value
+        returnValue((paths, unique_paths))
@@ -9,7 +9,9 @@ import ujson
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..lib.hash import pack_hash
 from ..lib.cassandra import insert_relation, get_counter, pack_timestamp, \
-    insert_relation_by_id
+    insert_relation_by_id, multiget_slice
+from .registry import is_known, add_known
+from .event import sum_columns
 
 
 class PropertyValueModel(object):
@@ -32,8 +34,11 @@ class PropertyValueModel(object):
     @inlineCallbacks
     def create(self):
         """
-        Create property in a bucket.
+        Create property in a bucket. Skipped if this process has already
+        stored it.
         """
+        if is_known(self.user_name, self.bucket_name, self.id):
+            return
         key = (self.user_name, self.bucket_name, "property")
         column = (
             self.user_name,
@@ -43,6 +48,7 @@ class PropertyValueModel(object):
             self.property_value)
         value = ujson.dumps((self.property_name, self.property_value))
         yield insert_relation(key, column, value)
+        add_known(self.user_name, self.bucket_name, self.id)
 
     def get_name_and_value(self):
         """
@@ -61,11 +67,18 @@ class PropertyValueModel(object):
         yield insert_relation_by_id(key, column_id, value)
 
     @inlineCallbacks
-    def get_total(self):
+    def get_total(self, periods=None):
         """
-        Get the events associated with this property.
+        Get the events associated with this property, summed over the rows
+        of periods if given.
         """
         key = (self.user_name, self.bucket_name, "property")
         prefix = self.id
-        data = yield get_counter(key, prefix=prefix)
-        returnValue(data)
+        if not periods:
+            data = yield get_counter(key, prefix=prefix)
+            returnValue(data)
+        data = yield multiget_slice(
+            [key + x for x in periods],
+            "counter",
+            prefix=prefix)
+        returnValue(sum_columns(data.values()))
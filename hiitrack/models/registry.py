@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Registry of events and properties whose metadata this process has stored.
+"""
+
+from ..lib.cache import LRUCache
+
+# Process-local cache of (user_name, bucket_name, entity id) -> True. Entries
+# expire so that buckets deleted by another process are eventually rewritten.
+KNOWN = LRUCache(size=100000, ttl=600)
+
+
+def configure_registry(size, ttl=None):
+    """
+    Replace the registry, holding at most size ids.
+    """
+    global KNOWN
+    KNOWN = LRUCache(size=size, ttl=ttl)
+
+
+def is_known(user_name, bucket_name, entity_id):
+    """
+    Return True if the entity's metadata has been stored.
+    """
+    return (user_name, bucket_name, entity_id) in KNOWN
+
+
+def add_known(user_name, bucket_name, entity_id):
+    """
+    Record that the entity's metadata has been stored.
+    """
+    KNOWN.set((user_name, bucket_name, entity_id), True)
+
+
+def invalidate_bucket(user_name, bucket_name):
+    """
+    Forget the entities of a bucket.
+    """
+    KNOWN.delete_matching(lambda key: key[0:2] == (user_name, bucket_name))
@@ -10,10 +10,14 @@ from twisted.internet.defer import inlineCallbacks, returnValue
 from telephus.cassandra.c08.ttypes import NotFoundException
 from ..lib.cassandra import get_relation, insert_relation, delete_relation, \
     get_user, set_user, delete_user
+from ..lib.cache import LRUCache
 from ..exceptions import HTTPAuthenticationRequired
 from ..models import BucketModel
 from hashlib import sha1
 
+# Process-local cache of user_name -> verified password hash.
+CREDENTIAL_CACHE = LRUCache(size=10000, ttl=300)
+
 def user_authorize(method):
     """
     Decorator.
@@ -60,10 +64,18 @@ class UserModel(object):
     @inlineCallbacks
     def validate_password(self, password):
         """
-        Returns the password associated with the username.
+        Returns whether password is valid for the username. Verified
+        password hashes are cached, so repeated requests do not read the
+        user CF.
         """
-        _password_hash = yield get_user(self.user_name, "hash")
-        returnValue(_password_hash == password_hash(self.user_name, password))
+        _password_hash = password_hash(self.user_name, password)
+        if CREDENTIAL_CACHE.get(self.user_name) == _password_hash:
+            returnValue(True)
+        stored_password_hash = yield get_user(self.user_name, "hash")
+        if stored_password_hash != _password_hash:
+            returnValue(False)
+        CREDENTIAL_CACHE.set(self.user_name, _password_hash)
+        returnValue(True)
 
     @inlineCallbacks
     def create(self, password):
@@ -74,6 +86,7 @@ class UserModel(object):
             self.user_name, 
             "hash", 
             password_hash(self.user_name, password))
+        CREDENTIAL_CACHE.delete(self.user_name)
 
     @inlineCallbacks
     def get_buckets(self):
@@ -84,7 +97,7 @@ class UserModel(object):
         data = yield get_relation(key)
         result = {}
         for key, value in data.items():
-            name, description = ujson.loads(value)
+            name, description = ujson.loads(value)[0:2]
             result[name] = {
                 "id": key,
                 "description": description}
@@ -99,3 +112,4 @@ class UserModel(object):
         for bucket_name in buckets:
             yield BucketModel(self.user_name, bucket_name).delete()
         yield delete_user(self.user_name)
+        CREDENTIAL_CACHE.delete(self.user_name)
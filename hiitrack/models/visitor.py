@@ -5,11 +5,247 @@
 Visitors are stored in buckets and can have properties and events.
 """
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+import os
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    gatherResults
+from twisted.python import log
 from ..lib.hash import pack_hash
-from ..lib.cassandra import get_relation, get_counter, increment_counter
+from ..lib.cassandra import get_relation, get_counter, increment_counter, \
+    get_counter_pager, multiget_slice, insert_relation_by_id, \
+    pack_timestamp, unpack_timestamp, SlicePager
+from ..lib.cache import LRUCache
+from ..lib.bloom import ScalableBloomFilter
 from collections import defaultdict
 
+# Optional process-local LRUCache of (user_name, bucket_name, visitor id) ->
+# VisitorState, bounded by the number of ids held. Only consistent when all
+# hits for a visitor reach the same process.
+VISITOR_CACHE = None
+# Optional VisitorFilters. Buckets with the visitor_filter setting skip
+# reading visitors that are definitely new. Only consistent when all hits
+# for the bucket reach the same process.
+VISITOR_FILTERS = None
+
+
+def configure_cache(size, ttl=None):
+    """
+    Enable the visitor state cache, holding at most size ids.
+    """
+    global VISITOR_CACHE
+    if size:
+        VISITOR_CACHE = LRUCache(size=size, ttl=ttl, weigh=len)
+    else:
+        VISITOR_CACHE = None
+
+
+def configure_filters(path=None, capacity=10000, error_rate=0.001):
+    """
+    Enable visitor filters, checkpointed to the directory path if given.
+    """
+    global VISITOR_FILTERS
+    VISITOR_FILTERS = VisitorFilters(
+        path=path,
+        capacity=capacity,
+        error_rate=error_rate)
+
+
+def invalidate_bucket(user_name, bucket_name):
+    """
+    Remove cached visitor states and the visitor filter belonging to a
+    bucket.
+    """
+    if VISITOR_CACHE is not None:
+        VISITOR_CACHE.delete_matching(
+            lambda key: key[0:2] == (user_name, bucket_name))
+    if VISITOR_FILTERS is not None:
+        VISITOR_FILTERS.invalidate_bucket(user_name, bucket_name)
+
+
+class VisitorFilters(object):
+    """
+    Per bucket ScalableBloomFilters of the ids of visitors with events or
+    properties. A bucket's filter is loaded from its checkpoint, which is
+    then removed, or built by scanning the bucket's visitor_event and
+    visitor_property rows. Filters are checkpointed when stopped. A
+    checkpoint left by a process that did not stop cleanly would miss
+    visitors, so filters are rebuilt instead.
+    """
+
+    def __init__(self, path=None, capacity=10000, error_rate=0.001):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = {}
+        self.building = {}
+
+    def _checkpoint_path(self, key):
+        """
+        Return the checkpoint path of a bucket's filter.
+        """
+        file_name = "%s.bloom" % pack_hash(key).encode("hex")
+        return os.path.join(self.path, file_name)
+
+    def might_contain(self, user_name, bucket_name, visitor_id):
+        """
+        Return False if the visitor definitely has no events or properties.
+        """
+        key = (user_name, bucket_name)
+        if key in self.building:
+            return True
+        if key not in self.filters and not self._load(key):
+            self._build(key)
+            return True
+        return visitor_id in self.filters[key]
+
+    def add(self, user_name, bucket_name, visitor_id):
+        """
+        Add a visitor to the bucket's filter, if it has one.
+        """
+        bloom_filter = self.filters.get((user_name, bucket_name))
+        if bloom_filter is not None:
+            bloom_filter.add(visitor_id)
+
+    def _load(self, key):
+        """
+        Load and remove a bucket's checkpoint. Returns True on success.
+        """
+        if not self.path:
+            return False
+        path = self._checkpoint_path(key)
+        try:
+            with open(path, "rb") as checkpoint:
+                data = checkpoint.read()
+            os.remove(path)
+            self.filters[key] = ScalableBloomFilter.loads(data)
+        except (IOError, OSError):
+            return False
+        except Exception:
+            log.err()
+            return False
+        return True
+
+    def _build(self, key):
+        """
+        Start building a bucket's filter. Visitors added while it is built
+        are added to it too.
+        """
+        bloom_filter = ScalableBloomFilter(self.capacity, self.error_rate)
+        self.filters[key] = bloom_filter
+        deferred = self._scan(key, bloom_filter)
+        self.building[key] = deferred
+
+        def built(result):
+            if self.building.get(key) is deferred:
+                del self.building[key]
+
+        def failed(error):
+            log.err(error)
+            if self.building.get(key) is deferred:
+                del self.building[key]
+                del self.filters[key]
+
+        deferred.addCallbacks(built, failed)
+
+    @inlineCallbacks
+    def _scan(self, key, bloom_filter):
+        """
+        Add the ids of visitors stored in the bucket to bloom_filter.
+        """
+        rows = [
+            (key + ("visitor_event",), "counter"),
+            (key + ("visitor_property",), "relation")]
+        for row_key, column_family in rows:
+            pager = SlicePager(row_key, column_family)
+            while not pager.exhausted:
+                page = yield pager.next_page()
+                for column_id in page:
+                    bloom_filter.add(column_id[0:16])
+
+    def invalidate_bucket(self, user_name, bucket_name):
+        """
+        Remove a bucket's filter and checkpoint.
+        """
+        key = (user_name, bucket_name)
+        self.filters.pop(key, None)
+        self.building.pop(key, None)
+        if self.path:
+            try:
+                os.remove(self._checkpoint_path(key))
+            except OSError:
+                pass
+
+    def stop(self):
+        """
+        Checkpoint the filters that are fully built.
+        """
+        if not self.path:
+            return
+        for key, bloom_filter in self.filters.items():
+            if key in self.building:
+                continue
+            path = self._checkpoint_path(key)
+            temp_path = "%s.tmp" % path
+            with open(temp_path, "wb") as checkpoint:
+                checkpoint.write(bloom_filter.dumps())
+                checkpoint.flush()
+                os.fsync(checkpoint.fileno())
+            os.rename(temp_path, path)
+
+
+class VisitorState(object):
+    """
+    Event totals, event path, property ids, and event times of a visitor.
+    Event times are only recorded in buckets with path settings.
+    """
+
+    __slots__ = ("event_totals", "path", "property_ids", "event_times")
+
+    def __init__(self, event_totals, path, property_ids, event_times=None):
+        self.event_totals = dict(event_totals)
+        self.path = defaultdict(dict, path)
+        self.property_ids = set(property_ids)
+        self.event_times = dict(event_times or {})
+
+    def __len__(self):
+        return len(self.event_totals) + len(self.property_ids) + \
+            len(self.event_times) + sum([len(x) for x in self.path.values()])
+
+    def recent_event_ids(self, timestamp, limit=None, window=None):
+        """
+        Return ids of the visitor's events last seen within window seconds
+        of timestamp, limited to the most recent limit. Events without a
+        recorded time count as the oldest.
+        """
+        event_ids = self.event_totals.keys()
+        if window:
+            event_ids = [x for x in event_ids \
+                if self.event_times.get(x, 0) >= timestamp - window]
+        if limit and len(event_ids) > limit:
+            event_ids.sort(key=lambda x: self.event_times.get(x, 0))
+            event_ids = event_ids[-limit:]
+        return event_ids
+
+    def add_event(self, new_event_id, event_ids=None, timestamp=None):
+        """
+        Apply the increments recording new_event_id makes. Paths are added
+        from event_ids, by default all of the visitor's events.
+        """
+        if event_ids is None:
+            event_ids = self.event_totals
+        path = self.path[new_event_id]
+        for event_id in event_ids:
+            path[event_id] = path.get(event_id, 0) + 1
+        self.event_totals[new_event_id] = \
+            self.event_totals.get(new_event_id, 0) + 1
+        if timestamp is not None:
+            self.event_times[new_event_id] = timestamp
+
+    def add_property(self, property_id):
+        """
+        Apply adding property_id to the visitor.
+        """
+        self.property_ids.add(property_id)
+
 
 class VisitorModel(object):
     """
@@ -21,6 +257,76 @@ class VisitorModel(object):
         self.bucket_name = bucket_name
         self.id = pack_hash((user_name, bucket_name, visitor_id))
 
+    @inlineCallbacks
+    def get_state(self, filtered=False):
+        """
+        Return the visitor's VisitorState, from the cache if possible. If
+        filtered, visitors missing from the bucket's visitor filter are
+        new and are not read.
+        """
+        cache_key = (self.user_name, self.bucket_name, self.id)
+        if VISITOR_CACHE is not None:
+            state = VISITOR_CACHE.get(cache_key)
+            if state is not None:
+                returnValue(state)
+        if filtered and VISITOR_FILTERS is not None and \
+                not VISITOR_FILTERS.might_contain(
+                    self.user_name,
+                    self.bucket_name,
+                    self.id):
+            returnValue(VisitorState({}, {}, []))
+        state = yield self.load_state()
+        if VISITOR_CACHE is not None:
+            VISITOR_CACHE.set(cache_key, state)
+        returnValue(state)
+
+    @inlineCallbacks
+    def load_state(self):
+        """
+        Read the visitor's VisitorState. The visitor_event and visitor_path
+        counter rows are read with one multiget, concurrently with a
+        multiget of the visitor_property and visitor_event_time relation
+        rows.
+        """
+        total_key = (self.user_name, self.bucket_name, "visitor_event")
+        path_key = (self.user_name, self.bucket_name, "visitor_path")
+        property_key = (self.user_name, self.bucket_name, "visitor_property")
+        time_key = (self.user_name, self.bucket_name, "visitor_event_time")
+        counters, relations = yield gatherResults(
+            [multiget_slice([total_key, path_key], "counter", prefix=self.id),
+            multiget_slice([property_key, time_key], "relation",
+                prefix=self.id)],
+            consumeErrors=True)
+        path = defaultdict(dict)
+        for column_id, value in counters[path_key].iteritems():
+            path[column_id[0:16]][column_id[16:]] = value
+        event_times = dict([(k, unpack_timestamp(v)) \
+            for k, v in relations[time_key].iteritems()])
+        returnValue(VisitorState(
+            counters[total_key],
+            path,
+            relations[property_key].keys(),
+            event_times))
+
+    def update_state(self, state):
+        """
+        Store a state changed by this process' writes in the cache, and add
+        the visitor to the bucket's visitor filter.
+        """
+        if VISITOR_FILTERS is not None:
+            VISITOR_FILTERS.add(self.user_name, self.bucket_name, self.id)
+        if VISITOR_CACHE is not None:
+            cache_key = (self.user_name, self.bucket_name, self.id)
+            VISITOR_CACHE.set(cache_key, state)
+
+    def invalidate_state(self):
+        """
+        Remove the visitor's cached state, after writes recorded in it
+        failed.
+        """
+        if VISITOR_CACHE is not None:
+            VISITOR_CACHE.delete((self.user_name, self.bucket_name, self.id))
+
     @inlineCallbacks
     def get_property_ids(self):
         """
@@ -42,13 +348,22 @@ class VisitorModel(object):
         returnValue(data.keys())
 
     @inlineCallbacks
-    def increment_path(self, event_id, new_event_id):
+    def increment_path(self, event_id, new_event_id, batch=None):
         """
         Increment the path of visitor events from event_id -> new_event_id.
         """
         key = (self.user_name, self.bucket_name, "visitor_path")
         column_id = "".join([self.id, new_event_id, event_id])
-        yield increment_counter(key, column_id=column_id)
+        yield increment_counter(key, column_id=column_id, batch=batch)
+
+    @inlineCallbacks
+    def set_event_time(self, event_id, timestamp):
+        """
+        Record when the visitor last sent event_id.
+        """
+        key = (self.user_name, self.bucket_name, "visitor_event_time")
+        column_id = "".join([self.id, event_id])
+        yield insert_relation_by_id(key, column_id, pack_timestamp(timestamp))
 
     @inlineCallbacks
     def get_path(self):
@@ -56,23 +371,24 @@ class VisitorModel(object):
         Get the path of visitor events.
         """
         key = (self.user_name, self.bucket_name, "visitor_path")
-        prefix = self.id
-        data = yield get_counter(key, prefix=prefix)
+        pager = get_counter_pager(key, prefix=self.id)
         result = defaultdict(dict)
-        for column_id in data:
-            new_event_id = column_id[0:16]
-            event_id = column_id[16:]
-            result[new_event_id][event_id] = data[column_id]
+        while not pager.exhausted:
+            data = yield pager.next_page()
+            for column_id in data:
+                new_event_id = column_id[0:16]
+                event_id = column_id[16:]
+                result[new_event_id][event_id] = data[column_id]
         returnValue(result)
 
     @inlineCallbacks
-    def increment_total(self, event_id):
+    def increment_total(self, event_id, batch=None):
         """
         Increment the count of visitor events.
         """
         key = (self.user_name, self.bucket_name, "visitor_event")
         column_id = "".join([self.id, event_id])
-        yield increment_counter(key, column_id=column_id)
+        yield increment_counter(key, column_id=column_id, batch=batch)
 
     @inlineCallbacks
     def get_total(self):
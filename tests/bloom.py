@@ -0,0 +1,60 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hiitrack.lib.bloom import BloomFilter, ScalableBloomFilter
+import os
+
+
+def ids(count):
+    return [os.urandom(16) for _ in range(count)]
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def false_positive_rate(self, bloom_filter, count=20000):
+        return sum([x in bloom_filter for x in ids(count)]) / float(count)
+
+    def test_bloom_filter(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        added = ids(1000)
+        for key in added:
+            bloom_filter.add(key)
+        self.assertEqual(bloom_filter.count, 1000)
+        self.assertEqual(len(bloom_filter.bits) * 8, bloom_filter.size)
+        self.assertTrue(all([x in bloom_filter for x in added]))
+        self.assertTrue(
+            self.false_positive_rate(bloom_filter, 50000) < 0.012)
+
+    def test_scalable_bloom_filter(self):
+        bloom_filter = ScalableBloomFilter(1000, 0.01)
+        self.assertFalse(ids(1)[0] in bloom_filter)
+        added = ids(8000)
+        for key in added:
+            bloom_filter.add(key)
+        self.assertTrue(all([x in bloom_filter for x in added]))
+        self.assertEqual(
+            [x.capacity for x in bloom_filter.filters],
+            [1000, 2000, 4000, 8000])
+        # Ids that may already be present are not added again.
+        self.assertTrue(7900 < len(bloom_filter) <= 8000)
+        self.assertTrue(
+            self.false_positive_rate(bloom_filter, 50000) < 0.012)
+
+    def test_serialize(self):
+        bloom_filter = ScalableBloomFilter(100, 0.01)
+        added = ids(300)
+        for key in added:
+            bloom_filter.add(key)
+        loaded = ScalableBloomFilter.loads(bloom_filter.dumps())
+        self.assertEqual(loaded.capacity, 100)
+        self.assertEqual(loaded.error_rate, 0.01)
+        self.assertEqual(len(loaded), len(bloom_filter))
+        self.assertEqual(
+            [(x.capacity, x.error_rate, x.count, x.bits)
+                for x in loaded.filters],
+            [(x.capacity, x.error_rate, x.count, x.bits)
+                for x in bloom_filter.filters])
+        self.assertTrue(all([x in loaded for x in added]))
+        loaded = ScalableBloomFilter.loads(ScalableBloomFilter().dumps())
+        self.assertEqual(loaded.filters, [])
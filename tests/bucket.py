@@ -5,8 +5,10 @@ from twisted.trial import unittest
 from twisted.internet.defer import inlineCallbacks
 from lib.agent import request
 from hiitrack import HiiTrack
+from hiitrack.lib import dispatcher
 import uuid
 import ujson
+import zlib
 
 class BucketTestCase(unittest.TestCase):
     
@@ -117,4 +119,94 @@ class BucketTestCase(unittest.TestCase):
             username=self.username,
             password=self.password)        
         self.assertEqual(result.code, 404)
-    
\ No newline at end of file
+    
+    @inlineCallbacks
+    def test_settings(self):
+        BUCKETNAME = uuid.uuid4().hex
+        DESCRIPTION = uuid.uuid4().hex
+        result = yield request(
+            "PUT",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password,
+            data={"description":DESCRIPTION, "path_limit":"x"})
+        self.assertEqual(result.code, 403)
+        result = yield request(
+            "PUT",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password,
+            data={"description":DESCRIPTION, "path_limit":"-1"})
+        self.assertEqual(result.code, 403)
+        result = yield request(
+            "PUT",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password,
+            data={"description":DESCRIPTION, "path_limit":"1"})
+        self.assertEqual(result.code, 201)
+        for event_name in ["a", "b", "c"]:
+            result = yield request(
+                "POST",
+                "%s/%s/event/%s" % (self.url, BUCKETNAME, event_name),
+                data={"visitor_id":"visitor"})
+            self.assertEqual(result.code, 200)
+        result = yield request(
+            "GET",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
+        data = ujson.decode(result.body)
+        self.assertEqual(data["settings"]["path_limit"], 1)
+        self.assertEqual(data["stats"]["truncated_hits"], 1)
+        result = yield request(
+            "DELETE",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
+
+    @inlineCallbacks
+    def test_compression(self):
+        BUCKETNAME = uuid.uuid4().hex
+        DESCRIPTION = uuid.uuid4().hex
+        result = yield request(
+            "PUT",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password,
+            data={"description":DESCRIPTION})
+        self.assertEqual(result.code, 201)
+        result = yield request(
+            "GET",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password,
+            headers={"Accept-Encoding":["gzip"]})
+        self.assertEqual(result.code, 200)
+        self.assertFalse(result.headers.hasHeader("content-encoding"))
+        data = ujson.decode(result.body)
+        dispatcher.COMPRESSION_MIN_SIZE = 0
+        try:
+            result = yield request(
+                "GET",
+                "%s/%s" % (self.url, BUCKETNAME),
+                username=self.username,
+                password=self.password,
+                headers={"Accept-Encoding":["gzip"]})
+        finally:
+            dispatcher.COMPRESSION_MIN_SIZE = 1024
+        self.assertEqual(result.code, 200)
+        self.assertEqual(
+            result.headers.getRawHeaders("content-encoding"),
+            ["gzip"])
+        self.assertEqual(
+            ujson.decode(zlib.decompress(result.body, 16 + zlib.MAX_WBITS)),
+            data)
+        result = yield request(
+            "DELETE",
+            "%s/%s" % (self.url, BUCKETNAME),
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
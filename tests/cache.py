@@ -0,0 +1,110 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.task import Clock
+from hiitrack.lib.cache import LRUCache
+
+
+class LRUCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.clock = Clock()
+
+    def test_lru(self):
+        cache = LRUCache(size=2)
+        cache.set("a", 1)
+        cache.set("b", 2)
+        self.assertEqual(cache.get("a"), 1)
+        cache.set("c", 3)
+        # b was used least recently.
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        self.assertEqual(cache.get("c"), 3)
+        cache.set("a", 4)
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.get("a"), 4)
+        cache.delete("a")
+        cache.delete("a")
+        self.assertEqual(cache.get("a", 5), 5)
+
+    def test_weight(self):
+        cache = LRUCache(size=10, weigh=len)
+        cache.set("a", "x" * 4)
+        cache.set("b", "x" * 4)
+        self.assertEqual(cache.weight, 8)
+        cache.get("a")
+        cache.set("c", "x" * 4)
+        # b is evicted, a and c fit.
+        self.assertEqual(sorted(cache.data.keys()), ["a", "c"])
+        self.assertEqual(cache.weight, 8)
+        # Replacing an entry replaces its weight.
+        cache.set("a", "x")
+        self.assertEqual(cache.weight, 5)
+        cache.set("d", "x" * 6)
+        self.assertEqual(sorted(cache.data.keys()), ["a", "d"])
+        self.assertEqual(cache.weight, 7)
+        self.assertEqual(cache.evictions, 2)
+        # An entry heavier than the cache is not kept.
+        cache.set("e", "x" * 11)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.weight, 0)
+
+    def test_ttl(self):
+        cache = LRUCache(size=10, ttl=60, clock=self.clock.seconds)
+        cache.set("a", 1)
+        cache.set("b", 2, ttl=5)
+        self.clock.advance(5)
+        self.assertEqual(cache.get("b"), 2)
+        self.clock.advance(1)
+        self.assertEqual(cache.get("b"), None)
+        self.assertEqual(cache.get("a"), 1)
+        # Reading an entry does not extend it.
+        self.clock.advance(55)
+        self.assertEqual(cache.get("a"), None)
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.weight, 0)
+        cache = LRUCache(size=10, clock=self.clock.seconds)
+        cache.set("a", 1)
+        self.clock.advance(10 ** 6)
+        self.assertEqual(cache.get("a"), 1)
+
+    def test_negative(self):
+        cache = LRUCache(size=10, ttl=60, clock=self.clock.seconds)
+        cache.set("a", False, ttl=5)
+        cache.set("b", (False, None))
+        self.assertIdentical(cache.get("a"), False)
+        self.assertEqual(cache.get("b"), (False, None))
+        self.assertTrue("a" in cache)
+        self.assertFalse("c" in cache)
+        self.clock.advance(6)
+        self.assertIdentical(cache.get("a"), None)
+        self.assertEqual(cache.get("b"), (False, None))
+
+    def test_delete_matching(self):
+        cache = LRUCache(size=10)
+        for key in [("u", "a", 1), ("u", "a", 2), ("u", "b", 1)]:
+            cache.set(key, 1)
+        cache.delete_matching(lambda key: key[0:2] == ("u", "a"))
+        self.assertEqual(cache.data.keys(), [("u", "b", 1)])
+        self.assertEqual(cache.weight, 1)
+        cache.clear()
+        self.assertEqual(len(cache), 0)
+        self.assertEqual(cache.weight, 0)
+
+    def test_stats(self):
+        cache = LRUCache(size=2, ttl=5, clock=self.clock.seconds)
+        cache.set("a", 1)
+        cache.get("a")
+        cache.get("b")
+        self.clock.advance(6)
+        cache.get("a")
+        cache.set("a", 1)
+        cache.set("b", 1)
+        cache.set("c", 1)
+        self.assertEqual(cache.stats(), {
+            "entries": 2,
+            "weight": 2,
+            "hits": 1,
+            "misses": 2,
+            "evictions": 1})
@@ -0,0 +1,369 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue, succeed, \
+    fail, Deferred
+from twisted.internet.task import Clock
+from telephus.cassandra.c08.ttypes import ColumnOrSuperColumn, CounterColumn
+from hiitrack.lib import cassandra
+from hiitrack.lib.cassandra import CounterBatch, CounterBuffer, SlicePager, \
+    ShardedPager, multiget_slice, shard_key, shard_keys, sum_shards
+from hiitrack.lib.hash import pack_hash
+from collections import defaultdict
+import uuid
+
+
+class StubClient(object):
+    """
+    In-memory stand-in for the Cassandra client, holding counter rows by
+    packed key.
+    """
+
+    def __init__(self):
+        self.rows = defaultdict(dict)
+        self.calls = []
+        self.pending = None
+
+    def store(self, key, columns):
+        self.rows[pack_hash(key)].update(columns)
+
+    def batch_mutate(self, mutationmap, consistency=None):
+        self.calls.append(("batch_mutate", mutationmap))
+        for key, mutations in mutationmap.iteritems():
+            row = self.rows[key]
+            for mutation in mutations["counter"]:
+                column = mutation.column_or_supercolumn.counter_column
+                row[column.name] = row.get(column.name, 0) + column.value
+        if self.pending is not None:
+            deferred = Deferred()
+            self.pending.append(deferred)
+            return deferred
+        return succeed(None)
+
+    def _slice(self, key, start, finish, count, names):
+        row = self.rows.get(key, {})
+        if names is not None:
+            names = sorted([x for x in names if x in row])
+        else:
+            names = sorted([x for x in row
+                if x >= start and (not finish or x <= finish)])[0:count]
+        return [ColumnOrSuperColumn(counter_column=CounterColumn(
+            name=x,
+            value=row[x])) for x in names]
+
+    def get_slice(self, key, column_family, start="", finish="", count=100,
+            consistency=None):
+        self.calls.append(("get_slice", key, start, count))
+        return succeed(self._slice(key, start, finish, count, None))
+
+    def multiget_slice(self, keys, column_family, start="", finish="",
+            count=100, names=None, consistency=None):
+        self.calls.append(("multiget_slice", keys))
+        return succeed(dict([(x, self._slice(x, start, finish, count, names))
+            for x in keys]))
+
+    def called(self, method):
+        return [x for x in self.calls if x[0] == method]
+
+
+class CounterBatchTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubClient()
+        self.patch(cassandra, "CLIENT", self.client)
+        self.key = ("user", "bucket", "visitor_event")
+
+    def mutation_sizes(self):
+        return [sum([len(x["counter"]) for x in call[1].values()])
+            for call in self.client.called("batch_mutate")]
+
+    @inlineCallbacks
+    def test_sum(self):
+        batch = CounterBatch()
+        batch.add(self.key, column_id="a")
+        batch.add(self.key, column_id="a", value=2)
+        batch.add(self.key, column=("b",))
+        batch.add(self.key + ("x",), column_id="a")
+        self.assertEqual(len(batch), 3)
+        self.assertRaises(TypeError, batch.add, self.key)
+        other = CounterBatch()
+        other.add(self.key, column_id="a")
+        other.add(self.key, column_id="c", value=-1)
+        batch.merge(other)
+        self.assertEqual(len(batch), 4)
+        yield batch.write()
+        self.assertEqual(len(batch), 0)
+        self.assertEqual(self.mutation_sizes(), [4])
+        self.assertEqual(self.client.rows[pack_hash(self.key)], {
+            "a": 4,
+            pack_hash(("b",)): 1,
+            "c": -1})
+        self.assertEqual(
+            self.client.rows[pack_hash(self.key + ("x",))],
+            {"a": 1})
+        yield batch.write()
+        self.assertEqual(self.mutation_sizes(), [4])
+
+    @inlineCallbacks
+    def test_chunks(self):
+        batch = CounterBatch(size=2)
+        for column_id in "abcde":
+            batch.add(self.key, column_id=column_id)
+        # Increments summing to zero are not sent.
+        batch.add(self.key, column_id="f", value=0)
+        batch.add(self.key + ("x",), column_id="a", value=-1)
+        batch.add(self.key + ("x",), column_id="a", value=1)
+        self.assertEqual(len(batch), 7)
+        yield batch.write()
+        self.assertEqual(self.mutation_sizes(), [2, 2, 1])
+        self.assertEqual(
+            self.client.rows[pack_hash(self.key)],
+            dict([(x, 1) for x in "abcde"]))
+        self.assertFalse(pack_hash(self.key + ("x",)) in self.client.rows)
+
+    def test_concurrency(self):
+        self.patch(cassandra, "WRITE_CONCURRENCY", 2)
+        self.client.pending = []
+        batch = CounterBatch(size=1)
+        for column_id in "abcde":
+            batch.add(self.key, column_id=column_id)
+        deferred = batch.write()
+        self.assertEqual(len(self.client.pending), 2)
+        while self.client.pending:
+            self.client.pending.pop(0).callback(None)
+            self.assertTrue(len(self.client.pending) <= 2)
+        self.assertEqual(self.mutation_sizes(), [1] * 5)
+        self.assertTrue(deferred.called)
+
+
+class CounterBufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubClient()
+        self.patch(cassandra, "CLIENT", self.client)
+        self.clock = Clock()
+        self.key = ("user", "bucket", "visitor_event")
+
+    def start(self, **kwargs):
+        buffer = CounterBuffer(**kwargs)
+        buffer.loop.clock = self.clock
+        buffer.start()
+        return buffer
+
+    def written(self):
+        return self.client.rows.get(pack_hash(self.key), {})
+
+    def test_interval(self):
+        buffer = self.start(interval=5)
+        buffer.add(self.key, column_id="a")
+        buffer.add(self.key, column_id="a", value=2)
+        self.clock.advance(4)
+        self.assertEqual(self.client.calls, [])
+        self.clock.advance(1)
+        self.assertEqual(self.written(), {"a": 3})
+        self.assertEqual(len(self.client.called("batch_mutate")), 1)
+        # Nothing pending, nothing written.
+        self.clock.advance(5)
+        self.assertEqual(len(self.client.called("batch_mutate")), 1)
+        buffer.stop()
+
+    def test_size(self):
+        buffer = self.start(interval=5, size=3)
+        buffer.add(self.key, column_id="a")
+        buffer.add(self.key, column_id="a")
+        buffer.add(self.key, column_id="b")
+        self.assertEqual(self.client.calls, [])
+        batch = CounterBatch()
+        batch.add(self.key, column_id="c")
+        buffer.merge(batch)
+        self.assertEqual(self.written(), {"a": 2, "b": 1, "c": 1})
+        buffer.add(self.key, column_id="d")
+        buffer.add(self.key, column_id="e")
+        self.assertEqual(len(self.client.called("batch_mutate")), 1)
+        buffer.add(self.key, column_id="f")
+        self.assertEqual(len(self.client.called("batch_mutate")), 2)
+        self.assertEqual(len(buffer.batch), 0)
+        buffer.stop()
+
+    @inlineCallbacks
+    def test_stop(self):
+        buffer = self.start(interval=5)
+        buffer.add(self.key, column_id="a")
+        yield buffer.stop()
+        self.assertFalse(buffer.loop.running)
+        self.assertEqual(self.written(), {"a": 1})
+        buffer.add(self.key, column_id="b")
+        self.clock.advance(10)
+        self.assertEqual(self.written(), {"a": 1})
+        yield buffer.stop()
+        self.assertEqual(self.written(), {"a": 1, "b": 1})
+
+    @inlineCallbacks
+    def test_failure(self):
+        self.patch(
+            self.client,
+            "batch_mutate",
+            lambda **kwargs: fail(Exception("Unavailable")))
+        buffer = self.start(interval=5)
+        buffer.add(self.key, column_id="a")
+        yield buffer.stop()
+        self.assertEqual(len(self.flushLoggedErrors(Exception)), 1)
+        self.assertEqual(len(buffer.batch), 0)
+
+
+class SlicePagerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubClient()
+        self.patch(cassandra, "CLIENT", self.client)
+        self.key = ("user", "bucket", "event")
+
+    @inlineCallbacks
+    def pages(self, pager):
+        pages = []
+        while not pager.exhausted:
+            page = yield pager.next_page()
+            pages.append(page.keys())
+        returnValue(pages)
+
+    def slices(self):
+        return [x[2:] for x in self.client.called("get_slice")]
+
+    @inlineCallbacks
+    def test_empty(self):
+        pages = yield self.pages(SlicePager(self.key, "counter"))
+        self.assertEqual(pages, [[]])
+        self.assertEqual(len(self.slices()), 1)
+
+    @inlineCallbacks
+    def test_pages(self):
+        self.client.store(self.key, dict([(x, 1) for x in "abcde"]))
+        pager = SlicePager(self.key, "counter", page_size=2)
+        pages = yield self.pages(pager)
+        self.assertEqual(pages, [["a", "b"], ["c", "d"], ["e"]])
+        # Each page after the first starts at, and drops, the last column.
+        self.assertEqual(self.slices(), [("", 2), ("b", 3), ("d", 3)])
+        page = yield pager.next_page()
+        self.assertEqual(page.keys(), [])
+        self.assertEqual(len(self.slices()), 3)
+
+    @inlineCallbacks
+    def test_page_size_multiple(self):
+        self.client.store(self.key, dict([(x, 1) for x in "abcd"]))
+        pages = yield self.pages(SlicePager(self.key, "counter", page_size=2))
+        self.assertEqual(pages, [["a", "b"], ["c", "d"], []])
+
+    @inlineCallbacks
+    def test_prefix(self):
+        self.client.store(self.key, {"pa": 1, "pb": 2, "pc": 3, "qa": 4})
+        pager = SlicePager(self.key, "counter", prefix="p", page_size=2)
+        page = yield pager.next_page()
+        self.assertEqual(page.items(), [("a", 1), ("b", 2)])
+        page = yield pager.next_page()
+        self.assertEqual(page.items(), [("c", 3)])
+        self.assertTrue(pager.exhausted)
+
+    @inlineCallbacks
+    def test_last(self):
+        self.client.store(self.key, dict([(x, 1) for x in "abcde"]))
+        pager = SlicePager(self.key, "counter", page_size=2, last="b")
+        pages = yield self.pages(pager)
+        self.assertEqual(pages, [["c", "d"], ["e"]])
+        self.assertEqual(self.slices(), [("b", 3), ("d", 3)])
+
+
+class MultigetSliceTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubClient()
+        self.patch(cassandra, "CLIENT", self.client)
+        self.patch(cassandra, "PAGE_SIZE", 2)
+        self.keys = [("user", "bucket", "event", str(i)) for i in range(4)]
+        for key, width in zip(self.keys, [0, 1, 2, 5]):
+            self.client.store(key, dict([(x, 1) for x in "abcde"[0:width]]))
+
+    @inlineCallbacks
+    def test_continuation(self):
+        data = yield multiget_slice(self.keys, "counter")
+        self.assertEqual(len(self.client.called("multiget_slice")), 1)
+        self.assertEqual(
+            [data[x].keys() for x in self.keys],
+            [[], ["a"], ["a", "b"], ["a", "b", "c", "d", "e"]])
+        # Only rows filling the first page are continued.
+        self.assertEqual(
+            sorted([x[1:] for x in self.client.called("get_slice")]),
+            sorted([
+                (pack_hash(self.keys[2]), "b", 3),
+                (pack_hash(self.keys[3]), "b", 3),
+                (pack_hash(self.keys[3]), "d", 3)]))
+
+    @inlineCallbacks
+    def test_prefix(self):
+        self.client.store(self.keys[3], {"pa": 1, "pb": 2, "pc": 3})
+        data = yield multiget_slice(self.keys[2:], "counter", prefix="p")
+        self.assertEqual(data[self.keys[2]].items(), [])
+        self.assertEqual(
+            data[self.keys[3]].items(),
+            [("a", 1), ("b", 2), ("c", 3)])
+
+
+class ShardTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = StubClient()
+        self.patch(cassandra, "CLIENT", self.client)
+        self.patch(cassandra, "SHARDS", 4)
+        self.key = ("user", "bucket", "path")
+
+    def test_shard_key(self):
+        keys = shard_keys(self.key)
+        self.assertEqual(len(keys), 4)
+        # Shard 0 is the unsharded row.
+        self.assertEqual(keys[0], self.key)
+        shards = set()
+        for i in range(100):
+            column_id = uuid.uuid4().bytes
+            key = shard_key(self.key, column_id)
+            self.assertEqual(key, shard_key(self.key, column_id))
+            self.assertTrue(key in keys)
+            shards.add(key)
+        self.assertEqual(len(shards), 4)
+        key = ("user", "bucket", "visitor_event")
+        self.assertEqual(shard_key(key, "a"), key)
+        self.assertEqual(shard_keys(key), [key])
+        self.patch(cassandra, "SHARDS", 1)
+        self.assertEqual(shard_key(self.key, "a"), self.key)
+        self.assertEqual(shard_keys(self.key), [self.key])
+
+    def test_sum_shards(self):
+        data = sum_shards([{"a": 1, "c": 2}, {}, {"c": 3, "b": 1}])
+        self.assertEqual(data.items(), [("a", 1), ("b", 1), ("c", 5)])
+
+    @inlineCallbacks
+    def test_multiget_slice(self):
+        keys = shard_keys(self.key)
+        self.client.store(keys[0], {"a": 1, "c": 2})
+        self.client.store(keys[3], {"b": 1, "c": 3})
+        data = yield multiget_slice([self.key], "counter")
+        self.assertEqual(
+            data[self.key].items(),
+            [("a", 1), ("b", 1), ("c", 5)])
+
+    @inlineCallbacks
+    def test_sharded_pager(self):
+        keys = shard_keys(self.key)
+        self.client.store(keys[0], dict([("p" + x, 1) for x in "abcdefgh"]))
+        self.client.store(keys[1], {"pb": 1, "ph": 1, "pz": 1, "qa": 1})
+        self.client.store(keys[3], {"pa": 1, "pg": 1})
+        pager = ShardedPager(self.key, prefix="p", page_size=2)
+        pages = []
+        while not pager.exhausted:
+            page = yield pager.next_page()
+            pages.append(page.items())
+        columns = [x for page in pages for x in page]
+        # Every column is returned once, summed over all shards, in order.
+        self.assertEqual(columns, [
+            ("a", 2), ("b", 2), ("c", 1), ("d", 1), ("e", 1), ("f", 1),
+            ("g", 2), ("h", 2), ("z", 1)])
+        self.assertTrue(len(pages) > 1)
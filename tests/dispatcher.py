@@ -0,0 +1,429 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed, fail
+from twisted.web.test.requesthelper import DummyRequest
+from hiitrack.lib import dispatcher
+from hiitrack.lib.dispatcher import Dispatcher, StreamProducer, STREAMED, \
+    compress, negotiate_encoding
+from hiitrack.lib.serializer import Id, Stream, id_keys
+from hiitrack.lib.b64encode import uri_b64encode
+import ujson
+import zlib
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+class Request(DummyRequest):
+    """
+    DummyRequest holding a push producer and a response code, with a
+    connection that can be lost.
+    """
+
+    producer = None
+    lost = False
+    code = 200
+
+    def setResponseCode(self, code, message=None):
+        DummyRequest.setResponseCode(self, code, message)
+        self.code = code
+
+    def registerProducer(self, producer, streaming):
+        self.producer = producer
+
+    def unregisterProducer(self):
+        self.producer = None
+
+    def loseConnection(self):
+        self.lost = True
+
+
+class Controller(object):
+
+    def user(self, request, user_name):
+        pass
+
+    def bucket(self, request, user_name, bucket_name):
+        pass
+
+    def token(self, request, user_name):
+        pass
+
+    def delete_bucket(self, request, user_name, bucket_name):
+        pass
+
+    def static(self, request):
+        pass
+
+    def any_method(self, request, user_name, bucket_name, name):
+        pass
+
+
+class DispatcherTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.controller = Controller()
+        self.dispatcher = Dispatcher(cache_size=100)
+        routes = [
+            ("/{user_name}", "user", "GET"),
+            ("/{user_name}/{bucket_name}", "bucket", "GET"),
+            ("/{user_name}/token", "token", "GET"),
+            ("/{user_name}/{bucket_name}", "delete_bucket", "DELETE"),
+            ("/a/b/c", "static", "GET"),
+            ("/{user_name}/{bucket_name}/{name}", "any_method", None)]
+        for route, action, method in routes:
+            self.connect(route, action, method)
+
+    def connect(self, route, action, method=None):
+        conditions = None
+        if method:
+            conditions = {"method": method}
+        self.dispatcher.connect(
+            action,
+            route=route,
+            controller=self.controller,
+            action=action,
+            conditions=conditions)
+
+    def test_variables(self):
+        self.assertEqual(
+            self.dispatcher.match("GET", ["u"]),
+            (self.controller.user, {"user_name": "u"}))
+        self.assertEqual(
+            self.dispatcher.match("GET", ["u", "b"]),
+            (self.controller.bucket, {"user_name": "u", "bucket_name": "b"}))
+        self.assertEqual(
+            self.dispatcher.match("DELETE", ["u", "b"]),
+            (self.controller.delete_bucket,
+                {"user_name": "u", "bucket_name": "b"}))
+        self.assertEqual(self.dispatcher.match("POST", ["u", "b"]), None)
+
+    def test_static_precedence(self):
+        self.assertEqual(
+            self.dispatcher.match("GET", ["u", "token"]),
+            (self.controller.token, {"user_name": "u"}))
+        self.assertEqual(
+            self.dispatcher.match("GET", ["a", "b", "c"]),
+            (self.controller.static, {}))
+        # A static segment that leads nowhere falls back to the variable.
+        self.assertEqual(
+            self.dispatcher.match("GET", ["a", "b", "d"]),
+            (self.controller.any_method,
+                {"user_name": "a", "bucket_name": "b", "name": "d"}))
+
+    def test_any_method(self):
+        for method in ["GET", "POST", "PUT", "DELETE"]:
+            self.assertEqual(
+                self.dispatcher.match(method, ["u", "b", "n"]),
+                (self.controller.any_method,
+                    {"user_name": "u", "bucket_name": "b", "name": "n"}))
+
+    def test_empty_segments(self):
+        for segments in [[], [""], ["u", ""], ["", "b"], ["u", "", "n"],
+                ["u", "b", "n", ""], ["u", "b", "n", "x"]]:
+            self.assertEqual(self.dispatcher.match("GET", segments), None)
+
+    def test_cache(self):
+        cache = self.dispatcher._Dispatcher__cache
+        key = ("GET", ("u", "b", "n", "x"))
+        self.assertEqual(self.dispatcher.match("GET", ["u", "b", "n", "x"]),
+            None)
+        # Negative results are cached until a route is connected.
+        self.assertIdentical(cache.get(key), False)
+        self.assertEqual(self.dispatcher.match("GET", ["u", "b", "n", "x"]),
+            None)
+        self.connect("/{user_name}/{bucket_name}/{name}/x", "static", "GET")
+        self.assertIdentical(cache.get(key), None)
+        self.assertEqual(
+            self.dispatcher.match("GET", ["u", "b", "n", "x"]),
+            (self.controller.static, {
+                "user_name": "u",
+                "bucket_name": "b",
+                "name": "n"}))
+        self.assertEqual(
+            self.dispatcher.match("GET", ["u"]),
+            (self.controller.user, {"user_name": "u"}))
+        self.assertEqual(
+            self.dispatcher.match("GET", ["u"]),
+            (self.controller.user, {"user_name": "u"}))
+
+    def test_missing_action(self):
+        self.connect("/", "index", "GET")
+        self.assertEqual(self.dispatcher.match("GET", [""]), None)
+        request = DummyRequest([""])
+        self.dispatcher.render(request)
+        self.assertEqual(request.responseCode, 404)
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(
+            dispatcher,
+            "CODECS",
+            [x for x in dispatcher.CODECS if x[0] != "br"])
+
+    def test_negotiate_encoding(self):
+        headers = [
+            (None, None),
+            ("", None),
+            ("identity", None),
+            ("gzip", "gzip"),
+            ("deflate", "deflate"),
+            ("GZIP", "gzip"),
+            # The server's order of preference wins over quality.
+            ("deflate, gzip", "gzip"),
+            ("deflate;q=1.0, gzip;q=0.5", "gzip"),
+            ("gzip;q=0, deflate", "deflate"),
+            ("gzip;q=0, deflate;q=0", None),
+            ("gzip;q=x, deflate", "deflate"),
+            ("*", "gzip"),
+            ("*;q=0", None),
+            ("*, gzip;q=0", "deflate"),
+            ("deflate, *;q=0", "deflate")]
+        for header, encoding in headers:
+            self.assertEqual(negotiate_encoding(header), encoding)
+
+    def test_compress_level(self):
+        data = "x" * 100000
+        stored = "".join(compress(data, "deflate", 0))
+        self.assertEqual(zlib.decompress(stored), data)
+        self.assertTrue(len(stored) > len(data))
+        self.patch(dispatcher, "COMPRESSION_LEVEL", 0)
+        self.assertEqual("".join(compress(data, "deflate")), stored)
+        self.patch(dispatcher, "COMPRESSION_CHUNK_SIZE", 1000)
+        compressed = "".join(compress(data, "gzip", 9))
+        self.assertTrue(len(compressed) < 1000)
+        self.assertEqual(
+            zlib.decompress(compressed, 16 + zlib.MAX_WBITS),
+            data)
+
+    @inlineCallbacks
+    def test_compression_failure(self):
+        def failing_compress(data, encoding):
+            raise zlib.error("Failed.")
+        self.patch(dispatcher, "compress", failing_compress)
+        self.patch(dispatcher, "COMPRESSION_THREAD_SIZE", 0)
+        request = Request([])
+        request.requestHeaders.setRawHeaders("accept-encoding", ["gzip"])
+        yield Dispatcher()._compress_response("x" * 2048, request)
+        self.assertEqual(len(self.flushLoggedErrors(zlib.error)), 1)
+        self.assertTrue(request.lost)
+        self.assertEqual(request.finished, 0)
+
+
+class StreamController(object):
+
+    def __init__(self, stream):
+        self.stream = stream
+
+    def get(self, request):
+        return self.stream
+
+
+class StreamProducerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.patch(
+            dispatcher,
+            "CODECS",
+            [x for x in dispatcher.CODECS if x[0] != "br"])
+
+    def produce(self, sections, encoding=None, prefix="", suffix=""):
+        self.request = Request([])
+        self.producer = StreamProducer(
+            self.request,
+            Stream(sections),
+            prefix,
+            suffix,
+            encoding)
+        return self.producer.start()
+
+    def body(self):
+        data = "".join(self.request.written)
+        encoding = self.request.responseHeaders.getRawHeaders(
+            "content-encoding",
+            [None])[0]
+        if encoding == "gzip":
+            data = zlib.decompress(data, 16 + zlib.MAX_WBITS)
+        return data
+
+    @inlineCallbacks
+    def render(self, stream, args=None, headers=None):
+        """
+        Render a Stream through a Dispatcher.
+        """
+        _dispatcher = Dispatcher()
+        _dispatcher.connect(
+            "stream",
+            route="/stream",
+            controller=StreamController(stream),
+            action="get",
+            conditions={"method": "GET"})
+        self.request = Request(["stream"])
+        self.request.args = args or {}
+        for name, value in (headers or {}).items():
+            self.request.requestHeaders.setRawHeaders(name, [value])
+        finished = self.request.notifyFinish()
+        _dispatcher.render(self.request)
+        yield finished
+
+    @inlineCallbacks
+    def test_sections(self):
+        event_id = "\x01" * 16
+        result = yield self.produce([
+            ("id", Id(event_id)),
+            ("total", id_keys({event_id: 1})),
+            ("fired", succeed([1, 2])),
+            ("nested", Stream([
+                ("a", succeed(Stream([("b", None)]))),
+                ("c", u"\xe9")])),
+            ("empty", Stream([]))])
+        self.assertIdentical(result, STREAMED)
+        self.assertEqual(self.request.finished, 1)
+        self.assertIdentical(self.request.producer, None)
+        self.assertEqual(ujson.loads(self.body()), {
+            "id": uri_b64encode(event_id),
+            "total": {uri_b64encode(event_id): 1},
+            "fired": [1, 2],
+            "nested": {"a": {"b": None}, "c": u"\xe9"},
+            "empty": {}})
+
+    @inlineCallbacks
+    def test_pending_section(self):
+        self.patch(dispatcher, "COMPRESSION_MIN_SIZE", 100)
+        pending = Deferred()
+        done = self.produce([("a", "x" * 200), ("b", pending)])
+        # The sections before the pending one are sent while it is waited
+        # for.
+        self.assertFalse(done.called)
+        self.assertEqual(self.body(), '{"a":"%s","b":' % ("x" * 200))
+        pending.callback(1)
+        result = yield done
+        self.assertIdentical(result, STREAMED)
+        self.assertEqual(ujson.loads(self.body()), {"a": "x" * 200, "b": 1})
+
+    def test_small_pending_section(self):
+        pending = Deferred()
+        done = self.produce([("a", 1), ("b", pending)], "gzip")
+        # Too little to send or compress until the section arrives.
+        self.assertEqual(self.request.written, [])
+        pending.callback(2)
+        self.assertTrue(done.called)
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders("content-encoding"),
+            None)
+        self.assertEqual(ujson.loads(self.body()), {"a": 1, "b": 2})
+
+    @inlineCallbacks
+    def test_sync_flush(self):
+        self.patch(dispatcher, "COMPRESSION_MIN_SIZE", 100)
+        pending = Deferred()
+        done = self.produce([("a", "x" * 200), ("b", pending)], "gzip")
+        # Everything sent so far can be decompressed.
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        self.assertEqual(
+            decompressor.decompress("".join(self.request.written)),
+            '{"a":"%s","b":' % ("x" * 200))
+        pending.callback(1)
+        yield done
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders("content-encoding"),
+            ["gzip"])
+        self.assertEqual(ujson.loads(self.body()), {"a": "x" * 200, "b": 1})
+
+    def test_pause(self):
+        self.patch(dispatcher, "STREAM_CHUNK_SIZE", 10)
+        sections = [(str(x), "x" * 10) for x in range(10)]
+        self.request = Request([])
+        self.producer = StreamProducer(self.request, Stream(sections))
+        self.producer.pauseProducing()
+        done = self.producer.start()
+        self.assertIdentical(self.request.producer, self.producer)
+        self.assertEqual(self.request.written, [])
+        write = self.request.write
+
+        def pausing_write(data):
+            write(data)
+            self.producer.pauseProducing()
+        self.request.write = pausing_write
+        resumed = 0
+        while not done.called:
+            self.producer.resumeProducing()
+            resumed += 1
+            self.assertEqual(len(self.request.written), resumed)
+        self.assertTrue(resumed > 5)
+        self.assertEqual(self.request.finished, 1)
+        self.assertEqual(ujson.loads(self.body()), dict(sections))
+
+    def test_stop(self):
+        pending = Deferred()
+        done = self.produce([("a", pending)])
+        self.producer.stopProducing()
+        self.assertTrue(done.called)
+        pending.callback(1)
+        self.assertEqual(self.request.finished, 0)
+
+    @inlineCallbacks
+    def test_failure_before_start(self):
+        yield self.render(Stream([("a", fail(ValueError("Failed.")))]))
+        self.assertEqual(self.request.responseCode, 500)
+        self.assertFalse(self.request.lost)
+        self.assertEqual(self.request.finished, 1)
+        self.assertEqual(ujson.loads(self.body())["error"], "Failed.")
+
+    def test_failure_after_start(self):
+        self.patch(dispatcher, "COMPRESSION_MIN_SIZE", 100)
+        pending = Deferred()
+        done = self.produce([("a", "x" * 200), ("b", pending)])
+        written = list(self.request.written)
+        pending.errback(ValueError("Failed."))
+        self.assertEqual(len(self.flushLoggedErrors(ValueError)), 1)
+        self.assertTrue(self.request.lost)
+        self.assertEqual(self.request.finished, 0)
+        self.assertEqual(self.request.written, written)
+        self.assertIdentical(self.request.producer, None)
+        self.assertIdentical(done.result, STREAMED)
+
+    @inlineCallbacks
+    def test_jsonp(self):
+        yield self.render(
+            Stream([("a", succeed(1))]),
+            args={"callback": ["callback"]})
+        self.assertEqual(self.body(), 'callback({"a":1});')
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders("content-type"),
+            ["application/javascript"])
+
+    @inlineCallbacks
+    def test_compression(self):
+        self.patch(dispatcher, "STREAM_CHUNK_SIZE", 100)
+        sections = [(str(x), "x" * 100) for x in range(100)]
+        yield self.render(
+            Stream(sections),
+            headers={"accept-encoding": "gzip"})
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders("content-encoding"),
+            ["gzip"])
+        self.assertTrue(len(self.request.written) > 1)
+        self.assertEqual(ujson.loads(self.body()), dict(sections))
+
+    @inlineCallbacks
+    def test_msgpack(self):
+        if msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed.")
+        event_id = "\x01" * 16
+        yield self.render(
+            Stream([
+                ("id", Id(event_id)),
+                ("nested", succeed(Stream([("a", "b")])))]),
+            headers={"accept": "application/msgpack"})
+        self.assertEqual(
+            self.request.responseHeaders.getRawHeaders("content-type"),
+            ["application/msgpack"])
+        self.assertEqual(
+            msgpack.unpackb(self.body(), raw=False),
+            {"id": event_id, "nested": {"a": "b"}})
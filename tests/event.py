@@ -2,13 +2,28 @@
 # -*- coding: utf-8 -*-
 
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks, returnValue
-from lib.agent import request
+from twisted.internet.defer import inlineCallbacks, returnValue, fail, \
+    FirstError
+from lib.agent import request, StringProducer
 from hiitrack import HiiTrack
+from hiitrack.controllers.event import ingest_spooled
+from hiitrack.models import VisitorModel
+from hiitrack.models import visitor
+from hiitrack.models.visitor import VisitorFilters
+from hiitrack.lib.hash import pack_hash
+from hiitrack.lib import cassandra
+from hiitrack.lib.cache import LRUCache
+from hiitrack.lib.b64encode import uri_b64decode
 import uuid
 import ujson
+import time
+import os
 from pprint import pprint
 from urllib import quote
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
 
 
 class EventTestCase(unittest.TestCase):
@@ -116,6 +131,117 @@ class EventTestCase(unittest.TestCase):
         result = yield self.post_event(visitor_id_1, NAME)
         result = yield self.get_event(NAME)
 
+    @inlineCallbacks
+    def test_recreate_bucket(self):
+        NAME = uuid.uuid4().hex
+        PROPERTY = uuid.uuid4().hex
+        VALUE = uuid.uuid4().hex
+        visitor_id = uuid.uuid4().hex
+        self.patch(visitor, "VISITOR_CACHE", LRUCache(size=1000, weigh=len))
+        yield self.post_event(visitor_id, NAME)
+        yield self.post_property(visitor_id, PROPERTY, VALUE)
+        result = yield request(
+            "DELETE",
+            self.url,
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
+        result = yield request(
+            "PUT",
+            self.url,
+            username=self.username,
+            password=self.password,
+            data={"description":self.description})
+        self.assertEqual(result.code, 201)
+        events = yield self.get_event_dict()
+        self.assertEqual(events, {})
+        # Events, properties and visitors of the deleted bucket are new
+        # again.
+        yield self.post_event(visitor_id, NAME)
+        yield self.post_property(visitor_id, PROPERTY, VALUE)
+        events = yield self.get_event_dict()
+        self.assertEqual(events.keys(), [NAME])
+        properties = yield self.get_property_dict()
+        self.assertEqual(properties.keys(), [PROPERTY])
+        self.assertEqual(properties[PROPERTY].keys(), [VALUE])
+        event = yield self.get_event(NAME)
+        self.assertEqual(event["total"].values(), [1, 1])
+        self.assertEqual(event["unique_total"].values(), [1, 1])
+
+    @inlineCallbacks
+    def test_msgpack(self):
+        if msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed.")
+        NAME = uuid.uuid4().hex
+        visitor_id_1 = uuid.uuid4().hex
+        yield self.post_event(visitor_id_1, NAME)
+        event = yield self.get_event(NAME)
+        result = yield request(
+            "GET",
+            str("%s/event/%s" % (self.url, quote(NAME))),
+            username=self.username,
+            password=self.password,
+            headers={"Accept":["application/msgpack"]})
+        self.assertEqual(result.code, 200)
+        self.assertEqual(
+            result.headers.getRawHeaders("content-type"),
+            ["application/msgpack"])
+        data = msgpack.unpackb(result.body, raw=False)
+        event_id = uri_b64decode(str(event["id"]))
+        self.assertEqual(data["id"], event_id)
+        self.assertEqual(data["name"], NAME)
+        self.assertEqual(data["total"][event_id], 1)
+
+    @inlineCallbacks
+    def test_batch(self):
+        event_name_1 = "Event 1 %s" % uuid.uuid4().hex
+        event_name_2 = "Event 2 %s" % uuid.uuid4().hex
+        visitor_id_1 = uuid.uuid4().hex
+        visitor_id_2 = uuid.uuid4().hex
+        property_key = uuid.uuid4().hex
+        property_value = "Property %s" % uuid.uuid4().hex
+        records = [
+            {"visitor_id":visitor_id_1, "event":event_name_1},
+            {"visitor_id":visitor_id_2, "event":event_name_1,
+                "properties":{property_key:property_value}},
+            {"visitor_id":visitor_id_1, "event":event_name_2},
+            {"visitor_id":visitor_id_1, "event":event_name_1}]
+        result = yield request(
+            "POST",
+            "%s/event" % self.url,
+            headers={"Content-Type":["application/x-ndjson"]},
+            bodyProducer=StringProducer(
+                "\n".join([ujson.dumps(x) for x in records])))
+        self.assertEqual(result.code, 200)
+        self.assertEqual(ujson.loads(result.body)["events"], 4)
+        result = yield request(
+            "POST",
+            "%s/event" % self.url,
+            bodyProducer=StringProducer(ujson.dumps([{"event":"x"}])))
+        self.assertEqual(result.code, 403)
+        for properties in [[1], ["ab"], [["a", 1]], {"a": ["b"]}]:
+            result = yield request(
+                "POST",
+                "%s/event" % self.url,
+                bodyProducer=StringProducer(ujson.dumps([{
+                    "visitor_id":visitor_id_1,
+                    "event":event_name_1,
+                    "properties":properties}])))
+            self.assertEqual(result.code, 403)
+        event_1 = yield self.get_event(event_name_1)
+        event_2 = yield self.get_event(event_name_2)
+        events = yield self.get_event_dict()
+        event_1_id = events[event_name_1]
+        event_2_id = events[event_name_2]
+        properties = yield self.get_property_dict()
+        property_id = properties[property_key][property_value]
+        self.assertEqual(event_1["total"][event_1_id], 3)
+        self.assertEqual(event_1["unique_total"][event_1_id], 2)
+        self.assertEqual(event_1["total"][property_id], 1)
+        self.assertEqual(event_2["total"][event_2_id], 1)
+        self.assertEqual(event_2["path"][event_2_id][event_1_id], 1)
+        self.assertEqual(event_1["path"][event_1_id][event_2_id], 1)
+
     @inlineCallbacks
     def test_get(self):          
         event_name_1 = "Event 1 %s" % uuid.uuid4().hex
@@ -161,6 +287,328 @@ class EventTestCase(unittest.TestCase):
         self.assertEqual(event_3["unique_path"][event_3_id][event_2_id], 1)
         self.assertEqual(event_3["unique_path"][event_3_id][event_3_id], 1)
          
+    @inlineCallbacks
+    def test_sharded(self):
+        self.patch(cassandra, "SHARDS", 4)
+        shards = set()
+        shard_key = cassandra.shard_key
+        def recording_shard_key(key, column_id):
+            result = shard_key(key, column_id)
+            shards.add(result[len(key):])
+            return result
+        self.patch(cassandra, "shard_key", recording_shard_key)
+        yield self.test_get()
+        self.assertTrue(len(shards) > 1)
+
+    @inlineCallbacks
+    def test_unique_visitors(self):
+        event_name = "Event %s" % uuid.uuid4().hex
+        self.patch(
+            cassandra,
+            "SKETCHES",
+            cassandra.SketchBuffer(node_id="test"))
+        for i in range(100):
+            yield self.post_event(uuid.uuid4().hex, event_name)
+        yield cassandra.SKETCHES.flush()
+        # A restarted process with the same node id merges into its columns.
+        cassandra.SKETCHES = cassandra.SketchBuffer(node_id="test")
+        for i in range(100):
+            yield self.post_event(uuid.uuid4().hex, event_name)
+        yield cassandra.SKETCHES.flush()
+        event = yield self.get_event(event_name)
+        events = yield self.get_event_dict()
+        event_id = events[event_name]
+        self.assertApproximates(
+            event["unique_visitors"][event_id], 200, 20)
+        self.assertEqual(len(event["daily_unique_visitors"]), 1)
+        self.assertApproximates(
+            event["daily_unique_visitors"].values()[0][event_id],
+            200,
+            20)
+        key = (self.username, self.url.split("/")[-1], "visitor_sketch")
+        prefix = uri_b64decode(str(event_id))
+        data = yield cassandra.multiget_slices([(key, prefix)], "relation")
+        self.assertEqual(len(data[(key, prefix)]), 1)
+        cassandra.SKETCHES = None
+        event = yield self.get_event(event_name)
+        self.assertEqual(event["unique_visitors"], {})
+        self.assertEqual(event["daily_unique_visitors"], {})
+
+    @inlineCallbacks
+    def test_spooled_bucket_failure(self):
+        NAME = uuid.uuid4().hex
+        visitor_id_1 = uuid.uuid4().hex
+        bucket_name_1 = self.url.split("/")[-1]
+        bucket_name_2 = uuid.uuid4().hex
+        url_2 = "http://127.0.0.1:8080/%s/%s" % (self.username, bucket_name_2)
+        result = yield request(
+            "PUT",
+            url_2,
+            username=self.username,
+            password=self.password,
+            data={"description":self.description})
+        self.assertEqual(result.code, 201)
+        items = [{
+            "user_name":self.username,
+            "bucket_name":x,
+            "visitor_id":visitor_id_1,
+            "event":NAME,
+            "timestamp":time.time()} for x in [bucket_name_1, bucket_name_2]]
+        get_state = VisitorModel.get_state
+        def failing_get_state(visitor, *args):
+            if visitor.bucket_name == bucket_name_2:
+                return fail(IOError("Unavailable."))
+            return get_state(visitor, *args)
+        self.patch(VisitorModel, "get_state", failing_get_state)
+        retries = yield ingest_spooled(items)
+        self.assertEqual(len(self.flushLoggedErrors(FirstError)), 1)
+        self.assertEqual(retries, items[1:])
+        self.patch(VisitorModel, "get_state", get_state)
+        retries = yield ingest_spooled(retries)
+        self.assertEqual(retries, [])
+        for url in [self.url, url_2]:
+            result = yield request(
+                "GET",
+                str("%s/event/%s" % (url, NAME)),
+                username=self.username,
+                password=self.password)
+            self.assertEqual(result.code, 200)
+            event = ujson.loads(result.body)
+            self.assertEqual(event["total"].values(), [1])
+        result = yield request(
+            "DELETE",
+            url_2,
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
+
+    @inlineCallbacks
+    def test_spooled_write_failure(self):
+        NAME = uuid.uuid4().hex
+        self.patch(visitor, "VISITOR_CACHE", LRUCache(size=1000, weigh=len))
+        items = [{
+            "user_name":self.username,
+            "bucket_name":self.url.split("/")[-1],
+            "visitor_id":uuid.uuid4().hex,
+            "event":NAME,
+            "timestamp":time.time()}]
+        write = cassandra.CounterBatch.write
+        self.patch(
+            cassandra.CounterBatch,
+            "write",
+            lambda batch: fail(IOError("Unavailable.")))
+        retries = yield ingest_spooled(items)
+        self.assertEqual(len(self.flushLoggedErrors(FirstError)), 1)
+        self.assertEqual(retries, items)
+        # States recording the failed writes are not cached.
+        self.assertEqual(len(visitor.VISITOR_CACHE), 0)
+        result = yield request(
+            "POST",
+            "%s/event" % self.url,
+            bodyProducer=StringProducer(ujson.dumps(items)))
+        self.assertEqual(result.code, 500)
+        self.patch(cassandra.CounterBatch, "write", write)
+        retries = yield ingest_spooled(retries)
+        self.assertEqual(retries, [])
+        event = yield self.get_event(NAME)
+        self.assertEqual(event["total"].values(), [1])
+        self.assertEqual(event["unique_total"].values(), [1])
+
+    @inlineCallbacks
+    def test_path_settings(self):
+        visitor_id = uuid.uuid4().hex
+        now = time.time()
+        # Hits of d skip the path from a. With the window, so do those of b
+        # and c.
+        settings = [
+            ({"path_limit":"2"}, [("a", now - 3), ("b", now - 2),
+                ("c", now - 1), ("d", now)], 1),
+            ({"path_window":"60"}, [("a", now - 3600), ("b", now - 30),
+                ("c", now), ("d", now)], 3)]
+        for data, hits, truncated in settings:
+            url = "http://127.0.0.1:8080/%s/%s" % (
+                self.username,
+                uuid.uuid4().hex)
+            data["description"] = self.description
+            result = yield request(
+                "PUT",
+                url,
+                username=self.username,
+                password=self.password,
+                data=data)
+            self.assertEqual(result.code, 201)
+            result = yield request(
+                "POST",
+                "%s/event" % url,
+                bodyProducer=StringProducer(ujson.dumps([{
+                    "visitor_id":visitor_id,
+                    "event":x[0],
+                    "timestamp":x[1]} for x in hits])))
+            self.assertEqual(result.code, 200)
+            result = yield request(
+                "GET",
+                url,
+                username=self.username,
+                password=self.password)
+            bucket = ujson.loads(result.body)
+            event_ids = bucket["events"]
+            self.assertEqual(bucket["stats"]["truncated_hits"], truncated)
+            self.assertEqual(bucket["stats"]["skipped_paths"], truncated)
+            result = yield request(
+                "GET",
+                "%s/event/d" % url,
+                username=self.username,
+                password=self.password)
+            event = ujson.loads(result.body)
+            self.assertEqual(
+                sorted(event["path"][event_ids["d"]].keys()),
+                sorted([event_ids["b"], event_ids["c"]]))
+            result = yield request(
+                "DELETE",
+                url,
+                username=self.username,
+                password=self.password)
+            self.assertEqual(result.code, 200)
+
+    @inlineCallbacks
+    def test_buffer_stop(self):
+        NAME = uuid.uuid4().hex
+        self.patch(cassandra, "BUFFER", cassandra.CounterBuffer(interval=3600))
+        cassandra.BUFFER.start()
+        result = yield request(
+            "POST",
+            "%s/event/%s" % (self.url, NAME),
+            data={"visitor_id":uuid.uuid4().hex})
+        self.assertEqual(result.code, 200)
+        event = yield self.get_event(NAME)
+        self.assertEqual(event["total"].values(), [])
+        # Buffered increments are written on shutdown.
+        yield self.hiitrack.stopService()
+        self.hiitrack = HiiTrack(8080)
+        self.hiitrack.startService()
+        event = yield self.get_event(NAME)
+        self.assertEqual(event["total"].values(), [1])
+        self.assertEqual(event["unique_total"].values(), [1])
+
+    @inlineCallbacks
+    def test_visitor_filter(self):
+        path = self.mktemp()
+        os.mkdir(path)
+        self.patch(visitor, "VISITOR_FILTERS", VisitorFilters(path, 100))
+        bucket_name = uuid.uuid4().hex
+        url = "http://127.0.0.1:8080/%s/%s" % (self.username, bucket_name)
+        result = yield request(
+            "PUT",
+            url,
+            username=self.username,
+            password=self.password,
+            data={"description":self.description, "visitor_filter":"1"})
+        self.assertEqual(result.code, 201)
+        loaded = []
+        load_state = VisitorModel.load_state
+        def counting_load_state(_visitor):
+            loaded.append(_visitor.id)
+            return load_state(_visitor)
+        self.patch(VisitorModel, "load_state", counting_load_state)
+        visitor_id_1, visitor_id_2, visitor_id_3 = \
+            [uuid.uuid4().hex for _ in range(3)]
+        ids = [pack_hash((self.username, bucket_name, x))
+            for x in [visitor_id_1, visitor_id_2, visitor_id_3]]
+        for visitor_id in [visitor_id_1, visitor_id_1, visitor_id_2,
+                visitor_id_1, visitor_id_2]:
+            result = yield request(
+                "POST",
+                "%s/event/%s" % (url, "a"),
+                data={"visitor_id":visitor_id})
+            self.assertEqual(result.code, 200)
+        # The first hit reads while the filter is built. New visitor 2 is
+        # not read.
+        self.assertEqual(loaded, [ids[0], ids[0], ids[0], ids[1]])
+        result = yield request(
+            "GET",
+            "%s/event/a" % url,
+            username=self.username,
+            password=self.password)
+        event = ujson.loads(result.body)
+        self.assertEqual(event["total"].values(), [5])
+        self.assertEqual(event["unique_total"].values(), [2])
+        self.assertEqual(event["path"].values()[0].values(), [3])
+        self.assertEqual(event["unique_path"].values()[0].values(), [2])
+        # Filters are checkpointed on stop and loaded by the next process.
+        key = (self.username, bucket_name)
+        visitor.VISITOR_FILTERS.stop()
+        self.assertEqual(len(os.listdir(path)), 1)
+        filters = VisitorFilters(path, 100)
+        self.assertTrue(filters.might_contain(key[0], key[1], ids[0]))
+        self.assertTrue(filters.might_contain(key[0], key[1], ids[1]))
+        self.assertFalse(filters.might_contain(key[0], key[1], ids[2]))
+        self.assertEqual(os.listdir(path), [])
+        # Without a checkpoint they are built from the stored visitors.
+        filters = VisitorFilters(None, 100)
+        self.assertTrue(filters.might_contain(key[0], key[1], ids[2]))
+        if key in filters.building:
+            yield filters.building[key]
+        self.assertTrue(filters.might_contain(key[0], key[1], ids[0]))
+        self.assertTrue(filters.might_contain(key[0], key[1], ids[1]))
+        self.assertFalse(filters.might_contain(key[0], key[1], ids[2]))
+        result = yield request(
+            "DELETE",
+            url,
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
+        self.assertFalse(key in visitor.VISITOR_FILTERS.filters)
+
+    @inlineCallbacks
+    def test_time_range(self):
+        url = "http://127.0.0.1:8080/%s/%s" % (
+            self.username,
+            uuid.uuid4().hex)
+        result = yield request(
+            "PUT",
+            url,
+            username=self.username,
+            password=self.password,
+            data={"description":self.description, "time_series":"1"})
+        self.assertEqual(result.code, 201)
+        event_name = "Event %s" % uuid.uuid4().hex
+        result = yield request(
+            "POST",
+            "%s/event/%s" % (url, quote(event_name)),
+            data={"visitor_id":uuid.uuid4().hex})
+        self.assertEqual(result.code, 200)
+        now = int(time.time())
+        ranges = [
+            (now - 3600, now + 3600, 1),
+            (now - 3 * 86400, now - 2 * 86400, 0)]
+        for start, end, total in ranges:
+            result = yield request(
+                "GET",
+                str("%s/event/%s?start=%s&end=%s" % (
+                    url, quote(event_name), start, end)),
+                username=self.username,
+                password=self.password)
+            self.assertEqual(result.code, 200)
+            data = ujson.loads(result.body)
+            self.assertEqual(sum(data["total"].values()), total)
+        for query in [
+                "start=%s&end=%s" % (now, now - 3600),
+                "start=0",
+                "end=%s" % now,
+                "start=%s&end=%s" % (now - 367 * 86400, now)]:
+            result = yield request(
+                "GET",
+                str("%s/event/%s?%s" % (url, quote(event_name), query)),
+                username=self.username,
+                password=self.password)
+            self.assertEqual(result.code, 403)
+        result = yield request(
+            "DELETE",
+            url,
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
+
     @inlineCallbacks
     def test_property_get(self):   
         event_name_1 = "Event 1 %s" % uuid.uuid4().hex
@@ -5,11 +5,34 @@ from twisted.trial import unittest
 from twisted.internet.defer import inlineCallbacks, returnValue
 from lib.agent import request
 from hiitrack import HiiTrack
+from hiitrack.controllers.funnel import plan_path_columns
+from hiitrack.lib import cassandra
 import uuid
 import ujson
 from pprint import pprint
 from urllib import quote
 
+
+class PlanPathColumnsTestCase(unittest.TestCase):
+
+    def test_plan_path_columns(self):
+        event_1, event_2, event_3 = [uuid.uuid4().bytes for _ in range(3)]
+        property_1, property_2 = [uuid.uuid4().bytes for _ in range(2)]
+        self.assertEqual(
+            plan_path_columns([event_1, event_2, event_3],
+                [property_1, property_2]),
+            [event_2 + event_2 + event_1,
+            event_2 + property_1 + event_1,
+            event_2 + property_2 + event_1,
+            event_3 + event_3 + event_2,
+            event_3 + property_1 + event_2,
+            event_3 + property_2 + event_2])
+        self.assertEqual(
+            plan_path_columns([event_1, event_2], []),
+            [event_2 + event_2 + event_1])
+        self.assertEqual(plan_path_columns([event_1], [property_1]), [])
+
+
 class FunnelTestCase(unittest.TestCase):
     
     @inlineCallbacks
@@ -228,4 +251,17 @@ class FunnelTestCase(unittest.TestCase):
         self.assertEqual(unique_funnels[property_id_1][2][1], 1)
         self.assertEqual(unique_funnels[property_id_2][0][1], 2)
         self.assertEqual(unique_funnels[property_id_2][1][1], 2)
-        self.assertEqual(unique_funnels[property_id_2][2][1], 1)
\ No newline at end of file
+        self.assertEqual(unique_funnels[property_id_2][2][1], 1)
+
+    @inlineCallbacks
+    def test_sharded(self):
+        self.patch(cassandra, "SHARDS", 4)
+        shards = set()
+        shard_key = cassandra.shard_key
+        def recording_shard_key(key, column_id):
+            result = shard_key(key, column_id)
+            shards.add(result[len(key):])
+            return result
+        self.patch(cassandra, "shard_key", recording_shard_key)
+        yield self.test_add()
+        self.assertTrue(len(shards) > 1)
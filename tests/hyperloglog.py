@@ -0,0 +1,46 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hiitrack.lib.hyperloglog import HyperLogLog
+import uuid
+
+
+class HyperLogLogTestCase(unittest.TestCase):
+
+    def sketch(self, count):
+        sketch = HyperLogLog()
+        for i in range(count):
+            sketch.add(uuid.uuid4().bytes)
+        return sketch
+
+    def test_count(self):
+        self.assertEqual(HyperLogLog().count(), 0)
+        for count in [1, 10, 1000, 20000]:
+            self.assertApproximates(
+                self.sketch(count).count(),
+                count,
+                max(1, count * 0.05))
+
+    def test_duplicates(self):
+        sketch = HyperLogLog()
+        key = uuid.uuid4().bytes
+        for i in range(100):
+            sketch.add(key)
+        self.assertEqual(sketch.count(), 1)
+
+    def test_merge(self):
+        sketch_1 = self.sketch(1000)
+        sketch_2 = self.sketch(1000)
+        sketch_1.merge(sketch_2)
+        self.assertApproximates(sketch_1.count(), 2000, 100)
+        count = sketch_1.count()
+        sketch_1.merge(sketch_2)
+        self.assertEqual(sketch_1.count(), count)
+
+    def test_serialize(self):
+        sketch = self.sketch(1000)
+        loaded = HyperLogLog.loads(sketch.dumps())
+        self.assertEqual(loaded.precision, sketch.precision)
+        self.assertEqual(loaded.registers, sketch.registers)
+        self.assertEqual(loaded.count(), sketch.count())
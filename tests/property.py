@@ -2,9 +2,14 @@
 # -*- coding: utf-8 -*-
 
 from twisted.trial import unittest
-from twisted.internet.defer import inlineCallbacks
+from twisted.internet.defer import inlineCallbacks, returnValue, fail, \
+    Deferred, DeferredList
 from lib.agent import request
 from hiitrack import HiiTrack
+from hiitrack.controllers import property as property_controller
+from hiitrack.lib.cassandra import CounterBatch
+from hiitrack.lib.cache import LRUCache
+from hiitrack.models import visitor
 import uuid
 import ujson
 from urllib import quote
@@ -72,3 +77,117 @@ class PropertyTestCase(unittest.TestCase):
             username=self.username,
             password=self.password)
         self.assertTrue(NAME in ujson.loads(result.body)["properties"])
+
+    @inlineCallbacks
+    def test_post_multiple(self):
+        NAME_1 = uuid.uuid4().hex
+        VALUE_1 = uuid.uuid4().hex
+        NAME_2 = uuid.uuid4().hex
+        VALUE_2 = uuid.uuid4().hex
+        VISITOR_ID = uuid.uuid4().hex
+        result = yield request(
+            "POST",
+            "%s/property" % self.url,
+            data={"visitor_id":VISITOR_ID})
+        self.assertEqual(result.code, 403)
+        result = yield request(
+            "POST",
+            "%s/property" % self.url,
+            data={"visitor_id":VISITOR_ID, NAME_1:VALUE_1, NAME_2:VALUE_2})
+        self.assertEqual(result.code, 200)
+        result = yield request(
+            "GET",
+            self.url,
+            username=self.username,
+            password=self.password)
+        properties = ujson.loads(result.body)["properties"]
+        self.assertTrue(VALUE_1 in properties[NAME_1])
+        self.assertTrue(VALUE_2 in properties[NAME_2])
+
+    @inlineCallbacks
+    def post_events(self, visitor_id):
+        for name in ["a", "b", "a"]:
+            result = yield request(
+                "POST",
+                "%s/event/%s" % (self.url, name),
+                data={"visitor_id":visitor_id})
+            self.assertEqual(result.code, 200)
+
+    @inlineCallbacks
+    def get_total(self, name, value):
+        result = yield request(
+            "GET",
+            "%s/property/%s/%s" % (self.url, quote(name), quote(value)),
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 200)
+        returnValue(ujson.loads(result.body)["total"])
+
+    @inlineCallbacks
+    def test_background_backfill(self):
+        NAME = uuid.uuid4().hex
+        VALUE = uuid.uuid4().hex
+        VISITOR_ID_1 = uuid.uuid4().hex
+        VISITOR_ID_2 = uuid.uuid4().hex
+        self.patch(property_controller, "BACKGROUND_BACKFILL", 1)
+        yield self.post_events(VISITOR_ID_1)
+        yield self.post_events(VISITOR_ID_2)
+        pending = []
+        write = CounterBatch.write
+        def held_write(batch):
+            deferred = Deferred()
+            deferred.addCallback(lambda _: write(batch))
+            pending.append(deferred)
+            return deferred
+        self.patch(CounterBatch, "write", held_write)
+        result = yield request(
+            "POST",
+            "%s/property/%s/%s" % (self.url, quote(NAME), quote(VALUE)),
+            data={"visitor_id":VISITOR_ID_1})
+        self.assertEqual(result.code, 202)
+        result = yield request(
+            "POST",
+            "%s/property" % self.url,
+            data={"visitor_id":VISITOR_ID_2, NAME:VALUE})
+        self.assertEqual(result.code, 202)
+        # Background backfills are sent one at a time.
+        self.assertEqual(len(pending), 1)
+        self.assertEqual(len(property_controller.BACKFILLS), 2)
+        total = yield self.get_total(NAME, VALUE)
+        self.assertEqual(total, {})
+        self.patch(CounterBatch, "write", write)
+        pending[0].callback(None)
+        yield DeferredList(list(property_controller.BACKFILLS))
+        self.assertEqual(len(property_controller.BACKFILLS), 0)
+        # Each visitor is counted once per event.
+        total = yield self.get_total(NAME, VALUE)
+        self.assertEqual(total.values(), [2, 2])
+        result = yield request(
+            "GET",
+            "%s/event/a" % self.url,
+            username=self.username,
+            password=self.password)
+        self.assertEqual(ujson.loads(result.body)["total"].values(), [4, 4])
+
+    @inlineCallbacks
+    def test_background_backfill_failure(self):
+        NAME = uuid.uuid4().hex
+        VALUE = uuid.uuid4().hex
+        VISITOR_ID = uuid.uuid4().hex
+        self.patch(property_controller, "BACKGROUND_BACKFILL", 1)
+        self.patch(visitor, "VISITOR_CACHE", LRUCache(size=1000, weigh=len))
+        yield self.post_events(VISITOR_ID)
+        self.assertEqual(len(visitor.VISITOR_CACHE), 1)
+        self.patch(
+            CounterBatch,
+            "write",
+            lambda batch: fail(IOError("Unavailable.")))
+        result = yield request(
+            "POST",
+            "%s/property/%s/%s" % (self.url, quote(NAME), quote(VALUE)),
+            data={"visitor_id":VISITOR_ID})
+        self.assertEqual(result.code, 202)
+        yield DeferredList(list(property_controller.BACKFILLS))
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        # The cached state recording the failed backfill is dropped.
+        self.assertEqual(len(visitor.VISITOR_CACHE), 0)
@@ -0,0 +1,121 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hiitrack.lib.serializer import Id, IdPairs, dumps_json, \
+    dumps_msgpack, encode_msgpack_ids, id_keys, id_nested_keys, \
+    id_double_nested_keys, id_values, id_nested_values
+from hiitrack.lib.b64encode import uri_b64encode
+import json
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+
+def listed(value):
+    """
+    Return value with tuples replaced by lists, as MessagePack decodes them.
+    """
+    if isinstance(value, (list, tuple)):
+        return [listed(x) for x in value]
+    if isinstance(value, dict):
+        return dict([(k, listed(v)) for k, v in value.iteritems()])
+    return value
+
+
+class SerializerTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Ids include bytes that are not valid UTF-8.
+        self.a = "\x01" * 16
+        self.b = "\xff\xfe" * 8
+        self.c = "\"\\" * 8
+
+    def encoded(self, value):
+        return uri_b64encode(value)
+
+    def marked(self):
+        """
+        Return (data, expected JSON value, expected MessagePack value)
+        triples of responses with ids.
+        """
+        a, b, c = self.a, self.b, self.c
+        e = self.encoded
+        return [
+            (Id(a), e(a), a),
+            (id_keys({a: 1, b: "x"}), {e(a): 1, e(b): "x"}, {a: 1, b: "x"}),
+            (id_nested_keys({a: {b: 1, c: 2}}),
+                {e(a): {e(b): 1, e(c): 2}},
+                {a: {b: 1, c: 2}}),
+            (id_double_nested_keys({a: {b: {c: 1}}, c: {}}),
+                {e(a): {e(b): {e(c): 1}}, e(c): {}},
+                {a: {b: {c: 1}}, c: {}}),
+            (id_values({"x": a, "y": b}),
+                {"x": e(a), "y": e(b)},
+                {"x": a, "y": b}),
+            (id_nested_values({"x": {"y": a}, "z": {}}),
+                {"x": {"y": e(a)}, "z": {}},
+                {"x": {"y": a}, "z": {}}),
+            (IdPairs([(a, 1), (b, {"c": [2]})]),
+                [[e(a), 1], [e(b), {"c": [2]}]],
+                [[a, 1], [b, {"c": [2]}]]),
+            ({"ids": [Id(a), Id(a), id_keys({b: None})]},
+                {"ids": [e(a), e(a), {e(b): None}]},
+                {"ids": [a, a, {b: None}]})]
+
+    def plain(self):
+        """
+        Return responses without ids.
+        """
+        return [
+            {1: "int", 2L: "long", 1.5: "float", 1.0 / 3: "float",
+                True: "bool", None: "none"},
+            {u"\xe9": u"\xe9", "\xc3\xa8": "\xc3\xa8", "\"\n": "\\"},
+            {"float": 1.0 / 3, "large": 1e300, "small": -1e-7, "zero": 0.0,
+                "long": 2 ** 62, "none": None, "true": True, "false": False},
+            [(1, 2), [], {}, "", u""],
+            1.0 / 3,
+            None,
+            u"☃"]
+
+    def test_json_ids(self):
+        for data, expected, _ in self.marked():
+            self.assertEqual(json.loads(dumps_json(data)), expected)
+
+    def test_json_plain(self):
+        for data in self.plain():
+            self.assertEqual(
+                json.loads(dumps_json(data)),
+                json.loads(json.dumps(data)))
+
+    def test_msgpack_ids(self):
+        for data, _, expected in self.marked():
+            self.assertEqual(listed(encode_msgpack_ids(data)), expected)
+        # Ids are binary, other strings are text.
+        encoded = encode_msgpack_ids({"x": [Id(self.a), "y", "\xff"]})
+        self.assertEqual(
+            [type(x) for x in encoded.keys() + encoded["x"]],
+            [unicode, str, unicode, str])
+
+    def test_msgpack_plain(self):
+        for data in self.plain():
+            encoded = encode_msgpack_ids(data)
+            if isinstance(data, dict):
+                self.assertEqual(
+                    encoded,
+                    dict([(k.decode("utf-8") if isinstance(k, str) else k,
+                        v.decode("utf-8") if isinstance(v, str) else v)
+                        for k, v in data.iteritems()]))
+            elif isinstance(data, list):
+                self.assertEqual(listed(encoded), [[1, 2], [], {}, u"", u""])
+            else:
+                self.assertEqual(encoded, data)
+
+    def test_msgpack_round_trip(self):
+        if msgpack is None:
+            raise unittest.SkipTest("msgpack is not installed.")
+        for data, _, expected in self.marked():
+            self.assertEqual(
+                msgpack.unpackb(dumps_msgpack(data), raw=False),
+                expected)
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, succeed
+from hiitrack.lib import spool
+from hiitrack.lib.spool import Spool
+import os
+
+
+class SpoolTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = self.mktemp()
+        self.handled = []
+        self.retries = []
+        self.failing = False
+        self.spools = []
+
+    @inlineCallbacks
+    def tearDown(self):
+        for _spool in self.spools:
+            if not _spool.file.closed:
+                yield _spool.stop()
+
+    def handler(self, records):
+        if self.failing:
+            raise IOError("Unavailable.")
+        self.handled.extend(records)
+        retries = [x for x in records if x in self.retries]
+        for record in retries:
+            self.retries.remove(record)
+        return succeed(retries)
+
+    def open_spool(self, chunk_size=1000):
+        _spool = Spool(self.path, self.handler, chunk_size=chunk_size)
+        self.spools.append(_spool)
+        return _spool
+
+    @inlineCallbacks
+    def append(self, _spool, records):
+        deferred = _spool.append(records)
+        yield _spool.sync()
+        yield deferred
+
+    def read_offset(self):
+        with open("%s.offset" % self.path, "rb") as offset_file:
+            return int(offset_file.read())
+
+    @inlineCallbacks
+    def test_append_after_fsync(self):
+        fsynced = []
+        self.patch(spool.os, "fsync", fsynced.append)
+        _spool = self.open_spool()
+        deferred = _spool.append([{"a": 1}])
+        self.assertFalse(deferred.called)
+        self.assertEqual(fsynced, [])
+        yield _spool.sync()
+        self.assertTrue(deferred.called)
+        self.assertEqual(fsynced, [_spool.file.fileno()])
+
+    @inlineCallbacks
+    def test_replay(self):
+        _spool = self.open_spool()
+        yield self.append(_spool, [{"a": 1}, {"a": 2}])
+        # Abandon the spool without draining, as a crash would.
+        _spool.file.close()
+        yield self.open_spool().drain()
+        self.assertEqual(self.handled, [{"a": 1}, {"a": 2}])
+
+    @inlineCallbacks
+    def test_checkpoint(self):
+        _spool = self.open_spool(chunk_size=1)
+        yield self.append(_spool, [{"a": 1}, {"a": 2}])
+        _spool.handler = self.handle_once
+        yield _spool.drain()
+        self.assertEqual(len(self.flushLoggedErrors(IOError)), 1)
+        self.assertEqual(self.handled, [{"a": 1}])
+        self.assertEqual(self.read_offset(), _spool.offset)
+        self.assertTrue(0 < _spool.offset < os.path.getsize(self.path))
+        _spool.file.close()
+        self.failing = False
+        self.handled = []
+        yield self.open_spool().drain()
+        self.assertEqual(self.handled, [{"a": 2}])
+
+    def handle_once(self, records):
+        result = self.handler(records)
+        self.failing = True
+        return result
+
+    @inlineCallbacks
+    def test_truncate(self):
+        _spool = self.open_spool()
+        yield self.append(_spool, [{"a": 1}, {"a": 2}])
+        yield _spool.drain()
+        self.assertEqual(self.handled, [{"a": 1}, {"a": 2}])
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.assertEqual(_spool.offset, 0)
+        self.assertEqual(self.read_offset(), 0)
+        yield _spool.stop()
+        self.handled = []
+        yield self.open_spool().drain()
+        self.assertEqual(self.handled, [])
+
+    @inlineCallbacks
+    def test_retry(self):
+        _spool = self.open_spool()
+        self.retries = [{"a": 2}]
+        yield self.append(_spool, [{"a": 1}, {"a": 2}])
+        yield _spool.drain()
+        self.assertEqual(self.handled, [{"a": 1}, {"a": 2}])
+        self.handled = []
+        yield _spool.drain()
+        self.assertEqual(self.handled, [{"a": 2}])
+        self.assertEqual(os.path.getsize(self.path), 0)
+        self.handled = []
+        yield _spool.drain()
+        self.assertEqual(self.handled, [])
@@ -6,4 +6,18 @@ from event import EventTestCase
 from property import PropertyTestCase
 from user import UserTestCase
 from funnel import FunnelTestCase
-
+from funnel import PlanPathColumnsTestCase
+from spool import SpoolTestCase
+from hyperloglog import HyperLogLogTestCase
+from dispatcher import DispatcherTestCase
+from dispatcher import CompressionTestCase
+from dispatcher import StreamProducerTestCase
+from serializer import SerializerTestCase
+from cache import LRUCacheTestCase
+from visitor import VisitorStateTestCase
+from bloom import BloomFilterTestCase
+from cassandra import CounterBatchTestCase
+from cassandra import CounterBufferTestCase
+from cassandra import SlicePagerTestCase
+from cassandra import MultigetSliceTestCase
+from cassandra import ShardTestCase
@@ -6,6 +6,7 @@ from twisted.internet.defer import inlineCallbacks
 from lib.agent import request
 from hiitrack import HiiTrack
 import uuid
+import ujson
 
 class UserTestCase(unittest.TestCase):
     
@@ -121,4 +122,42 @@ class UserTestCase(unittest.TestCase):
             "http://127.0.0.1:8080/%s" % USERNAME_B,
             username=USERNAME_B,
             password=PASSWORD_B) 
-        self.assertEqual(result.code, 200)       
\ No newline at end of file
+        self.assertEqual(result.code, 200)       
+
+    @inlineCallbacks
+    def test_token(self):
+        USERNAME = uuid.uuid4().hex
+        PASSWORD = "qwerty"
+        result = yield request(
+            "PUT",
+            "http://127.0.0.1:8080/%s" % USERNAME,
+            data={"password":PASSWORD})
+        self.assertEqual(result.code, 201)
+        result = yield request(
+            "POST",
+            "http://127.0.0.1:8080/%s/token" % USERNAME,
+            username=USERNAME,
+            password=PASSWORD)
+        self.assertEqual(result.code, 200)
+        token = ujson.loads(result.body)["token"]
+        result = yield request(
+            "GET",
+            "http://127.0.0.1:8080/%s" % USERNAME,
+            headers={"Authorization":["Token %s" % token]})
+        self.assertEqual(result.code, 200)
+        result = yield request(
+            "POST",
+            "http://127.0.0.1:8080/%s/token" % USERNAME,
+            headers={"Authorization":["Token %s" % token]})
+        self.assertEqual(result.code, 401)
+        result = yield request(
+            "GET",
+            "http://127.0.0.1:8080/%s" % USERNAME,
+            headers={"Authorization":["Token %sX" % token]})
+        self.assertEqual(result.code, 401)
+        result = yield request(
+            "DELETE",
+            "http://127.0.0.1:8080/%s" % USERNAME,
+            username=USERNAME,
+            password=PASSWORD)
+        self.assertEqual(result.code, 200)
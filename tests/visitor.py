@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hiitrack.models.visitor import VisitorState
+
+
+class VisitorStateTestCase(unittest.TestCase):
+
+    def test_add_event(self):
+        state = VisitorState({}, {}, [])
+        state.add_event("a")
+        state.add_event("b")
+        state.add_event("a")
+        self.assertEqual(state.event_totals, {"a": 2, "b": 1})
+        self.assertEqual(dict(state.path), {
+            "a": {"a": 1, "b": 1},
+            "b": {"a": 1}})
+        self.assertEqual(state.event_times, {})
+        state.add_event("c", ["b"], 10)
+        self.assertEqual(state.path["c"], {"b": 1})
+        self.assertEqual(state.event_times, {"c": 10})
+        self.assertEqual(len(state), 3 + 1 + 4)
+
+    def test_recent_event_ids(self):
+        state = VisitorState(
+            {"a": 1, "b": 1, "c": 1, "d": 1},
+            {},
+            [],
+            {"a": 10, "b": 30, "c": 20})
+        self.assertEqual(
+            sorted(state.recent_event_ids(40)),
+            ["a", "b", "c", "d"])
+        # Events without a time are the oldest.
+        self.assertEqual(state.recent_event_ids(40, limit=2), ["c", "b"])
+        self.assertEqual(
+            state.recent_event_ids(40, limit=3),
+            ["a", "c", "b"])
+        self.assertEqual(
+            sorted(state.recent_event_ids(40, window=20)),
+            ["b", "c"])
+        self.assertEqual(
+            state.recent_event_ids(40, limit=1, window=20),
+            ["b"])
+        self.assertEqual(state.recent_event_ids(100, window=20), [])
+
+    def test_recent_after_add(self):
+        state = VisitorState({}, {}, [])
+        for timestamp, event_id in enumerate(["a", "b", "c", "a"]):
+            event_ids = state.recent_event_ids(timestamp, limit=2)
+            state.add_event(event_id, event_ids, timestamp)
+        self.assertEqual(state.recent_event_ids(4, limit=2), ["c", "a"])
+        self.assertEqual(state.path["c"], {"a": 1, "b": 1})
+        self.assertEqual(state.path["a"], {"b": 1, "c": 1})